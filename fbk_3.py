@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+
+# fbk_3.py -- One entry point for the fbk_*_3 scripts, e.g.
+#
+#		$ ./fbk_3.py fetch -a
+#		$ ./fbk_3.py scrape-likes
+#		$ ./fbk_3.py publish -i
+#		$ ./fbk_3.py search -e "road trip"
+#		$ ./fbk_3.py daemon
+#
+#	Each subcommand takes the same arguments as the script it runs. A script's module, and what it depends on, is
+#	only imported once its subcommand has been picked, so that a cron job running one of them doesn't pay for
+#	loading the others. Link it into your PATH as "fbk" to use it as such.
+#
+#	Every subcommand also takes fbk_metrics' --report, --record-run and --profile, e.g.
+#
+#		$ ./fbk_3.py fetch -a --report fetch.json --record-run
+#
+#	With several accounts in config.json, fetch and scrape-likes work on all of them at once; --account picks one
+#	for any command, e.g.
+#
+#		$ ./fbk_3.py --account band publish -i
+#
+#	--set overrides a setting from config.json (or the environment) for one run, e.g.
+#
+#		$ ./fbk_3.py --set graph.rate=2 --set graph.retries=0 fetch -a
+
+import argparse
+import importlib
+import sys
+from collections import OrderedDict
+from fbk_metrics import fbk_metrics
+
+# subcommand -> (module, description)
+commands = OrderedDict([
+	('fetch',		('fbk_fetch_3', 'Fetch content from Facebook\'s Graph API')),
+	('scrape-likes',	('fbk_scrape_likes_3', 'Scrape likes for content from Facebook\'s Graph API')),
+	('publish',		('fbk_publish_3', 'Publish content from _fetch to html pages')),
+	('replay',		('fbk_replay_3', 'Replay archived pages of posts into the cache')),
+	('search',		('fbk_search_3', 'Search the messages of cached posts')),
+	('daemon',		('fbk_daemon_3', 'Fetch, scrape likes and publish on a schedule')),
+])
+
+# Main()
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(prog='fbk', description='Fetch, scrape and publish Facebook posts',
+			formatter_class=argparse.RawDescriptionHelpFormatter,
+			epilog="commands:\n" + "\n".join("  %-14s %s" % (command, commands[command][1]) for command in commands) +
+				"\n\nRun \"fbk COMMAND -h\" for a command's arguments.")
+
+	parser.add_argument('command', choices=list(commands.keys()), metavar='COMMAND',
+			help='One of: %s' % ", ".join(commands.keys()))
+
+	parser.add_argument('arguments', nargs=argparse.REMAINDER, metavar='...',
+			help='The arguments for COMMAND')
+
+	parser.add_argument('--account', metavar='NAME',
+			help='Run COMMAND against one of the accounts listed in config.json (see fbk_config)')
+
+	parser.add_argument('--set', action='append', default=[], metavar='SECTION.SETTING=VALUE',
+			help='Override a setting from config.json for this run, e.g. graph.rate=2 (see fbk_config)')
+
+	parser.add_argument('--version', action='version', version='%(prog)s 1.0')
+
+	args = parser.parse_args()
+
+	(module_name, description) = commands[args.command]
+	module = importlib.import_module(module_name)
+
+	if(args.account or args.set):
+		from fbk_config import fbk_config
+		fbk_config.account = args.account
+
+		for str_option in args.set:
+			fbk_config.set_option(str_option)
+
+	command_parser = argparse.ArgumentParser(prog='fbk %s' % args.command, description=description)
+	module.add_arguments(command_parser)
+	fbk_metrics.add_arguments(command_parser)
+
+	sys.exit( fbk_metrics.run(args.command, module.run, command_parser.parse_args(args.arguments)) )
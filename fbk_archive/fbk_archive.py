@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+import mmap
+import os
+import re
+import struct
+import time
+import urllib.parse
+import zlib
+from fbk_metrics import fbk_metrics
+
+# zstd compresses Graph's JSON better and faster than zlib, but the zstandard module is optional
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# fbk_archive -- Keeps every page of posts fbk_fetch_3 reads, as it came off the wire, so that the cache can be
+# rebuilt (or taught a new field) from disk instead of by crawling the Graph API again. Pages are compressed one at
+# a time and appended to segment files under the config directory's archive/; the archive table (see fbk_schema)
+# has each page's segment and offset, keyed by the id of the txn row of the request that fetched it.
+#
+#	Each page is a frame: a header (magic, codec, compressed length, length, txn id) and the compressed page. The
+#	header makes a segment readable on its own, should the index ever be lost.
+#
+#	The "archive" section of config.json may set "enabled" (default true), "codec" ("zstd" if the zstandard
+#	module is installed, otherwise "zlib") and "segment_size" (MiB, default 64).
+
+archive_dirname = 'archive'
+default_segment_size = 64
+
+frame_magic = b'FBKA'
+frame_header = struct.Struct('>4sBIIQ')
+
+codec_ids = { 'zlib' : 1, 'zstd' : 2 }
+codec_names = { v : k for k, v in codec_ids.items() }
+
+segment_re = re.compile(r'^segment-(\d+)\.fbka$')
+
+decompress_errors = (zlib.error,)
+if zstandard is not None:
+	decompress_errors += (zstandard.ZstdError,)
+
+def default_codec( ):
+	if zstandard is not None:
+		return 'zstd'
+
+	return 'zlib'
+
+def compressor( codec ):
+	if codec == 'zstd':
+		return zstandard.ZstdCompressor(level=3).compressobj()
+
+	return zlib.compressobj(6)
+
+def decompress( codec, data ):
+	if codec == 'zstd':
+		if zstandard is None:
+			raise ValueError("This archive has zstd pages; install the zstandard module to read them")
+		return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+	return zlib.decompress(data)
+
+# The index doesn't keep access tokens
+def strip_token( url ):
+	parts = urllib.parse.urlsplit(url)
+	query = [ (k, v) for (k, v) in urllib.parse.parse_qsl(parts.query) if k != 'access_token' ]
+
+	return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+# One page, compressed as it is read (fbk_graph hands it each piece of the body). A request that is retried starts
+# over with reset().
+class Record:
+	def __init__(self, codec):
+		self.codec = codec
+		self.reset()
+
+	def reset(self):
+		self.compressor = compressor(self.codec)
+		self.chunks = []
+		self.raw_length = 0
+
+	def write(self, data):
+		self.raw_length += len(data)
+
+		out = self.compressor.compress(data)
+		if out:
+			self.chunks.append(out)
+
+	def finish(self):
+		self.chunks.append(self.compressor.flush())
+
+		data = b''.join(self.chunks)
+		self.chunks = [data]
+		return data
+
+class Archive:
+	def __init__(self, config_dir, codec=None, segment_size=default_segment_size):
+		self.path = os.path.join(config_dir, archive_dirname)
+		self.codec = codec or default_codec()
+		self.segment_size = segment_size * 1048576
+
+		if self.codec not in codec_ids:
+			raise ValueError("Unknown archive codec: %s" % self.codec)
+		if self.codec == 'zstd' and zstandard is None:
+			raise ValueError("The zstd archive codec needs the zstandard module")
+
+		self.outfile = None
+		self.segment = None
+		self.maps = {}
+
+	def record(self):
+		return Record(self.codec)
+
+	def segment_path(self, segment):
+		return os.path.join(self.path, 'segment-%06d.fbka' % segment)
+
+	def segments(self):
+		if not os.path.isdir(self.path):
+			return []
+
+		return sorted( int(m.group(1)) for m in map(segment_re.match, os.listdir(self.path)) if m )
+
+	# The segment to append size bytes to: the last one, until it is full
+	def _outfile(self, size):
+		if self.outfile is None:
+			os.makedirs(self.path, exist_ok=True)
+
+			segments = self.segments()
+			self.segment = segments[-1] if segments else 1
+			self.outfile = open(self.segment_path(self.segment), 'ab')
+
+		if self.outfile.tell() and self.outfile.tell() + size > self.segment_size:
+			self.outfile.close()
+			self.segment += 1
+			self.outfile = open(self.segment_path(self.segment), 'ab')
+
+		return self.outfile
+
+	# Appends a page and adds it to the index. The index row is part of the caller's transaction, so a page whose
+	# transaction is rolled back is left in the segment but never referred to.
+	def append(self, cxn, txn_id, url, record):
+		with fbk_metrics.timed('archive_write'):
+			self._append(cxn, txn_id, url, record)
+
+	def _append(self, cxn, txn_id, url, record):
+		data = record.finish()
+		header = frame_header.pack(frame_magic, codec_ids[record.codec], len(data), record.raw_length, txn_id or 0)
+
+		outfile = self._outfile(len(header) + len(data))
+		offset = outfile.tell()
+		outfile.write(header)
+		outfile.write(data)
+		outfile.flush()
+
+		# SQL
+		sql_archive_insert = """INSERT OR REPLACE INTO archive
+		(`txn_id`, `segment`, `offset`, `length`, `raw_length`, `codec`, `url`, `datetime_archived`)
+		VALUES
+		(?, ?, ?, ?, ?, ?, ?, ?)
+		;"""
+		# END SQL
+		cxn.execute( sql_archive_insert, (txn_id, self.segment, offset, len(data), record.raw_length, record.codec,
+			strip_token(url), int(time.time())) )
+
+	def _map(self, segment):
+		if segment not in self.maps:
+			infile = open(self.segment_path(segment), 'rb')
+			self.maps[segment] = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+			infile.close()
+
+		return self.maps[segment]
+
+	# A page, straight out of the memory-mapped segment
+	def read(self, segment, offset):
+		with fbk_metrics.timed('archive_read'):
+			return self._read(segment, offset)
+
+	def _read(self, segment, offset):
+		m = self._map(segment)
+
+		(magic, codec_id, length, raw_length, txn_id) = frame_header.unpack_from(m, offset)
+		if magic != frame_magic:
+			raise ValueError("No archived page at offset %s of segment %s" % (offset, segment))
+
+		start = offset + frame_header.size
+		try:
+			data = decompress(codec_names[codec_id], memoryview(m)[start:start + length])
+		except decompress_errors:
+			data = None
+
+		if data is None or len(data) != raw_length:
+			raise ValueError("The archived page at offset %s of segment %s is damaged" % (offset, segment))
+
+		return data
+
+	# (txn_id, url, page) for the indexed pages, oldest first
+	def pages(self, cxn, since_txn=None):
+		cur = cxn.cursor()
+		cur.execute("SELECT `txn_id`, `url`, `segment`, `offset` FROM archive WHERE `txn_id` > ? ORDER BY `txn_id`",
+			(since_txn or 0,))
+
+		for (txn_id, url, segment, offset) in cur:
+			yield (txn_id, url, self.read(segment, offset))
+
+	def close(self):
+		if self.outfile is not None:
+			self.outfile.close()
+			self.outfile = None
+
+		for m in self.maps.values():
+			m.close()
+		self.maps = {}
+
+# The archive fbk_fetch_3 should write to, or None if it is switched off
+def archive_from_config( config_dir, obj_config ):
+	archive_config = obj_config.archive
+
+	if not archive_config.enabled:
+		return None
+
+	return Archive( config_dir, archive_config.codec, archive_config.get('segment_size', default_segment_size) )
@@ -0,0 +1,531 @@
+#! /usr/bin/env python3
+
+# fbk_bench_3.py -- Benchmarks for the hot paths of the fbk_*_3 scripts, run against synthetic data so that the
+# numbers are reproducible and don't need a Graph API token.
+#
+#		* stream: parsing Graph pages with json.loads() on the whole body vs. fbk_graph.StreamedPage. Each method runs
+#			in its own process, so that the peak RSS reported is its own.
+#
+#		* render: fbk_publish_3's renderers ("template" and the BeautifulSoup "soup"), writing a wall of synthetic
+#			posts to a temporary file. Again, one process per renderer and size.
+#
+#		* transform: fbk_publish_3.transform() against the strptime/strftime version it replaced, over synthetic rows.
+#
+#		* search: fbk_search_3's full-text index against a LIKE scan of posts.message for the same whole words, over
+#			a synthetic cache of --search-posts posts (1,000,000 by default) built in a temporary directory, or kept
+#			in --search-dir. Both find the same posts; a count that differs is flagged.
+#
+#		* pipeline: fetch -a, scrape-likes, replay and publish run end to end, each as its own process, against
+#			fbk_standin_3 (a local stand-in for the Graph API) serving --pipeline-posts posts. Reports posts/s for
+#			fetch, replay and publish, and likes/s for scrape-likes, with each stage's peak RSS.
+#
+#		* startup: how long "fbk_3.py COMMAND --help" takes to start, with python -X importtime's account of where the
+#			time goes. No config or database is needed, so only the imports are measured.
+
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from fbk_graph import fbk_graph
+
+def synthetic_post( i, likes ):
+	created = time.gmtime(1300000000 + i * 3600)
+
+	return {
+		'id'		: "100000000000001_%s" % (10000000 + i),
+		'message'	: "Synthetic post number %s. " % i * 8,
+		'type'		: 'status',
+		'created_time'	: time.strftime("%Y-%m-%dT%H:%M:%S+0000", created),
+		'privacy'	: { 'description' : 'Public', 'value' : 'EVERYONE' },
+		'likes'		: {
+			'data' : [ { 'id' : str(200000000 + (i * 7 + j) % 5000), 'name' : "Person %s" % j } for j in range(likes) ],
+			'paging' : { 'cursors' : { 'before' : 'MTAw', 'after' : 'MjAw' } },
+		},
+	}
+
+# A page is generated a post at a time, the way it arrives off the network, rather than held in memory up front
+def synthetic_page_chunks( page, posts, likes, chunk_size=16384 ):
+	pending = b'{"data":['
+
+	for i in range(posts):
+		if i:
+			pending += b','
+		pending += json.dumps(synthetic_post(page * posts + i, likes)).encode('utf-8')
+
+		while len(pending) >= chunk_size:
+			yield pending[:chunk_size]
+			pending = pending[chunk_size:]
+
+	pending += b'],"paging":{"next":"https://graph.facebook.com/me/posts?until=1300000000"}}'
+	while pending:
+		yield pending[:chunk_size]
+		pending = pending[chunk_size:]
+
+# Stands in for fbk_graph.ResponseBody
+class ChunkBody:
+	def __init__(self, chunks):
+		self.chunks = chunks
+		self.size = 0
+
+	def read(self, amt=65536):
+		chunk = next(self.chunks, b'')
+		self.size += len(chunk)
+		return chunk
+
+def parse_loads( chunks ):
+	response = json.loads(b''.join(chunks).decode('utf-8'))
+
+	n = 0
+	for post in response['data']:
+		n += len(post['id'])
+	return (n, response['paging'])
+
+def parse_stream( chunks ):
+	response = fbk_graph.StreamedPage(ChunkBody(chunks), 'data')
+
+	n = 0
+	for post in response['data']:
+		n += len(post['id'])
+	return (n, response['paging'])
+
+stream_methods = { 'loads' : parse_loads, 'stream' : parse_stream }
+
+def maxrss_kb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_stream_child( method, pages, posts, likes, rounds ):
+	parse = stream_methods[method]
+
+	# One page to warm up, and to measure Python-level peak allocation
+	tracemalloc.start()
+	parse(synthetic_page_chunks(0, posts, likes))
+	(current, traced_peak) = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	# Each page is generated before its parse is timed, so only parsing is measured; the fastest round is kept, as
+	# the others are the same work with more noise
+	elapsed = None
+	for r in range(rounds):
+		round_elapsed = 0.0
+		for page in range(pages):
+			chunks = list(synthetic_page_chunks(page, posts, likes))
+
+			start = time.perf_counter()
+			parse(iter(chunks))
+			round_elapsed += time.perf_counter() - start
+
+		if elapsed is None or round_elapsed < elapsed:
+			elapsed = round_elapsed
+
+	print(json.dumps({ 'method' : method, 'seconds' : elapsed, 'posts_per_sec' : pages * posts / elapsed,
+		'traced_peak_kb' : traced_peak // 1024, 'maxrss_kb' : maxrss_kb() }))
+
+def bench_stream( args ):
+	print("stream: %s pages of %s posts, %s inline likes each; parsing only, best of %s rounds" % (args.pages, args.posts, args.likes, args.rounds))
+
+	for method in ('loads', 'stream'):
+		out = subprocess.check_output([sys.executable, __file__, 'stream', '--child', method,
+			'--pages', str(args.pages), '--posts', str(args.posts), '--likes', str(args.likes), '--rounds', str(args.rounds)])
+		r = json.loads(out.decode('utf-8'))
+
+		print("  %-8s %10.0f posts/s   peak per page %8s KiB traced   process max RSS %8s KiB" %
+			(r['method'], r['posts_per_sec'], r['traced_peak_kb'], r['maxrss_kb']))
+
+# Rows as publish() selects them: fbk_id, message, created_timestamp, privacy_description, created_epoch
+def synthetic_rows( posts ):
+	for i in range(posts - 1, -1, -1):
+		post = synthetic_post(i, 0)
+		yield (post['id'], post['message'] + "\nSecond line & <more>", post['created_time'], 'Public', 1300000000 + i * 3600)
+
+render_methods = ('template', 'soup')
+
+def bench_render_child( method, posts ):
+	import fbk_publish_3
+	from fbk_config import fbk_config
+	from tzlocal import get_localzone
+
+	fbk_publish_3.obj_config = fbk_config.Config({ 'name' : 'Synthetic Person', 'tagline' : 'A tagline' })
+	fbk_publish_3.local_tz = get_localzone()
+
+	now = fbk_publish_3.datetime.now()
+	outfile = tempfile.TemporaryFile('w', encoding='utf-8')
+
+	start = time.perf_counter()
+	fbk_publish_3.renderers[method]( synthetic_rows(posts), outfile, True, now )
+	outfile.flush()
+	elapsed = time.perf_counter() - start
+
+	size = outfile.tell()
+	outfile.close()
+
+	print(json.dumps({ 'method' : method, 'seconds' : elapsed, 'posts_per_sec' : posts / elapsed,
+		'bytes' : size, 'maxrss_kb' : maxrss_kb() }))
+
+def bench_render( args ):
+	for posts in args.render_posts:
+		print("render: %s posts" % posts)
+
+		for method in render_methods:
+			out = subprocess.check_output([sys.executable, __file__, 'render', '--child', method,
+				'--render-posts', str(posts)])
+			r = json.loads(out.decode('utf-8'))
+
+			print("  %-8s %8.2f s %10.0f posts/s   output %8s KiB   process max RSS %8s KiB" %
+				(r['method'], r['seconds'], r['posts_per_sec'], r['bytes'] // 1024, r['maxrss_kb']))
+
+# transform() as it was before it cached its timestamp formatting, for comparison
+def transform_reference( o_post, local_tz ):
+	ts = datetime.strptime(o_post[2], "%Y-%m-%dT%H:%M:%S%z")
+
+	zts = ts.isoformat()
+
+	ts = ts.astimezone( local_tz )
+
+	dy = ts.strftime("%e").strip()
+	hr = ts.strftime("%l").strip()
+	ap = ts.strftime("%p").lower()
+
+	nixts = ts.strftime("%s")
+	strts = ts.strftime("%A, %B " + dy + ", %Y at " + hr + ":%M" + ap + " %Z")
+	sants = ts.strftime("%B " + dy + ", %Y at " + hr + ":%M " + ap )
+
+	dt = ts.strftime("%Y%m%d")
+
+	return (zts, strts, sants, int(nixts), dt)
+
+def bench_transform( args ):
+	import fbk_publish_3
+	from tzlocal import get_localzone
+
+	fbk_publish_3.local_tz = get_localzone()
+	rows = list(synthetic_rows(args.transform_posts))
+
+	print("transform: %s posts" % args.transform_posts)
+
+	start = time.perf_counter()
+	expected = [ transform_reference(row, fbk_publish_3.local_tz) for row in rows ]
+	reference = time.perf_counter() - start
+
+	start = time.perf_counter()
+	transformed = [ fbk_publish_3.transform(row) for row in rows ]
+	cached = time.perf_counter() - start
+
+	mismatches = sum( 1 for (p, e) in zip(transformed, expected)
+		if (p['created_timestamp'], p['formatted_timestamp'], p['sanitized_timestamp'], p['unix_timestamp'], p['date']) != e )
+
+	print("  %-10s %8.3f s %10.0f posts/s" % ('strptime', reference, len(rows) / reference))
+	print("  %-10s %8.3f s %10.0f posts/s   (%s mismatches)" % ('cached', cached, len(rows) / cached, mismatches))
+
+# Made-up words, ranked: word n turns up about 1/(n+1) as often as the first (Zipf), as in real text
+def synthetic_vocabulary( size, rng ):
+	syllables = [ c + v for c in 'bdfghklmnprstvz' for v in ('a', 'e', 'i', 'o', 'u', 'ai', 'ou') ]
+
+	words = []
+	seen = set()
+	while len(words) < size:
+		word = "".join(rng.choice(syllables) for n in range(rng.randint(1, 4)))
+		if word not in seen:
+			seen.add(word)
+			words.append(word)
+
+	return words
+
+search_privacy = ('Public', 'Your friends', 'Only Me')
+
+# Posts as fbk_fetch_3 stores them, with messages of 5 to 40 words
+def synthetic_search_posts( posts, words, rng ):
+	weights = list(itertools.accumulate( 1.0 / (n + 1) for n in range(len(words)) ))
+
+	for i in range(posts):
+		epoch = 1200000000 + i * 300
+		created = time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime(epoch))
+		message = " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(5, 40)))
+
+		yield ("100000000000001_%s" % (10000000 + i), message, rng.choice(search_privacy), created, epoch, 'status')
+
+def search_cache( args ):
+	from fbk_db import fbk_db
+
+	rng = random.Random(1)
+	words = synthetic_vocabulary(20000, rng)
+
+	cxn = fbk_db.connect(args.search_dir)
+	posts = cxn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+
+	if posts != args.search_posts:
+		print("  building a cache of %s posts in %s" % (args.search_posts, args.search_dir))
+
+		# SQL
+		sql_post_insert = """INSERT INTO posts
+		(`fbk_id`, `message`, `privacy_description`, `created_timestamp`, `created_epoch`, `type`)
+		VALUES (?, ?, ?, ?, ?, ?)"""
+		# END SQL
+
+		start = time.perf_counter()
+		cxn.execute("DELETE FROM posts")
+		cxn.executemany( sql_post_insert, synthetic_search_posts(args.search_posts, words, rng) )
+		cxn.commit()
+		print("  %-24s %8.1f s (posts and their index, through the triggers)" % ('build', time.perf_counter() - start))
+
+	return (cxn, words)
+
+def bench_search( args ):
+	import fbk_search_3
+	from fbk_db import fbk_db
+
+	print("search: %s posts, best of %s runs" % (args.search_posts, args.search_runs))
+
+	tmpdir = None
+	if not args.search_dir:
+		tmpdir = tempfile.TemporaryDirectory()
+		args.search_dir = tmpdir.name
+
+	(cxn, words) = search_cache(args)
+
+	# (label, words as a phrase, filters)
+	middle = 1200000000 + args.search_posts * 150
+	queries = [
+		('common word', [words[5]], {}),
+		('uncommon word', [words[500]], {}),
+		('rare word', [words[15000]], {}),
+		('phrase', [words[5], words[50]], {}),
+		('word, a year, Public', [words[500]], { 'since' : middle, 'until' : middle + 365 * 86400, 'privacy' : ['Public'] }),
+	]
+
+	def best( fn ):
+		elapsed = []
+		for run in range(args.search_runs):
+			start = time.perf_counter()
+			result = fn()
+			elapsed.append(time.perf_counter() - start)
+		return (min(elapsed) * 1000, result)
+
+	print("  %-24s %20s %20s %20s %20s" % ('', 'fts top 20 (rank)', 'fts count', 'LIKE top 20 (newest)', 'LIKE count'))
+
+	mismatches = 0
+
+	for (label, phrase, filters) in queries:
+		query = fbk_search_3.fts_phrase(" ".join(phrase))
+
+		(fts_ms, results) = best(lambda: fbk_search_3.search(cxn, query, limit=20, **filters))
+		(fts_count_ms, fts_count) = best(lambda: fbk_search_3.search_count(cxn, query, **filters))
+
+		# The same filters, with a LIKE on the message in place of MATCH. The synthetic messages are lowercase words
+		# separated by single spaces, so padding the message and the phrase with spaces matches whole words only, as
+		# the index does; a bare %word% would also match inside longer words.
+		(where, params) = fbk_search_3.search_filter(query, **filters)
+		where = where.replace("posts_fts MATCH ?", "(' ' || p.`message` || ' ') LIKE ?")
+		params[0] = "%% %s %%" % " ".join(phrase)
+
+		sql_like = "SELECT p.`fbk_id` FROM posts p WHERE %s ORDER BY p.`created_epoch` DESC LIMIT 20" % where
+		(like_ms, like_results) = best(lambda: cxn.execute(sql_like, params).fetchall())
+
+		sql_like_count = "SELECT COUNT(*) FROM posts p WHERE %s" % where
+		(like_count_ms, like_count) = best(lambda: cxn.execute(sql_like_count, params).fetchone()[0])
+
+		flag = ''
+		if fts_count != like_count:
+			flag = '  (counts differ)'
+			mismatches += 1
+
+		print("  %-24s %9.1f ms %7s %9.1f ms %7s %9.1f ms %7s %9.1f ms %7s%s" %
+			(label, fts_ms, len(results), fts_count_ms, fts_count, like_ms, len(like_results), like_count_ms, like_count, flag))
+
+	if mismatches:
+		print("  %s of the queries found different posts through the index and through LIKE; their timings aren't for the same work" % mismatches)
+
+	fbk_db.close(args.search_dir)
+	if tmpdir:
+		tmpdir.cleanup()
+
+def script_path( name ):
+	return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+# Starts the stand-in server on a free port; it prints its address once it is listening
+def start_standin( posts, standin_args ):
+	proc = subprocess.Popen([sys.executable, script_path('fbk_standin_3.py'), '--port', '0', '--posts', str(posts)] + standin_args,
+		stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+
+	return (proc, proc.stdout.readline().strip())
+
+# Runs "fbk_3.py COMMAND ..." in cwd; returns (seconds, peak RSS in KiB)
+def run_stage( cwd, command ):
+	start = time.perf_counter()
+	proc = subprocess.Popen([sys.executable, script_path('fbk_3.py')] + command, cwd=cwd, stdout=subprocess.DEVNULL)
+	(pid, status, rusage) = os.wait4(proc.pid, 0)
+	elapsed = time.perf_counter() - start
+
+	proc.returncode = os.waitstatus_to_exitcode(status)
+	if proc.returncode:
+		raise subprocess.CalledProcessError(proc.returncode, command)
+
+	return (elapsed, rusage.ru_maxrss)
+
+def bench_pipeline( args ):
+	import sqlite3
+
+	for posts in args.pipeline_posts:
+		print("pipeline: %s posts, %s to a page, against fbk_standin_3" % (posts, args.pipeline_page_size))
+
+		(standin, base_url) = start_standin(posts, ['--page-size', str(args.pipeline_page_size)] + args.standin_args)
+
+		tmpdir = tempfile.TemporaryDirectory()
+		config_dir = os.path.join(tmpdir.name, '.fbk')
+		os.mkdir(config_dir)
+
+		# No rate limit to speak of; the point is to measure the scripts
+		config = { 'name' : 'Pipeline Benchmark', 'tagline' : '', 'graph' : { 'base_url' : base_url, 'access_token' : 'bench',
+			'client_id' : 1, 'update_freq' : 0, 'rate' : 100000, 'burst' : 1000 } }
+		with open(os.path.join(config_dir, 'config.json'), 'w') as configfile:
+			json.dump(config, configfile)
+
+		def count( sql ):
+			cxn = sqlite3.connect(os.path.join(config_dir, 'fbk_cache.db'))
+			n = cxn.execute(sql).fetchone()[0]
+			cxn.close()
+			return n
+
+		try:
+			stages = [
+				('fetch -a', ['fetch', '-a'], 'posts', "SELECT COUNT(*) FROM posts"),
+				('scrape-likes -j %s' % args.pipeline_workers, ['scrape-likes', '-j', str(args.pipeline_workers)], 'likes', "SELECT COUNT(*) FROM posts_likes"),
+				('replay', ['replay'], 'posts', "SELECT COUNT(*) FROM posts"),
+				('publish', ['publish'], 'posts', "SELECT COUNT(*) FROM posts WHERE `privacy_description`='Public' AND `type`='status'"),
+				('publish -i', ['publish', '-i'], 'posts', "SELECT COUNT(*) FROM posts WHERE `privacy_description`='Public' AND `type`='status'"),
+				('publish -i (unchanged)', ['publish', '-i'], 'posts', "SELECT COUNT(*) FROM posts WHERE `privacy_description`='Public' AND `type`='status'"),
+			]
+
+			for (label, command, unit, sql) in stages:
+				(elapsed, maxrss) = run_stage(tmpdir.name, command)
+				n = count(sql)
+
+				print("  %-24s %8.2f s %10.0f %s/s   (%s %s)   max RSS %8s KiB" % (label, elapsed, n / elapsed, unit, n, unit, maxrss))
+		finally:
+			standin.terminate()
+			standin.wait()
+			tmpdir.cleanup()
+
+# Each line of -X importtime is "import time: self | cumulative | name", nested imports indented under their name
+def parse_importtime( stderr ):
+	imports = []
+
+	for line in stderr.splitlines():
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+
+		(self_us, cumulative_us, name) = line[len('import time:'):].split('|')
+		if not name.startswith('  '):
+			imports.append( (int(cumulative_us), name.strip()) )
+
+	return imports
+
+def bench_startup( args ):
+	import fbk_3
+
+	fbk = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fbk_3.py')
+
+	print("startup: %s runs of each command" % args.startup_runs)
+
+	for command in fbk_3.commands:
+		elapsed = []
+		for run in range(args.startup_runs):
+			start = time.perf_counter()
+			subprocess.check_output([sys.executable, fbk, command, '--help'])
+			elapsed.append(time.perf_counter() - start)
+
+		out = subprocess.run([sys.executable, '-X', 'importtime', fbk, command, '--help'],
+			stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+		imports = sorted(parse_importtime(out.stderr.decode('utf-8')), reverse=True)
+
+		print("  %-14s %8.1f ms (best of %s)   imports %8.1f ms" %
+			(command, min(elapsed) * 1000, len(elapsed), sum(us for (us, name) in imports) / 1000.0))
+
+		for (us, name) in imports[:args.startup_top]:
+			print("      %8.1f ms  %s" % (us / 1000.0, name))
+
+benchmarks = {
+	'stream' : bench_stream,
+	'render' : bench_render,
+	'transform' : bench_transform,
+	'search' : bench_search,
+	'pipeline' : bench_pipeline,
+	'startup' : bench_startup,
+}
+
+# Main()
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Benchmark fbk_utils against synthetic data')
+
+	parser.add_argument('benchmark', choices=sorted(benchmarks.keys()), nargs='+',
+			help='The benchmark(s) to run')
+
+	parser.add_argument('--pages', type=int, default=50,
+			help='stream: the number of pages to parse (default: 50)')
+
+	parser.add_argument('--posts', type=int, default=200,
+			help='stream: posts per page (default: 200)')
+
+	parser.add_argument('--likes', type=int, default=25,
+			help='stream: inline likes per post (default: 25)')
+
+	parser.add_argument('--rounds', type=int, default=5,
+			help='stream: times to parse the pages, keeping the fastest (default: 5)')
+
+	parser.add_argument('--render-posts', type=int, nargs='+', default=[10000, 100000],
+			help='render: wall sizes, in posts (default: 10000 100000)')
+
+	parser.add_argument('--transform-posts', type=int, default=100000,
+			help='transform: the number of posts (default: 100000)')
+
+	parser.add_argument('--search-posts', type=int, default=1000000,
+			help='search: posts in the synthetic cache (default: 1000000)')
+
+	parser.add_argument('--search-dir', metavar='DIR',
+			help='search: build (or reuse) the synthetic cache in DIR, rather than in a temporary directory')
+
+	parser.add_argument('--search-runs', type=int, default=5,
+			help='search: runs of each query, of which the best is reported (default: 5)')
+
+	parser.add_argument('--pipeline-posts', type=int, nargs='+', default=[1000, 100000],
+			help='pipeline: timeline sizes, in posts (default: 1000 100000; add 1000000 for the full run)')
+
+	parser.add_argument('--pipeline-page-size', type=int, default=100,
+			help='pipeline: posts to a page of /me/posts (default: 100)')
+
+	parser.add_argument('--pipeline-workers', type=int, default=8,
+			help='pipeline: scrape-likes -j (default: 8)')
+
+	parser.add_argument('--standin-args', nargs=argparse.REMAINDER, default=[],
+			help='pipeline: the rest of the arguments are passed to fbk_standin_3 (e.g. --latency 20 --error-rate 0.01)')
+
+	parser.add_argument('--startup-runs', type=int, default=10,
+			help='startup: runs of each command, of which the best is reported (default: 10)')
+
+	parser.add_argument('--startup-top', type=int, default=5,
+			help='startup: how many of the slowest top-level imports to list (default: 5)')
+
+	parser.add_argument('--child', choices=sorted(set(stream_methods.keys()) | set(render_methods)),
+			help=argparse.SUPPRESS)
+
+	args = parser.parse_args()
+
+	if args.child:
+		if args.benchmark[0] == 'render':
+			bench_render_child(args.child, args.render_posts[0])
+		else:
+			bench_stream_child(args.child, args.pages, args.posts, args.likes, args.rounds)
+		sys.exit(0)
+
+	for benchmark in args.benchmark:
+		benchmarks[benchmark](args)
+
+	sys.exit(0)
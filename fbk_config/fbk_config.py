@@ -1,57 +1,484 @@
 #!/usr/bin/env python3
+import bisect
+import calendar
 import os 
 import json
-import urllib
-import urllib.request
-import sqlite3
+import re
 import sys
+from datetime import datetime
 
-obj_config = None
-default_obj_config = obj_config = {
-	"timefilter"	: {},
-	"albums" 		: [],
-	"tagline"		: "",
-	"graph"			: {},
-}
+# fbk_config -- config.json, read into a Config: each section is a class with a fixed set of typed settings and
+# their defaults, so a typo or a value of the wrong type is reported when the config is loaded, not as a KeyError
+# half way through a run. Settings are layered, each layer overriding the one before:
+#
+#	the defaults below
+#	config.json (or the file given with -f)
+#	the account's entry in "accounts", when one is selected (see below)
+#	the environment: FBK_<SETTING> for the top-level settings, FBK_<SECTION>_<SETTING> for the rest, e.g.
+#		FBK_GRAPH_ACCESS_TOKEN or FBK_ARCHIVE_ENABLED=0
+#	the command line: the scripts' -A and -C, and fbk_3.py's --set SECTION.SETTING=VALUE
+
+# Types a setting may have, and its default. None means unset; code with a default of its own asks for it with get().
+number = (int, float)
+
+class Section:
+	__slots__ = ()
+	schema = {}
+
+	def __init__(self, values=None, where=''):
+		if values is None:
+			values = {}
+		if not isinstance(values, dict):
+			config_error("%s should be an object" % where.rstrip('.'))
+
+		for (name, (types, default)) in self.schema.items():
+			value = values.get(name)
+
+			if value is None:
+				value = list(default) if isinstance(default, list) else default
+			elif not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+				config_error("%s%s should be %s, not %s" % (where, name, type_names(types), json.dumps(value)))
+
+			setattr(self, name, value)
+
+		for name in values:
+			if name not in self.schema and name not in self.__slots__:
+				print("Ignoring the unknown setting %s%s in the config" % (where, name))
+
+	# A setting, or default if it isn't set
+	def get(self, name, default=None):
+		value = getattr(self, name)
+		if value is None:
+			return default
+
+		return value
+
+class GraphConfig(Section):
+	schema = {
+		'access_token'		: (str, None),
+		'client_id'		: ((int, str), None),
+		'update_freq'		: (number, None),
+		'node'			: (str, 'me'),			# whose posts: "me", or a page's id
+		'basedirname'		: (str, '_fbk'),
+		'merge_compat_id'	: ((int, str), None),
+
+		# fbk_graph's client (defaults in fbk_graph)
+		'base_url'		: (str, None),
+		'timeout'		: (number, None),
+		'pool_size'		: (int, None),
+		'rate'			: (number, None),
+		'burst'			: (number, None),
+		'retries'		: (int, None),
+		'backoff'		: (number, None),
+		'backoff_max'		: (number, None),
+		'usage_threshold'	: (number, None),
+
+		# fbk_scrape_likes_3 (defaults there)
+		'likes_hot_days'	: (number, None),
+		'likes_cold_interval'	: (number, None),
+	}
+	__slots__ = tuple(schema)
+
+class ArchiveConfig(Section):
+	schema = {
+		'enabled'		: (bool, True),
+		'codec'			: (str, None),
+		'segment_size'		: (number, None),
+	}
+	__slots__ = tuple(schema)
+
+class DaemonConfig(Section):
+	schema = {
+		'fetch_freq'		: (number, None),
+		'likes_freq'		: (number, None),
+		'publish_freq'		: (number, None),
+	}
+	__slots__ = tuple(schema)
+
+class Config(Section):
+	schema = {
+		'name'			: (str, ''),
+		'tagline'		: (str, ''),
+		'albums'		: (list, []),
+		'accounts'		: (list, []),
+	}
+	sections = {
+		'graph'			: GraphConfig,
+		'archive'		: ArchiveConfig,
+		'daemon'		: DaemonConfig,
+	}
+	__slots__ = tuple(schema) + tuple(sections) + ('timefilter', 'account', 'path')
+
+	def __init__(self, values=None, path=None):
+		values = values or {}
+
+		for (name, section) in self.sections.items():
+			setattr(self, name, section(values.get(name), name + '.'))
+
+		self.timefilter = TimeFilter(values.get('timefilter'))
+		self.account = values.get('account')
+		self.path = path
+
+		Section.__init__(self, values)
+
+def type_names( types ):
+	if not isinstance(types, tuple):
+		types = (types,)
+
+	names = { bool : 'true or false', int : 'a whole number', float : 'a number', str : 'a string', list : 'a list' }
+	return " or ".join( names[t] for t in types if not (t is int and float in types) )
+
+def config_error( msg ):
+	print("The config is invalid: %s" % msg)
+	sys.exit(1)
+
+# "timefilter" holds ranges of time whose posts are left out: neither stored by fbk_fetch_3 (or fbk_replay_3) nor
+# published. Each is [start, end), as YYYY-MM-DD dates (UTC) or UNIX timestamps, in named groups, e.g.
+#
+#	"timefilter" : { "travels" : [ ["2011-06-01", "2011-07-01"], [1325376000, 1325462400] ] }
+#
+# The ranges are merged and sorted once, so that checking a post is a binary search.
+class TimeFilter:
+	__slots__ = ('starts', 'ends')
+
+	def __init__(self, values=None):
+		if values is None:
+			groups = []
+		elif isinstance(values, dict):
+			groups = list(values.values())
+		else:
+			groups = [values]
+
+		ranges = []
+		for group in groups:
+			if not isinstance(group, list):
+				config_error("timefilter should hold lists of [start, end] ranges")
+
+			for r in group:
+				if not isinstance(r, list) or len(r) != 2:
+					config_error("timefilter ranges should be [start, end], not %s" % json.dumps(r))
+
+				(start, end) = (parse_when(r[0]), parse_when(r[1]))
+				if start < end:
+					ranges.append( [start, end] )
+
+		ranges.sort()
+		merged = []
+		for (start, end) in ranges:
+			if merged and start <= merged[-1][1]:
+				merged[-1][1] = max(merged[-1][1], end)
+			else:
+				merged.append( [start, end] )
+
+		self.starts = [ r[0] for r in merged ]
+		self.ends = [ r[1] for r in merged ]
+
+	def __contains__(self, epoch):
+		if epoch is None or not self.starts:
+			return False
+
+		i = bisect.bisect_right(self.starts, epoch) - 1
+		return i >= 0 and epoch < self.ends[i]
+
+	def __bool__(self):
+		return bool(self.starts)
+
+	def __len__(self):
+		return len(self.starts)
+
+def parse_when( when ):
+	if isinstance(when, bool) or not isinstance(when, (int, float, str)):
+		config_error("timefilter times should be YYYY-MM-DD dates or UNIX timestamps, not %s" % json.dumps(when))
+
+	if isinstance(when, str):
+		try:
+			return calendar.timegm(datetime.strptime(when, "%Y-%m-%d").timetuple())
+		except ValueError:
+			config_error("timefilter times should be YYYY-MM-DD dates or UNIX timestamps, not %s" % json.dumps(when))
+
+	return when
+
+# config.json may list several accounts (people, or pages) under "accounts", each an object with an "account" name
+# and whatever it sets differently from the rest of the file; its "graph" settings are merged into the graph
+# section, e.g.
+#
+#	"accounts" : [
+#		{ "account" : "me", "graph" : { "access_token" : "..." } },
+#		{ "account" : "band", "name" : "The Band", "graph" : { "access_token" : "...", "node" : "1234567890", "rate" : 5 } }
+#	]
+#
+# Each account's cache, archive and checkpoints live in accounts/<account>/ under the config directory. Setting
+# account (fbk_3.py --account NAME does) points find_config_dir() and load_config() at one of them.
+account = None
+accounts_dirname = 'accounts'
+account_name_re = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+# fbk_3.py --set: { section : { setting : value } }, or { setting : value } for the top-level settings
+settings = {}
 
 def validate_access_token( obj_config ):
-	#obj_config['graph']['access_token'] = "blarg"
+	#obj_config.graph.access_token = "blarg"
 
-	if not obj_config['graph']['access_token']:
+	if not obj_config.graph.access_token:
 		print("No access_token was specified. Unable to process requests.")
 		sys.exit(3)
 
 
 
-	url_token_req = "https://www.facebook.com/dialog/oauth?client_id=%s&redirect_uri=https://www.facebook.com/connect/login_success.html&response_type=token" % (obj_config['graph']['client_id'])
+	url_token_req = "https://www.facebook.com/dialog/oauth?client_id=%s&redirect_uri=https://www.facebook.com/connect/login_success.html&response_type=token" % (obj_config.graph.client_id)
 	#res = urllib.request.urlopen(url_token_req)
 	#print(res.read())
 
 
 	return obj_config
 
-def parse_config( str_configpath, validate_token=False ):
+# Lays values over base, a section at a time. Settings that are None are left alone.
+def merge_values( base, values ):
+	merged = dict(base)
+
+	for (k, v) in values.items():
+		if v is None:
+			continue
+
+		if isinstance(v, dict) and isinstance(merged.get(k), dict) and k in Config.sections:
+			merged[k] = merge_values(merged[k], v)
+		else:
+			merged[k] = v
+
+	return merged
+
+# A setting given as text (in the environment, or with --set), as the type its schema wants
+def coerce( types, text, where ):
+	if not isinstance(types, tuple):
+		types = (types,)
+
+	try:
+		if str in types:
+			return text
+		if bool in types:
+			if text.lower() not in ('1', '0', 'true', 'false', 'yes', 'no', 'on', 'off'):
+				raise ValueError(text)
+			return text.lower() in ('1', 'true', 'yes', 'on')
+		if int in types and re.match(r'^-?\d+$', text):
+			return int(text)
+		if float in types:
+			return float(text)
+		if list in types:
+			return json.loads(text)
+		return int(text)
+	except ValueError:
+		config_error("%s should be %s, not %s" % (where, type_names(types), text))
+
+# The setting a name (graph.rate, or name) refers to: (section or None, setting, its types)
+def find_setting( str_setting ):
+	(section, sep, name) = str_setting.rpartition('.')
+
+	if not section and name in Config.schema:
+		return (None, name, Config.schema[name][0])
+
+	if section in Config.sections and name in Config.sections[section].schema:
+		return (section, name, Config.sections[section].schema[name][0])
+
+	return None
+
+def set_values( values, section, name, value ):
+	if section is None:
+		values[name] = value
+	else:
+		values.setdefault(section, {})[name] = value
+
+def env_values( environ ):
+	values = {}
+
+	for name in Config.schema:
+		if 'FBK_' + name.upper() in environ:
+			set_values( values, None, name, coerce(Config.schema[name][0], environ['FBK_' + name.upper()], 'FBK_' + name.upper()) )
+
+	for (section, section_class) in Config.sections.items():
+		for (name, (types, default)) in section_class.schema.items():
+			var = 'FBK_%s_%s' % (section.upper(), name.upper())
+			if var in environ:
+				set_values( values, section, name, coerce(types, environ[var], var) )
+
+	return values
+
+# For fbk_3.py --set SECTION.SETTING=VALUE
+def set_option( str_option ):
+	(str_setting, sep, text) = str_option.partition('=')
+
+	setting = find_setting(str_setting.strip())
+	if not sep or setting is None:
+		config_error("--set takes SECTION.SETTING=VALUE, for a known setting, not %s" % str_option)
+
+	(section, name, types) = setting
+	set_values( settings, section, name, coerce(types, text, str_setting) )
+
+def parse_config( str_configpath, validate_token=False, overrides=None ):
 	if( not os.path.isfile(str_configpath)):
 		print("The specified config filter file, %s, does not exist." % (str_configpath))
 		sys.exit(1)
 
 	configfile = open(str_configpath, 'r')
-	obj_config = json.load(configfile)
+	values = json.load(configfile)
 	configfile.close()
 
-	# Re-generate the keys for un-specified values in the JSON config file
-	for conf_key in default_obj_config:
-		if conf_key not in obj_config:
-			obj_config[conf_key] = default_obj_config[conf_key]
+	if not isinstance(values, dict):
+		config_error("%s should hold a JSON object" % str_configpath)
+
+	check_accounts( values.get('accounts') or [] )
+	if( account ):
+		values = merge_values( values, account_values(values['accounts'], account) )
+		values['account'] = account
 
-	temp_timefilter = []
-	for k in obj_config['timefilter']:
-		temp_timefilter.extend(obj_config['timefilter'][k])
+	values = merge_values( values, env_values(os.environ) )
+	values = merge_values( values, settings )
+	values = merge_values( values, overrides or {} )
 
-	obj_config['timefilter'] = temp_timefilter
+	obj_config = Config( values, str_configpath )
 
 	if( validate_token ):
 		obj_config = validate_access_token( obj_config )
 
 	return obj_config
 
+
+def check_accounts( accounts ):
+	names = set()
+
+	if not isinstance(accounts, list):
+		config_error("accounts should be a list")
+
+	for entry in accounts:
+		name = entry.get('account') if isinstance(entry, dict) else None
+
+		if not name or not isinstance(name, str) or not account_name_re.match(name):
+			print("Each of the accounts in the config file needs an \"account\" name (letters, digits, _, . and -).")
+			sys.exit(1)
+
+		if name in names:
+			print("The account %s is listed more than once in the config file." % (name))
+			sys.exit(1)
+		names.add(name)
+
+# What the named account sets differently
+def account_values( accounts, name ):
+	entries = [ entry for entry in accounts if entry['account'] == name ]
+	if not entries:
+		print("There is no account named %s in the config file." % (name))
+		sys.exit(1)
+
+	return { k : v for (k, v) in entries[0].items() if k != 'account' }
+
+def account_names( obj_config ):
+	return [ entry['account'] for entry in obj_config.accounts ]
+
+# For the commands that work on one account at a time: with accounts configured, the root directory's cache
+# belongs to none of them, so one has to be chosen
+def require_account( obj_config, command ):
+	if( account is None and obj_config.accounts ):
+		print("config.json lists accounts; choose one with fbk --account NAME %s" % (command))
+		sys.exit(1)
+
+# The directory holding config.json: the .fbk directory in the working directory if there is one, otherwise ~/.fbk
+def find_root_dir( ):
+	root_dir = ".fbk"
+
+	if not os.path.exists( root_dir ):
+		root_dir = os.path.join( os.path.expanduser('~'), '.fbk' )
+
+	return root_dir
+
+# Where the cache and the rest of a run's data live: the root directory, or the selected account's under it
+def find_config_dir( ):
+	config_dir = find_root_dir()
+
+	if account:
+		config_dir = os.path.join( config_dir, accounts_dirname, account )
+
+	return config_dir
+
+# The config file given on the command line, or else config.json in the root directory. overrides are the command
+# line's settings, as { section : { setting : value } }; those that are None weren't given.
+def load_config( config_dir, config_file=None, validate_token=False, overrides=None ):
+	root_dir = find_root_dir() if account else config_dir
+
+	file_configfile = None
+	if(config_file):
+		file_configfile = os.path.abspath(config_file)
+	elif( os.path.exists(os.path.join(root_dir, 'config.json')) ):
+		file_configfile = os.path.join(root_dir, 'config.json')
+
+	if not file_configfile:
+		print("No config file was given, and there is no config.json in %s." % (root_dir))
+		sys.exit(1)
+
+	obj_config = parse_config( file_configfile, validate_token, overrides )
+
+	# Only made once the account is known to be in the config
+	if account:
+		os.makedirs( config_dir, exist_ok=True )
+
+	return obj_config
+
+# Prefixes each line a process prints with the account it is working on
+class AccountOutput:
+	def __init__(self, stream, name):
+		self.stream = stream
+		self.prefix = "[%s] " % name
+		self.line_start = True
+
+	def write(self, text):
+		for line in text.splitlines(True):
+			if self.line_start:
+				self.stream.write(self.prefix)
+			self.stream.write(line)
+			self.line_start = line.endswith('\n')
+
+	def flush(self):
+		self.stream.flush()
+
+# Runs in a process of its own, with its own config, Graph client (and so its own rate budget) and cache. Returns
+# the exit code, and the account's fbk_metrics timers and counters for the parent's report. The pool may run another
+# account in the same process afterwards, so the metrics start from zero and stdout is put back.
+def run_account( name, script_run, run_args ):
+	global account
+
+	from fbk_metrics import fbk_metrics
+
+	fbk_metrics.reset()
+	account = name
+	stdout = sys.stdout
+	sys.stdout = AccountOutput(stdout, name)
+
+	try:
+		code = script_run(run_args)
+	except SystemExit as e:
+		code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+	finally:
+		sys.stdout.flush()
+		sys.stdout = stdout
+		account = None
+
+	return (code, fbk_metrics.snapshot())
+
+# Runs script_run (a script's run()) for each of the accounts at once. Returns the highest exit code.
+def run_accounts( names, script_run, run_args ):
+	from concurrent.futures import ProcessPoolExecutor
+	from fbk_metrics import fbk_metrics
+
+	codes = {}
+	with ProcessPoolExecutor(max_workers=len(names)) as executor:
+		futures = [ (name, executor.submit(run_account, name, script_run, run_args)) for name in names ]
+
+		for (name, future) in futures:
+			(codes[name], snapshot) = future.result()
+			fbk_metrics.merge(snapshot)
+
+	failed = [ name for name in names if codes[name] ]
+	if failed:
+		print("Finished %s accounts; %s exited with an error: %s" % (len(names), len(failed),
+			", ".join("%s (%s)" % (name, codes[name]) for name in failed)))
+	else:
+		print("Finished %s accounts" % len(names))
+
+	return max(codes.values())
@@ -0,0 +1,213 @@
+#! /usr/bin/env python3
+
+# fbk_daemon_3.py -- Runs fetch, likes scraping and publishing in one long-lived process, each on its own interval,
+# instead of starting the scripts from cron. The sqlite connection and the Graph client's connection pool stay open
+# between runs, and the wall is only published again when a fetch has brought in new or edited posts.
+#
+#	The intervals come from the "daemon" section of config.json, in seconds:
+#		"fetch_freq"	how often to fetch new posts (default: the graph section's update_freq, or 4 hours)
+#		"likes_freq"	how often to scrape likes (default: fetch_freq)
+#		"publish_freq"	the least time between two publishes (default: 60)
+#
+#	SIGTERM (or SIGINT) stops it once the pages in flight have been written.
+
+import argparse
+import signal
+import sys
+import sqlite3
+import threading
+import time
+import traceback
+from datetime import datetime
+from fbk_config import fbk_config
+from fbk_graph import fbk_graph
+from fbk_db import fbk_db
+from fbk_metrics import fbk_metrics
+import fbk_fetch_3
+import fbk_scrape_likes_3
+import fbk_publish_3
+
+default_fetch_freq = 14400
+default_publish_freq = 60
+
+# Set by a signal; wakes the main loop from its sleep
+stop = threading.Event()
+
+def debug_print(msg, verbose_threshold):
+	if args.verbosity:
+		if args.verbosity >= verbose_threshold:
+			print(msg)
+
+def log( msg ):
+	print("[%s] %s" % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), msg))
+	sys.stdout.flush()
+
+def request_stop( signum, frame ):
+	log("Received signal %s; stopping after the work in hand" % signum)
+
+	fbk_fetch_3.stopping = True
+	fbk_scrape_likes_3.stopping = True
+	stop.set()
+
+# Each script's own defaults, as though it had been run with no arguments
+def script_args( module, argv ):
+	parser = argparse.ArgumentParser()
+	module.add_arguments(parser)
+
+	return parser.parse_args(argv)
+
+# Runs one task; a failure (including the sys.exit() a script makes on one) is logged, and the daemon carries on.
+# Only KeyboardInterrupt, or a signal (see request_stop), ends the daemon. Returns (whether it finished, its result).
+def run_task( name, task ):
+	log("Starting %s" % name)
+
+	try:
+		return (True, task())
+	except SystemExit as e:
+		log("%s stopped with exit code %s; it will be tried again at its next interval" % (name, e.code))
+	except fbk_graph.fetch_errors as e:
+		log("%s failed: %s; it will be tried again at its next interval" % (name, e))
+	except Exception as e:
+		log("%s failed: %s; it will be tried again at its next interval\n%s" % (name, e, traceback.format_exc().rstrip()))
+
+	# Whatever the task left half written is dropped, so that the next task's commit doesn't pick it up
+	try:
+		fbk_db.connect(config_dir).rollback()
+	except sqlite3.Error as e:
+		log("Could not roll back after %s: %s" % (name, e))
+
+	return (False, None)
+
+def daemon( ):
+	daemon_config = obj_config.daemon
+
+	intervals = {}
+	intervals['fetch'] = daemon_config.get('fetch_freq') or obj_config.graph.update_freq or default_fetch_freq
+	intervals['likes'] = daemon_config.get('likes_freq') or intervals['fetch']
+	intervals['publish'] = daemon_config.get('publish_freq', default_publish_freq)
+
+	log("fetch every %ss, likes every %ss, publish at most every %ss" % (intervals['fetch'], intervals['likes'], intervals['publish']))
+
+	due = { 'fetch' : 0, 'likes' : 0, 'publish' : 0 }
+
+	# Publish once at startup, in case posts came in while the daemon wasn't running
+	publish_pending = not args.no_publish
+
+	while not stop.is_set():
+		now = time.time()
+
+		if now >= due['fetch']:
+			(finished, counts) = run_task('fetch', fbk_fetch_3.fbk_fetch_new)
+			due['fetch'] = time.time() + intervals['fetch']
+
+			if counts and (counts[0] or counts[1]):
+				log("Fetched %s new and %s edited posts" % counts)
+				publish_pending = not args.no_publish
+
+		if not args.no_likes and not stop.is_set() and now >= due['likes']:
+			run_task('likes', fbk_scrape_likes_3.fbk_cache)
+			due['likes'] = time.time() + intervals['likes']
+
+		if publish_pending and not stop.is_set() and now >= due['publish']:
+			(finished, result) = run_task('publish', lambda: fbk_publish_3.publish(None, not args.posts_only, 'template', True, args.shards, args.workers, args.search_index))
+			due['publish'] = time.time() + intervals['publish']
+
+			# A publish that failed is tried again once publish_freq has passed
+			publish_pending = not finished
+
+		# Sleep until the next task is due
+		upcoming = [due['fetch']]
+		if not args.no_likes:
+			upcoming.append(due['likes'])
+		if publish_pending:
+			upcoming.append(due['publish'])
+
+		wait = max(0, min(upcoming) - time.time())
+		debug_print("Sleeping for %ss" % int(wait), 1)
+		stop.wait(wait)
+
+	log("Stopped")
+
+def add_arguments( parser ):
+	parser.add_argument('-A', '--access-token',
+			help='The access token to use for making Facebook Graph API requests.')
+
+	parser.add_argument('-C', '--client-id', type=int,
+			help='The Facebook application\'s client ID to use for making Facebook Graph API requests.')
+
+	parser.add_argument('-f', '--config-file', metavar='CONFIG_FILE',
+			help='A JSON-structured file containing configuration directives to use for the script')
+
+	parser.add_argument('--no-likes', action="store_true",
+			help='Don\'t scrape likes')
+
+	parser.add_argument('--no-publish', action="store_true",
+			help='Don\'t publish')
+
+	parser.add_argument('-P', '--posts-only', action="store_true",
+			help='Publish only the structured content of posts (wall-posts.html), as fbk_publish_3 -P')
+
+	parser.add_argument('-S', '--shards', metavar='SHARDS', type=fbk_publish_3.shard_scheme,
+			help='Publish per-month ("month") or SHARDS-post pages, as fbk_publish_3 -S')
+
+	parser.add_argument('-X', '--search-index', action="store_true",
+			help='Publish a search index with the wall, as fbk_publish_3 -X')
+
+	parser.add_argument('-j', '--workers', type=int, default=4,
+			help='Requests in flight at once when scraping likes, and processes when publishing shards (default: 4)')
+
+	parser.add_argument('-v', '--verbosity', action="count",
+			help="Increase output verbosity")
+
+	parser.add_argument('--version', action='version', version='%(prog)s 1.0')
+
+def run( run_args ):
+	global args, config_dir, obj_config, graph
+
+	args = run_args
+
+	if( args.search_index and args.shards ):
+		print("--search-index only works with a single page wall, not --shards")
+		sys.exit(1)
+
+	config_dir = fbk_config.find_config_dir()
+
+	obj_config = fbk_config.load_config( config_dir, args.config_file, False,
+		{ 'graph' : { 'access_token' : args.access_token, 'client_id' : args.client_id } } )
+
+	# One daemon works for one account
+	fbk_config.require_account( obj_config, 'daemon' )
+
+	fbk_config.validate_access_token( obj_config )
+
+	# One Graph client (and so one connection pool and one rate limit) for everything
+	graph = fbk_graph.graph_client( obj_config )
+
+	verbosity = ['-v'] * (args.verbosity or 0)
+	fbk_fetch_3.configure( script_args(fbk_fetch_3, verbosity), config_dir, obj_config, graph )
+	fbk_scrape_likes_3.configure( script_args(fbk_scrape_likes_3, verbosity + ['-j', str(args.workers)]), config_dir, obj_config, graph )
+	fbk_publish_3.configure( script_args(fbk_publish_3, []), config_dir, obj_config )
+
+	# Opens (and migrates) the cache, and keeps it open until we stop
+	fbk_db.connect(config_dir)
+
+	signal.signal(signal.SIGTERM, request_stop)
+	signal.signal(signal.SIGINT, request_stop)
+
+	daemon()
+
+	fbk_db.close()
+	graph.close()
+	if fbk_fetch_3.archive:
+		fbk_fetch_3.archive.close()
+	return 0
+
+# Main()
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='Fetch, scrape likes and publish on a schedule')
+	add_arguments(parser)
+	fbk_metrics.add_arguments(parser)
+
+	sys.exit( fbk_metrics.run('daemon', run, parser.parse_args()) )
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import os
+import sqlite3
+from fbk_schema import fbk_schema
+from fbk_metrics import fbk_metrics
+
+# fbk_db -- Opens fbk_cache.db. Each process gets one connection, tuned and migrated the first time it is asked
+# for, and shared by every helper after that. Helpers don't commit on their own; the script commits once per unit
+# of work (a fetched page, say), so that a page costs one fsync rather than one per table.
+
+db_filename = 'fbk_cache.db'
+
+# WAL lets fbk_publish_3 read while a fetch is writing, and with synchronous=NORMAL a commit only appends to the
+# log; the database itself is synced at checkpoints.
+pragmas = [
+	('journal_mode', 'WAL'),
+	('synchronous', 'NORMAL'),
+	('cache_size', -32000),			# KiB, i.e. 32MB
+	('mmap_size', 268435456),
+	('temp_store', 'MEMORY'),
+	('busy_timeout', 10000),		# ms to wait on another process's write lock
+]
+
+# Keyed by pid: a forked worker must not reuse its parent's connection
+connections = {}
+
+# Commits are timed for fbk_metrics; with synchronous=NORMAL they are where a write waits on the disk
+class Connection(sqlite3.Connection):
+	def commit(self):
+		with fbk_metrics.timed('sqlite_commit'):
+			sqlite3.Connection.commit(self)
+
+def db_path( config_dir ):
+	return os.path.join(config_dir, db_filename)
+
+def tune( cxn ):
+	for (pragma, value) in pragmas:
+		cxn.execute("PRAGMA %s = %s" % (pragma, value))
+
+def connect( config_dir ):
+	key = (os.getpid(), config_dir)
+
+	if key not in connections:
+		cxn = sqlite3.connect( db_path(config_dir), factory=Connection )
+		tune(cxn)
+		fbk_schema.migrate(cxn)
+
+		connections[key] = cxn
+
+	return connections[key]
+
+def close( config_dir=None ):
+	for key in list(connections):
+		if key[0] == os.getpid() and (config_dir is None or key[1] == config_dir):
+			connections.pop(key).close()
@@ -48,41 +48,54 @@ import sys
 import re
 import argparse
 import os
-import json
 import shutil
 import urllib
-import urllib.request
+import urllib.parse
 import time
+import calendar
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from collections import OrderedDict
 from fbk_config import fbk_config
-import sqlite3
+from fbk_graph import fbk_graph
+from fbk_schema import fbk_schema
+from fbk_db import fbk_db
+from fbk_archive import fbk_archive
+from fbk_metrics import fbk_metrics
+
+# Set (by fbk_daemon_3, on SIGTERM) to stop crawling once the page in hand has been committed
+stopping = False
+
+sqlite_write_timer = fbk_metrics.timer('sqlite_write')
 
 def debug_print(msg, verbose_threshold):
 	if args.verbosity:
 		if args.verbosity >= verbose_threshold:
 			print(msg)
 
-def fbk_fetch_prior( ):
+def fbk_fetch_prior( cxn ):
 
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
 	cur = cxn.cursor()
 
-	sql_fetch_query = """SELECT `created_timestamp` FROM `posts`
-	ORDER BY `created_timestamp` ASC LIMIT 1"""
+	sql_fetch_query = """SELECT `created_timestamp`, `created_epoch` FROM `posts`
+	ORDER BY `created_epoch` ASC LIMIT 1"""
 	cur.execute(sql_fetch_query)
 
-	str_earliest_ts = cur.fetchone()[0]
-	earliest_ts = int(datetime.strptime(str_earliest_ts, "%Y-%m-%dT%H:%M:%S%z").strftime('%s'))
+	(str_earliest_ts, earliest_ts) = cur.fetchone()
 	print(str_earliest_ts)
-	fbk_fetch_insert(until=earliest_ts, limit=200)
-	cxn.close()
+	fbk_fetch_insert(cxn, until=earliest_ts, limit=200)
 
 	sys.exit(32)
 
 	return
 
-def fbk_insert_response( res, fbk_cache_id=[] ):
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
+# Neither fbk_insert_response nor fbk_fetch_url commit; the caller owns the transaction, so that a page's txn
+# row and its posts land together (or not at all).
+#
+# Duplicates are left to the UNIQUE index on posts.fbk_id: a post we already have is updated in place if it was
+# edited, and otherwise left alone.
+def fbk_insert_response( cxn, res ):
 	cur = cxn.cursor()
 
 	status_kv_schema = { 'fbk_id' : 'id', 'created_timestamp' : 'created_time' }
@@ -90,85 +103,139 @@ def fbk_insert_response( res, fbk_cache_id=[] ):
 	
 	status_kv_dict = (OrderedDict((list(status_kv_dict.items()) + list(status_kv_schema.items()))))
 
-	posts = []
-	skipped = 0
-	invalid = 0
-	for status in res['data']:
+	# Posts are handed to executemany() as they are mapped, so that a streamed page (fbk_graph.StreamedPage) is
+	# never held in memory as a whole
+	counts = { 'posts' : 0, 'invalid' : 0, 'filtered' : 0, 'mapping' : 0.0 }
+	timefilter = obj_config.timefilter
 
-		if "message" not in status:
-			invalid += 1
-			continue
+	def mapped_posts():
+		start = time.perf_counter()
+		for status in res['data']:
 
-		if "privacy" not in status:
-			invalid += 1
-			continue
+			if "message" not in status:
+				counts['invalid'] += 1
+				continue
 
-		if "description" not in status['privacy']:
-			invalid += 1
-			continue
+			if "privacy" not in status:
+				counts['invalid'] += 1
+				continue
 
-		#process_post_likes(cxn, status['id'], status['likes'])
+			if "description" not in status['privacy']:
+				counts['invalid'] += 1
+				continue
 
-		# Don't add to the DB multiple times
-		if status['id'] in fbk_cache_id:
-			skipped += 1
-			continue
+			#process_post_likes(cxn, status['id'], status['likes'])
 
-		post = OrderedDict( {k : status[v] for k,v in status_kv_dict.items()} )
-		post['privacy_description'] = status['privacy']['description']
+			post = OrderedDict( {k : status[v] for k,v in status_kv_dict.items()} )
+			post['privacy_description'] = status['privacy']['description']
+			post['created_epoch'] = fbk_schema.parse_epoch(post['created_timestamp'])
 
-		posts.append(post)
+			# Left out altogether (see fbk_config.TimeFilter)
+			if post['created_epoch'] in timefilter:
+				counts['filtered'] += 1
+				continue
 
-	debug_print("Skipped, %s posts; invalid" % (invalid), 2)
-	debug_print("Skipped, %s posts; previously added" % (skipped), 3)
+			counts['posts'] += 1
+			counts['mapping'] += time.perf_counter() - start
+			yield post
+			start = time.perf_counter()
 
-	status_insert = []
-	for p in posts:
-		status_insert.append( ("(" + ",".join(["%s" % (v) for v in p.values()]) + ")") )
+		counts['mapping'] += time.perf_counter() - start
 
 	# SQL
-	sql_status_insert = """INSERT INTO posts 
+	sql_status_upsert = """INSERT INTO posts 
 	(%s) 
 	VALUES 
-	(:fbk_id, :created_timestamp, :type, :message, :privacy_description)
-	;""" % (",".join( ('fbk_id', 'created_timestamp', 'type', 'message', 'privacy_description') ))
+	(:fbk_id, :created_timestamp, :created_epoch, :type, :message, :privacy_description)
+	ON CONFLICT(`fbk_id`) DO UPDATE SET
+		`message`=excluded.`message`,
+		`privacy_description`=excluded.`privacy_description`,
+		`type`=excluded.`type`
+	WHERE `message` IS NOT excluded.`message`
+		OR `privacy_description` IS NOT excluded.`privacy_description`
+		OR `type` IS NOT excluded.`type`
+	;""" % (",".join( ('fbk_id', 'created_timestamp', 'created_epoch', 'type', 'message', 'privacy_description') ))
 	# END SQL
 
-	cur.executemany( sql_status_insert, posts )
-	cxn.commit()
+	with fbk_metrics.timed('dedup'):
+		cur.execute("SELECT IFNULL(MAX(`id`), 0) FROM posts")
+		max_id = cur.fetchone()[0]
+
+	# Reading and mapping the page happens inside executemany(), and is timed by fbk_graph (http_wait, json_decode)
+	# instead, so it is taken back out of sqlite_write
+	start = time.perf_counter()
+	cur.executemany( sql_status_upsert, mapped_posts() )
+	sqlite_write_timer.add(time.perf_counter() - start - counts['mapping'])
+	changed = max(cur.rowcount, 0)
+
+	invalid = counts['invalid']
+	filtered = counts['filtered']
+
+	# ids only ever grow, so anything past the old maximum is new; the remaining changes were edits
+	with fbk_metrics.timed('dedup'):
+		cur.execute("SELECT COUNT(*) FROM posts WHERE `id` > ?", (max_id,))
+		inserted = cur.fetchone()[0]
+	updated = changed - inserted
+	skipped = counts['posts'] - changed
+
+	fbk_metrics.count('pages')
+	fbk_metrics.count('posts_inserted', inserted)
+	fbk_metrics.count('posts_updated', updated)
+	fbk_metrics.count('posts_skipped', skipped)
+	fbk_metrics.count('posts_invalid', invalid)
+	fbk_metrics.count('posts_filtered', filtered)
 
-	cxn.close()
-	return (invalid,skipped,len(posts))
+	debug_print("Skipped, %s posts; invalid" % (invalid), 2)
+	debug_print("Skipped, %s posts; in the timefilter" % (filtered), 2)
+	debug_print("Skipped, %s posts; previously added" % (skipped), 3)
+	debug_print("Updated, %s edited posts" % (updated), 3)
 
-def fbk_fetch_url(url):
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
-	cur = cxn.cursor()
+	return (invalid,skipped,inserted,updated)
 
+# Network only; safe to call from worker threads. Returns the attempts made, to be recorded in the txn table.
+# record (see fbk_archive) is given the page as it was sent.
+def fbk_fetch_page( url, record=None ):
 	debug_print("Fetch URL: %s" % (url), 4)
 
-	with urllib.request.urlopen(url) as r:
+	(attempts, response) = graph.get_json(url, record)
+
+	debug_print("Loaded %s responses" % (len(response['data'])), 3)
+
+	return (attempts, response)
 
-		cur.execute( "INSERT INTO txn (`datetime_requested`, `return_code`) VALUES (?, ?)", (time.time(), r.status) )
+# A request that failed for good still has its attempts written (and committed) before the error is passed on
+def fbk_fetch_url( cxn, url ):
+	record = archive.record() if archive else None
+
+	try:
+		(attempts, response) = fbk_fetch_page(url, record)
+	except Exception as e:
+		fbk_graph.record_attempts(cxn, getattr(e, 'attempts', []))
 		cxn.commit()
+		raise
 
-		response = json.loads(r.read().decode('utf-8'))
-	
-	debug_print("Loaded %s responses" % (len(response['data'])), 3)
-	cxn.close()
+	txn_id = fbk_graph.record_attempts(cxn, attempts)
+	if record is not None:
+		archive.append(cxn, txn_id, url, record)
 
 	return response
 
-def fbk_fetch_insert( endpoint="posts", type_="status", fields=['id','message','privacy','type','likes'], since=None, until=None, limit=None, **kwargs):
+# As fbk_fetch_url, but the page's posts are parsed as they arrive (see fbk_graph.StreamedPage). The attempts are
+# returned for the caller to record once the page has been read, as that is when its size is known.
+def fbk_fetch_stream( cxn, url, record=None ):
+	debug_print("Fetch URL: %s" % (url), 4)
 
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
-	cur = cxn.cursor()
+	try:
+		return graph.get_stream(url, tee=record)
+	except Exception as e:
+		fbk_graph.record_attempts(cxn, getattr(e, 'attempts', []))
+		cxn.commit()
+		raise
 
-	# Set up fbk_cache_id
-	cur.execute("SELECT fbk_id FROM posts")
-	fbk_cache_id = [x for l in cur.fetchall() for x in l]
+def fbk_fetch_insert( cxn, endpoint="posts", type_="status", fields=['id','message','privacy','type','likes'], since=None, until=None, limit=None, **kwargs):
 
-	url_params = (endpoint, obj_config['graph']['access_token'], type_, ",".join(fields))
-	url = "https://graph.facebook.com/me/%s?access_token=%s&type=%s&fields=%s" % url_params
+	url_params = (endpoint, obj_config.graph.access_token, type_, ",".join(fields))
+	url = graph.url("/%s/%s?access_token=%s&type=%s&fields=%s" % ((node,) + url_params))
 
 	if(since):
 		url += "&since=%s" % (since)
@@ -177,42 +244,68 @@ def fbk_fetch_insert( endpoint="posts", type_="status", fields=['id','message','
 	if(until):
 		url += "&until=%s" % (until)
 
-	fbk_insert_response( fbk_fetch_url(url), fbk_cache_id)
-
-	cxn.close()
+	fbk_insert_response( cxn, fbk_fetch_url(cxn, url) )
+	cxn.commit()
 
 	return
 
+# A crawl checkpoint stores the paging.next URL of the last committed page, minus the access_token, so that a
+# resumed crawl picks up with whatever token is configured at the time.
+def fbk_cursor_from_url( url ):
+	parts = urllib.parse.urlsplit(url)
+	query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k != 'access_token']
+
+	until = None
+	for k, v in query:
+		if k == 'until':
+			until = int(v)
+
+	return (urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query))), until)
+
+def fbk_url_from_cursor( cursor ):
+	parts = urllib.parse.urlsplit(cursor)
+	query = urllib.parse.parse_qsl(parts.query) + [('access_token', obj_config.graph.access_token)]
+
+	return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+def fbk_checkpoint_load( cxn, name ):
+	cur = cxn.cursor()
+	cur.execute("SELECT `cursor`, `pages` FROM `checkpoint` WHERE `name`=? AND `complete`=0", (name,))
+
+	return cur.fetchone()
+
+def fbk_checkpoint_save( cxn, name, next_url, pages ):
+	cursor, until = (None, None)
+	if next_url:
+		(cursor, until) = fbk_cursor_from_url(next_url)
+
+	# SQL
+	sql_checkpoint_save = """INSERT OR REPLACE INTO checkpoint
+	(`name`, `cursor`, `until`, `pages`, `datetime_updated`, `complete`)
+	VALUES
+	(?, ?, ?, ?, ?, ?)
+	;"""
+	# END SQL
+
+	cxn.execute( sql_checkpoint_save, (name, cursor, until, pages, time.time(), 0 if next_url else 1) )
+
+def fbk_resume_throttle( cxn ):
+	throttled_until = fbk_graph.resume_throttle(cxn, graph.scheduler)
+	if throttled_until:
+		print("Graph API throttled an earlier run; waiting until %s" % datetime.fromtimestamp(throttled_until).strftime('%H:%M:%S'))
+
 def fbk_cache( ):
 	#if ( use_configdir and os.path.exists(os.path.join(config_dir,'fbk_cache.db')) ):
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
+	cxn = fbk_db.connect(config_dir)
 	cur = cxn.cursor()
 
-	sql_txn_create = """CREATE TABLE IF NOT EXISTS txn 
-	(
-		`id` INTEGER PRIMARY KEY AUTOINCREMENT,
-		`datetime_requested` INTEGER,
-		`return_code` INTEGER	
-	)
-	"""
-	cur.execute( sql_txn_create )
-
-	sql_posts_create = """CREATE TABLE IF NOT EXISTS posts 
-	(
-		`id` INTEGER PRIMARY KEY AUTOINCREMENT,
-		`fbk_id` TEXT,
-		`message` TEXT,
-		`privacy_description` TEXT,
-		`created_timestamp` TEXT,
-		`type` TEXT
-	)
-	"""
-	cur.execute( sql_posts_create )
+	fbk_resume_throttle(cxn)
 
+	# A full crawl is resumable, so it isn't held back by the cache timeout
 	last_cache_time = None
-	if args.ignore_last_cache_time == False: 
-		if obj_config['graph']['update_freq']:
-			if obj_config['graph']['update_freq'] > 0:
+	if args.ignore_last_cache_time == False and not args.all: 
+		if obj_config.graph.update_freq:
+			if obj_config.graph.update_freq > 0:
 
 				sql_cache_query = "SELECT `datetime_requested` FROM `txn` WHERE `return_code`=200 ORDER BY `id` DESC LIMIT 1"
 				cur.execute(sql_cache_query)
@@ -221,48 +314,271 @@ def fbk_cache( ):
 
 				if last_cache_time:
 					last_cache_time = last_cache_time[0]
-					if not force_update and time.time() - last_cache_time < obj_config['graph']['update_freq']:
+					if not force_update and time.time() - last_cache_time < obj_config.graph.update_freq:
 						print( "Fetch request aborted. Use cache data. You may override with -R")
 						sys.exit(12)
 
 
-	# Set up fbk_cache_id
-	cur.execute("SELECT fbk_id FROM posts")
-	fbk_cache_id = [x for l in cur.fetchall() for x in l]
-
 
-	graph_status_url = "https://graph.facebook.com/me/posts?access_token=%s&type=status&fields=id,message,privacy,type,likes" % (obj_config['graph']['access_token'])
+	graph_status_url = graph.url("/%s/posts?access_token=%s&type=status&fields=id,message,privacy,type,likes" % (node, obj_config.graph.access_token))
 
 	if last_cache_time is not None:
 		graph_status_url += "&since=%s" % ( int(last_cache_time) )
 	#else:
 	#	graph_status_url += "&limit=200"
 
-	debug_print("Fetch URL: %s" % (graph_status_url), 4)
-
-
-	# 
 	iteration = 0
-	fetch_loop_max = 1 # At some point in the future, this will represent a complete fetch loop
-	while iteration < fetch_loop_max and graph_status_url:
+	fetch_loop_max = 1
+	checkpoint_name = None
+	if args.all:
+		fetch_loop_max = None
+		checkpoint_name = 'posts'
+
+		if args.restart:
+			cxn.execute("DELETE FROM `checkpoint` WHERE `name`=?", ('posts',))
+			cxn.commit()
+
+		checkpoint = fbk_checkpoint_load(cxn, 'posts')
+		if checkpoint and checkpoint[0]:
+			graph_status_url = fbk_url_from_cursor(checkpoint[0])
+			iteration = checkpoint[1]
+			print("Resuming crawl after %s pages" % iteration)
+
+	(total_inserted, total_updated) = fbk_crawl( cxn, graph_status_url, fetch_loop_max, checkpoint_name, iteration )
+
+	if total_inserted > 0:
+		print("Inserted %s updated posts" % total_inserted)
+	else:
+		print("No additional posts were fetched.")
+
+	if total_updated > 0:
+		print("Updated %s edited posts" % total_updated)
 
-		response = fbk_fetch_url(graph_status_url)
+	return (total_inserted, total_updated)
 
-		(num_invalid,num_skipped,num_inserted) = fbk_insert_response( response, fbk_cache_id)
+# Reads pages from url, following paging.next, until there are no more, max_pages have been read, or a stop has been
+# asked for (see stopping). Each page is one transaction, along with the checkpoint if one is named.
+# Returns (inserted, updated).
+def fbk_crawl( cxn, graph_status_url, max_pages=None, checkpoint_name=None, iteration=0 ):
+	debug_print("Fetch URL: %s" % (graph_status_url), 4)
 
-		if not force_update:
-			graph_status_url = response['paging']['next']
+	pages = 0
+	total_inserted = 0
+	total_updated = 0
+	while (max_pages is None or pages < max_pages) and graph_status_url and not stopping:
+
+		attempts = []
+		record = archive.record() if archive else None
+		try:
+			(attempts, response) = fbk_fetch_stream(cxn, graph_status_url, record)
+			(num_invalid,num_skipped,num_inserted,num_updated) = fbk_insert_response( cxn, response )
+
+			# Reads the rest of the page (paging, ...), so that its size is known and it is archived whole
+			response.close()
+		except fbk_graph.fetch_errors as e:
+			# A page that broke off half way is dropped as a whole
+			cxn.rollback()
+			fbk_graph.record_attempts(cxn, attempts)
+			cxn.commit()
+
+			print("Fetch failed after %s pages: %s" % (iteration, e))
+			if checkpoint_name == 'posts':
+				print("Run with -a again to resume the crawl.")
+			sys.exit(13)
+
+		txn_id = fbk_graph.record_attempts(cxn, attempts)
+		if record is not None:
+			archive.append(cxn, txn_id, graph_status_url, record)
+		debug_print("Loaded %s responses" % (response.count), 3)
+
+		total_inserted += num_inserted
+		total_updated += num_updated
+
+		if force_update and max_pages is not None:
+			graph_status_url = None
+		elif response.count and 'paging' in response:
+			graph_status_url = response['paging'].get('next')
 		else:
 			graph_status_url = None
 
 		iteration = iteration + 1
+		pages = pages + 1
+
+		# One transaction per page: the txn row, the posts and the checkpoint are committed together
+		if checkpoint_name:
+			fbk_checkpoint_save(cxn, checkpoint_name, graph_status_url, iteration)
+		cxn.commit()
+
+		debug_print("Page %s: inserted %s, updated %s, skipped %s, invalid %s" % (iteration, num_inserted, num_updated, num_skipped, num_invalid), 2)
+
+	return (total_inserted, total_updated)
+
+# For fbk_daemon_3: every page of posts newer than the newest one cached. Returns (inserted, updated).
+def fbk_fetch_new( ):
+	cxn = fbk_db.connect(config_dir)
+
+	fbk_resume_throttle(cxn)
+
+	newest = cxn.execute("SELECT MAX(`created_epoch`) FROM `posts`").fetchone()[0]
+
+	graph_status_url = graph.url("/%s/posts?access_token=%s&type=status&fields=id,message,privacy,type,likes" % (node, obj_config.graph.access_token))
+	if newest:
+		graph_status_url += "&since=%s" % (newest)
+
+	return fbk_crawl( cxn, graph_status_url )
 
-		if num_inserted > 0:
-			print("Inserted %s updated posts" % num_inserted)
+def parse_when( str_when ):
+	if str_when.isdigit():
+		return int(str_when)
+
+	return calendar.timegm(datetime.strptime(str_when, "%Y-%m-%d").timetuple())
+
+def fbk_windows( since, until, window ):
+	windows = []
+	while since < until:
+		windows.append( (since, min(since + window, until)) )
+		since += window
+
+	# Newest first, matching the order Graph returns posts in
+	windows.reverse()
+	return windows
+
+# Worker: pages through one since/until window, handing each parsed page to the writer. Graph's paging.next
+# keeps walking back in time past `since`, so stop at the first page that reaches the start of the window.
+# stop is set when the writer gives up; a worker then drops what it has rather than wait on a queue nobody reads.
+def fbk_fetch_window( name, url, since, pages, stop ):
+	while url and not stop.is_set():
+		page_url = url
+		record = archive.record() if archive else None
+		(attempts, response) = fbk_fetch_page(url, record)
+
+		data = response['data']
+		url = None
+		if data and 'paging' in response:
+			url = response['paging'].get('next')
+
+		oldest = None
+		if data:
+			oldest = min( int(datetime.strptime(d['created_time'], "%Y-%m-%dT%H:%M:%S%z").timestamp()) for d in data if 'created_time' in d )
+		if oldest is not None and oldest <= since:
+			url = None
+
+		while True:
+			try:
+				pages.put( (name, attempts, response, url, page_url, record), timeout=0.1 )
+				break
+			except queue.Full:
+				if stop.is_set():
+					return name
+
+	return name
+
+def fbk_cache_windows( since, until, window, workers ):
+	cxn = fbk_db.connect(config_dir)
+	cur = cxn.cursor()
+
+	fbk_resume_throttle(cxn)
+
+	if args.restart:
+		cxn.execute("DELETE FROM `checkpoint` WHERE `name` LIKE 'window:%'")
+		cxn.commit()
+
+	fields = "id,message,privacy,type,likes"
+	url_params = (obj_config.graph.access_token, fields)
+
+	# Each window gets its own checkpoint, so a re-run skips finished windows and resumes unfinished ones
+	jobs = []
+	for (w_since, w_until) in fbk_windows(since, until, window):
+		name = "window:%s-%s" % (w_since, w_until)
+
+		cur.execute("SELECT `cursor`, `complete` FROM `checkpoint` WHERE `name`=?", (name,))
+		checkpoint = cur.fetchone()
+
+		if checkpoint and checkpoint[1]:
+			debug_print("Skipping completed window %s" % name, 2)
+			continue
+
+		if checkpoint and checkpoint[0]:
+			url = fbk_url_from_cursor(checkpoint[0])
 		else:
-			print("No additional posts were fetched.")
+			url = graph.url("/%s/posts?access_token=%s&type=status&fields=%s&limit=200" % ((node,) + url_params))
+			url += "&since=%s&until=%s" % (w_since, w_until)
+
+		jobs.append( (name, url, w_since) )
+
+	print("Fetching %s windows with %s workers" % (len(jobs), workers))
+
+	# Keep a warm connection around for every worker
+	graph.pool_size = max(graph.pool_size, workers)
+
+	# The calling thread is the only writer; workers never touch sqlite
+	pages = queue.Queue(maxsize=workers * 2)
+	page_count = {}
+	total_inserted = 0
+	total_updated = 0
+	failed = []
+
+	stop = threading.Event()
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(fbk_fetch_window, name, url, w_since, pages, stop) for (name, url, w_since) in jobs]
+		pending = set(futures)
+
+		# If the writer stops early (an sqlite error, or Ctrl-C), the workers are told to stop and the queue is
+		# drained, so that none of them is left blocked on it while the executor waits for them to finish
+		finished = False
+		try:
+			while pending or not pages.empty():
+				try:
+					(name, attempts, response, next_url, page_url, record) = pages.get(timeout=0.1)
+				except queue.Empty:
+					for f in [f for f in pending if f.done()]:
+						pending.discard(f)
+						if f.exception():
+							failed.append(f.exception())
+							fbk_graph.record_attempts(cxn, getattr(f.exception(), 'attempts', []))
+							cxn.commit()
+					continue
+
+				txn_id = fbk_graph.record_attempts(cxn, attempts)
+				if record is not None:
+					archive.append(cxn, txn_id, page_url, record)
+				(num_invalid,num_skipped,num_inserted,num_updated) = fbk_insert_response( cxn, response )
+				total_inserted += num_inserted
+				total_updated += num_updated
+
+				page_count[name] = page_count.get(name, 0) + 1
+				fbk_checkpoint_save(cxn, name, next_url, page_count[name])
+				cxn.commit()
+
+				debug_print("%s page %s: inserted %s, updated %s, skipped %s, invalid %s" % (name, page_count[name], num_inserted, num_updated, num_skipped, num_invalid), 2)
+
+			finished = True
+		finally:
+			if not finished:
+				cxn.rollback()
+				stop.set()
+				for f in futures:
+					f.cancel()
+
+				while not all(f.done() for f in futures):
+					try:
+						pages.get(timeout=0.1)
+					except queue.Empty:
+						pass
+
+	if total_inserted > 0:
+		print("Inserted %s updated posts" % total_inserted)
+	else:
+		print("No additional posts were fetched.")
+
+	if total_updated > 0:
+		print("Updated %s edited posts" % total_updated)
 
-	cxn.close()
+	if failed:
+		for e in failed:
+			print("Window failed: %s" % e)
+		print("%s windows failed. Re-run with the same --since/--until to resume them." % len(failed))
+		sys.exit(14)
 
 def mktreeoutput( basedirname ):
 	file_path = '.'
@@ -284,19 +600,15 @@ def process_post_likes(cxn, id, likes):
 
 def process_graph():
 
-	if( 'basedirname' in obj_config['graph'] ):
-		basedirname = obj_config['graph']['basedirname']
-	else:
-		basedirname = "_fbk"
+	basedirname = obj_config.graph.basedirname
 
-	fbk_cache()
+	if args.since:
+		until = parse_when(args.until) if args.until else int(time.time())
+		fbk_cache_windows( parse_when(args.since), until, args.window * 86400, args.workers )
+	else:
+		fbk_cache()
 	
-# Main()
-if __name__ == "__main__":
-
-	# Process arguments
-	parser = argparse.ArgumentParser(description='Fetch content from Facebook\'s Graph API')
-
+def add_arguments( parser ):
 	parser.add_argument('-A', '--access-token', 
 			help='The access token to use for making Facebook Graph API requests.')
 
@@ -309,6 +621,24 @@ if __name__ == "__main__":
 	parser.add_argument('-T', '--ignore-last-cache-time', action="store_true",
 			help='Ignore the local cache timeout.')
 
+	parser.add_argument('-a', '--all', action="store_true",
+			help='Crawl the complete history, following pages until exhausted. An interrupted crawl resumes from its last committed page.')
+
+	parser.add_argument('--restart', action="store_true",
+			help='Discard the saved crawl checkpoint and start a full crawl (-a) from the newest post.')
+
+	parser.add_argument('--since', metavar='DATE',
+			help='Fetch posts from DATE (YYYY-MM-DD or a UNIX timestamp) onwards, concurrently, in --window sized slices.')
+
+	parser.add_argument('--until', metavar='DATE',
+			help='Stop a --since fetch at DATE (YYYY-MM-DD or a UNIX timestamp). Defaults to now.')
+
+	parser.add_argument('-w', '--window', type=int, default=30, metavar='DAYS',
+			help='The size, in days, of each slice of a --since fetch. (default: 30)')
+
+	parser.add_argument('-j', '--workers', type=int, default=4,
+			help='The number of slices of a --since fetch to request at once. (default: 4)')
+
 	parser.add_argument('-f', '--config-file', metavar='CONFIG_FILE', 
 			help='A JSON-structured file containing configuration directives to use for the script')
 
@@ -317,39 +647,65 @@ if __name__ == "__main__":
 
 	parser.add_argument('--version', action='version', version='%(prog)s 1.3')
 
-	args = parser.parse_args()
-
+# Sets the module's globals, as run() would; fbk_daemon_3 shares its config and Graph client this way
+def configure( run_args, run_config_dir, run_obj_config, run_graph ):
+	global args, config_dir, use_configdir, obj_config, graph, force_update, archive, node
 
-	config_dir = ".fbk"
+	args = run_args
+	config_dir = run_config_dir
 	use_configdir = os.path.exists( config_dir )
-	
-	if use_configdir == False:
-		config_dir = os.path.join( os.path.expanduser('~'), '.fbk' )
-		use_configdir = os.path.exists( config_dir )
+	obj_config = run_obj_config
+	graph = run_graph
 
-	# Default obj_config
-	
-	file_configfile = None
-	if(args.config_file):
-		file_configfile = os.path.abspath(args.config_file)
-	elif( use_configdir and os.path.exists(os.path.join(config_dir, 'config.json'))):
-		file_configfile = os.path.join(config_dir, 'config.json')
+	# Whose posts: the token's own user ("me"), or a page's id
+	node = obj_config.graph.node
 
-	if(file_configfile):
-		obj_config = fbk_config.parse_config( file_configfile, True )
-
-	if(args.access_token):
-		obj_config['graph']['access_token'] = args.access_token
-
-	if(args.client_id):
-		obj_config['graph']['client_id'] = args.client_id
+	try:
+		archive = fbk_archive.archive_from_config( config_dir, obj_config )
+	except ValueError as e:
+		print(e)
+		sys.exit(1)
 
 	if(args.force):
 		force_update = True
 	else:
 		force_update = False
-		#obj_config['graph']['update_freq'] = 0
+		#obj_config.graph.update_freq = 0
+
+def run( run_args ):
+	config_dir = fbk_config.find_config_dir()
+
+	obj_config = fbk_config.load_config( config_dir, run_args.config_file, False,
+		{ 'graph' : { 'access_token' : run_args.access_token, 'client_id' : run_args.client_id } } )
+
+	# With several accounts configured and none chosen, each is fetched at once, by a process of its own
+	if( fbk_config.account is None and obj_config.accounts ):
+		if( run_args.access_token or run_args.client_id ):
+			print("-A and -C only apply to one account; choose it with fbk --account NAME")
+			sys.exit(1)
+
+		return fbk_config.run_accounts( fbk_config.account_names(obj_config), run, run_args )
+
+	fbk_config.validate_access_token( obj_config )
+
+	configure( run_args, config_dir, obj_config, fbk_graph.graph_client(obj_config) )
+
+	# Opens (and migrates) the cache once for the whole run
+	fbk_db.connect(config_dir)
 
 	process_graph()
 
-	sys.exit(0)
+	fbk_db.close()
+	if archive:
+		archive.close()
+	return 0
+
+# Main()
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='Fetch content from Facebook\'s Graph API')
+	add_arguments(parser)
+	fbk_metrics.add_arguments(parser)
+
+	sys.exit( fbk_metrics.run('fetch', run, parser.parse_args()) )
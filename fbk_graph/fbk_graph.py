@@ -0,0 +1,669 @@
+#!/usr/bin/env python3
+import codecs
+import email.utils
+import http.client
+import json
+import random
+import threading
+import time
+import urllib.parse
+import zlib
+from fbk_metrics import fbk_metrics
+
+# fbk_graph -- A small Graph API client shared by the fbk_*_3 scripts. Connections are kept alive and pooled per
+# host, so paging through a timeline pays for one TLS handshake instead of one per page.
+
+default_base_url = "https://graph.facebook.com"
+default_timeout = 30
+default_pool_size = 4
+
+default_rate = 10
+default_burst = 10
+default_retries = 5
+default_backoff = 1.0
+default_backoff_max = 300.0
+default_usage_threshold = 75
+
+# Graph error codes for application, user, page and custom rate limits. They come back as 400/403 rather than 429.
+throttle_codes = (4, 17, 32, 613)
+
+# The most requests the batch endpoint takes at once
+batch_max = 50
+
+http_timer = fbk_metrics.timer('http_wait')
+json_timer = fbk_metrics.timer('json_decode')
+
+class GraphError(Exception):
+	def __init__(self, url, status, headers, body):
+		self.url = url
+		self.status = status
+		self.headers = headers
+		self.body = body
+
+		# The URL carries the access_token, so it stays out of the message
+		Exception.__init__(self, ("HTTP %s %s" % (status, self.error().get("message", ""))).strip())
+
+		# Every attempt made before giving up, for the txn table
+		self.attempts = []
+
+	def error(self):
+		try:
+			return json.loads(self.body.decode('utf-8'))['error']
+		except (ValueError, KeyError, TypeError):
+			return {}
+
+	def throttled(self):
+		return self.status == 429 or self.error().get('code') in throttle_codes
+
+	def retriable(self):
+		return self.throttled() or self.status >= 500 or self.error().get('is_transient', False)
+
+class TokenBucket:
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.stamp = time.monotonic()
+		self.lock = threading.Lock()
+
+	def take(self):
+		while self.rate:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+				self.stamp = now
+
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+
+				wait = (1 - self.tokens) / self.rate
+
+			time.sleep(wait)
+
+# The request budget shared by every thread using a client. The bucket refills at `rate` requests/second; the rate
+# is scaled back as the usage headers Graph sends with each response approach 100%, and all requests are held back
+# (paused_until) when Graph says we are throttled.
+class Scheduler:
+	def __init__(self, rate=default_rate, burst=default_burst, retries=default_retries, backoff=default_backoff,
+			backoff_max=default_backoff_max, usage_threshold=default_usage_threshold):
+		self.base_rate = rate
+		self.bucket = TokenBucket(rate, burst)
+		self.retries = retries
+		self.backoff = backoff
+		self.backoff_max = backoff_max
+		self.usage_threshold = usage_threshold
+
+		self.paused_until = 0
+		self.lock = threading.Lock()
+
+	def pause(self, until):
+		with self.lock:
+			self.paused_until = max(self.paused_until, until)
+
+	def wait(self):
+		while True:
+			delay = self.paused_until - time.time()
+			if delay <= 0:
+				break
+			time.sleep(delay)
+
+		self.bucket.take()
+
+	def delay(self, attempt, retry_after=None):
+		# "Full jitter": a random wait up to the exponential ceiling, so that workers don't retry in lock-step
+		delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+		if retry_after is not None:
+			delay = max(delay, retry_after)
+
+		return delay
+
+	# Returns the highest usage percentage reported, or None
+	def observe(self, headers):
+		(usage, regain) = parse_usage(headers)
+		if usage is None:
+			return None
+
+		# Without an estimate, a throttled request's own backoff decides how long to hold off
+		if usage >= 100 and regain:
+			self.pause(time.time() + regain)
+
+		if self.base_rate:
+			scale = 1.0
+			if usage > self.usage_threshold:
+				scale = max(0.05, (100.0 - usage) / (100.0 - self.usage_threshold))
+			self.bucket.rate = self.base_rate * scale
+
+		return usage
+
+def parse_usage( headers ):
+	usage = None
+	regain = None
+
+	for name in ('X-App-Usage', 'X-Page-Usage', 'X-Ad-Account-Usage', 'X-Business-Use-Case-Usage'):
+		value = headers.get(name)
+		if not value:
+			continue
+
+		try:
+			value = json.loads(value)
+		except ValueError:
+			continue
+
+		# X-Business-Use-Case-Usage is keyed by business id, each with a list of usage objects
+		objs = [value]
+		if name == 'X-Business-Use-Case-Usage':
+			objs = [o for l in value.values() for o in l]
+
+		for o in objs:
+			for k in ('call_count', 'total_cputime', 'total_time', 'acc_id_util_pct'):
+				if k in o:
+					usage = max(usage or 0, float(o[k]))
+
+			if o.get('estimated_time_to_regain_access'):
+				regain = max(regain or 0, 60 * float(o['estimated_time_to_regain_access']))
+
+	return (usage, regain)
+
+def parse_retry_after( headers ):
+	value = headers.get('Retry-After')
+	if not value:
+		return None
+
+	if value.isdigit():
+		return int(value)
+
+	try:
+		return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return None
+
+# What a failed fetch can raise: an error response, a network failure, or a body that isn't the JSON it should be
+fetch_errors = (GraphError, OSError, http.client.HTTPException, ValueError)
+
+# Connections a server has quietly dropped only show up once they are reused; these are worth one retry on a fresh
+# connection.
+stale_errors = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+
+class GraphClient:
+	def __init__(self, base_url=default_base_url, timeout=default_timeout, pool_size=default_pool_size, scheduler=None):
+		self.base_url = base_url.rstrip('/')
+		self.timeout = timeout
+		self.pool_size = pool_size
+		self.scheduler = scheduler or Scheduler()
+
+		self.idle = {}
+		self.lock = threading.Lock()
+
+	def url(self, path):
+		return self.base_url + path
+
+	def _connect(self, key):
+		(scheme, host, port) = key
+		if scheme == 'https':
+			return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+
+		return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+	def _acquire(self, key):
+		with self.lock:
+			if self.idle.get(key):
+				return (self.idle[key].pop(), True)
+
+		return (self._connect(key), False)
+
+	def _release(self, key, cxn):
+		with self.lock:
+			idle = self.idle.setdefault(key, [])
+			if len(idle) < self.pool_size:
+				idle.append(cxn)
+				return
+
+		cxn.close()
+
+	def close(self):
+		with self.lock:
+			for idle in self.idle.values():
+				for cxn in idle:
+					cxn.close()
+			self.idle = {}
+
+	# Sends a request and returns as soon as the headers are in. The body is read through the returned ResponseBody,
+	# which hands the connection back to the pool once it has been read to the end.
+	def open(self, method, url, body=None, headers={}):
+		parts = urllib.parse.urlsplit(url)
+		key = (parts.scheme, parts.hostname, parts.port)
+
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+
+		req_headers = { 'Accept-Encoding' : 'gzip, deflate', 'Connection' : 'keep-alive', 'User-Agent' : 'fbk_utils' }
+		req_headers.update(headers)
+
+		(cxn, reused) = self._acquire(key)
+		start = time.perf_counter()
+		try:
+			cxn.request(method, path, body=body, headers=req_headers)
+			r = cxn.getresponse()
+		except stale_errors:
+			cxn.close()
+			if not reused:
+				raise
+
+			cxn = self._connect(key)
+			cxn.request(method, path, body=body, headers=req_headers)
+			r = cxn.getresponse()
+		except:
+			cxn.close()
+			raise
+		finally:
+			http_timer.add(time.perf_counter() - start)
+
+		response_body = ResponseBody(self, key, cxn, r)
+
+		if r.status >= 400:
+			raise GraphError(url, r.status, r.headers, response_body.read_all())
+
+		return (r.status, r.headers, response_body)
+
+	def request(self, method, url, body=None, headers={}):
+		(status, headers, response_body) = self.open(method, url, body, headers)
+		return (status, headers, response_body.read_all())
+
+	# Requests go through the scheduler and are retried with backoff. send(record) makes one attempt and returns
+	# (status, headers, result). Returns (attempts, result), where attempts holds one txn record per try; on failure
+	# they are attached to the exception instead.
+	def _scheduled(self, send):
+		attempts = []
+		attempt = 0
+
+		while True:
+			with fbk_metrics.timed('throttle_wait'):
+				self.scheduler.wait()
+
+			record = { 'datetime_requested' : time.time(), 'attempt' : attempt, 'return_code' : None, 'latency' : None,
+				'bytes' : None, 'usage' : None, 'error' : None, 'throttled_until' : None }
+			attempts.append(record)
+
+			start = time.monotonic()
+			retry_after = None
+			try:
+				(status, headers, result) = send(record)
+			except GraphError as e:
+				record['latency'] = time.monotonic() - start
+				record['return_code'] = e.status
+				record['bytes'] = len(e.body)
+				record['usage'] = self.scheduler.observe(e.headers)
+				record['error'] = str(e)
+
+				error = e
+				retry = e.retriable()
+				retry_after = parse_retry_after(e.headers)
+			except (OSError, http.client.HTTPException) as e:
+				record['latency'] = time.monotonic() - start
+				record['error'] = "%s: %s" % (type(e).__name__, e)
+
+				error = e
+				retry = True
+			else:
+				record['latency'] = time.monotonic() - start
+				record['return_code'] = status
+				record['usage'] = self.scheduler.observe(headers)
+
+				return (attempts, result)
+
+			if not retry or attempt >= self.scheduler.retries:
+				error.attempts = attempts
+				raise error
+
+			delay = self.scheduler.delay(attempt, retry_after)
+			if isinstance(error, GraphError) and error.throttled():
+				# Throttling applies to the whole app, not just this thread
+				record['throttled_until'] = time.time() + delay
+				self.scheduler.pause(record['throttled_until'])
+				fbk_metrics.count('http_throttled')
+			else:
+				with fbk_metrics.timed('throttle_wait'):
+					time.sleep(delay)
+
+			fbk_metrics.count('http_retries')
+			attempt += 1
+
+	# tee (an fbk_archive.Record, say) is given the body of the response, as sent
+	def get_json(self, url, tee=None):
+		def send(record):
+			if tee is not None:
+				tee.reset()
+
+			(status, headers, data) = self.request('GET', url)
+			record['bytes'] = len(data)
+
+			if tee is not None:
+				tee.write(data)
+
+			with fbk_metrics.timed('json_decode'):
+				return (status, headers, json.loads(data.decode('utf-8')))
+
+		return self._scheduled(send)
+
+	def post_json(self, url, fields):
+		body = urllib.parse.urlencode(fields).encode('utf-8')
+
+		def send(record):
+			(status, headers, data) = self.request('POST', url, body, { 'Content-Type' : 'application/x-www-form-urlencoded' })
+			record['bytes'] = len(data)
+
+			with fbk_metrics.timed('json_decode'):
+				return (status, headers, json.loads(data.decode('utf-8')))
+
+		return self._scheduled(send)
+
+	# Up to batch_max GETs in one round trip, through the batch endpoint. Returns (attempts, results), with one
+	# (code, body) per relative URL; body is the decoded JSON, and code is None if Graph didn't get to that request.
+	def batch(self, access_token, relative_urls):
+		requests = [ { 'method' : 'GET', 'relative_url' : relative_url.lstrip('/') } for relative_url in relative_urls ]
+
+		(attempts, items) = self.post_json(self.url('/'),
+			{ 'access_token' : access_token, 'batch' : json.dumps(requests), 'include_headers' : 'false' })
+
+		results = []
+		start = time.perf_counter()
+		for item in items:
+			if item is None:
+				results.append( (None, None) )
+				continue
+
+			try:
+				body = json.loads(item['body'])
+			except (TypeError, ValueError):
+				body = None
+
+			results.append( (item.get('code'), body) )
+		json_timer.add(time.perf_counter() - start)
+
+		return (attempts, results)
+
+	# As get_json, but the response is a StreamedPage, parsed as it is read off the connection. tee is given each
+	# piece of the body as it is read.
+	def get_stream(self, url, key='data', tee=None):
+		def send(record):
+			if tee is not None:
+				tee.reset()
+
+			(status, headers, response_body) = self.open('GET', url)
+			if tee is not None:
+				response_body.tee = tee.write
+
+			return (status, headers, StreamedPage(response_body, key, record))
+
+		return self._scheduled(send)
+
+class ResponseBody:
+	def __init__(self, client, key, cxn, r):
+		self.client = client
+		self.key = key
+		self.cxn = cxn
+		self.r = r
+
+		self.encoding = r.getheader('Content-Encoding')
+		self.decompressor = None
+		if self.encoding == 'gzip':
+			self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+		# Bytes as sent, before decompression
+		self.size = 0
+		self.done = False
+
+		# Called with each piece of the decoded body
+		self.tee = None
+
+	# Returns the next piece of the decoded body, or b'' at the end
+	def read(self, amt=65536):
+		data = self._read(amt)
+		if data and self.tee is not None:
+			self.tee(data)
+
+		return data
+
+	def _read(self, amt):
+		while not self.done:
+			start = time.perf_counter()
+			try:
+				chunk = self.r.read(amt)
+			except:
+				self.abort()
+				raise
+			finally:
+				http_timer.add(time.perf_counter() - start, 0)
+
+			if not chunk:
+				self.finish()
+				if self.decompressor:
+					return self.decompressor.flush()
+				return b''
+
+			if self.encoding == 'deflate' and self.decompressor is None:
+				# Servers disagree on whether "deflate" means zlib-wrapped or raw
+				zlib_header = len(chunk) >= 2 and (chunk[0] & 0x0f) == 8 and ((chunk[0] << 8) | chunk[1]) % 31 == 0
+				self.decompressor = zlib.decompressobj(zlib.MAX_WBITS if zlib_header else -zlib.MAX_WBITS)
+
+			self.size += len(chunk)
+			if self.decompressor is None:
+				return chunk
+
+			data = self.decompressor.decompress(chunk)
+			if data:
+				return data
+
+		return b''
+
+	def read_all(self):
+		chunks = []
+		while True:
+			chunk = self.read()
+			if not chunk:
+				break
+			chunks.append(chunk)
+
+		return b''.join(chunks)
+
+	def finish(self):
+		if self.done:
+			return
+		self.done = True
+
+		fbk_metrics.count('http_bytes', self.size)
+
+		if self.r.will_close:
+			self.cxn.close()
+		else:
+			self.client._release(self.key, self.cxn)
+
+	def abort(self):
+		self.done = True
+		self.cxn.close()
+
+# A JSON object read incrementally from a ResponseBody. Iterating page[key] (normally page['data']) yields the
+# elements of that array one at a time as they come off the connection, so only one post (plus a read buffer) is
+# held in memory rather than the raw page, its decoded text and the whole object tree. The object's other members
+# (paging, ...) can be looked up once the array has been read through; looking one up earlier skips the rest of it.
+class StreamedPage:
+	whitespace = ' \t\n\r'
+	delimiters = whitespace + ',:]}'
+	decoder = json.JSONDecoder()
+
+	def __init__(self, response_body, key, record=None):
+		self.body = response_body
+		self.key = key
+		self.record = record
+
+		self.text = codecs.getincrementaldecoder('utf-8')()
+		self.buf = ''
+		self.pos = 0
+		self.eof = False
+
+		self.rest = {}
+		self.count = 0
+		self.items = self._parse()
+
+	def __getitem__(self, k):
+		if k == self.key:
+			return self.items
+
+		self.close()
+		return self.rest[k]
+
+	def __contains__(self, k):
+		if k == self.key:
+			return True
+
+		self.close()
+		return k in self.rest
+
+	def get(self, k, default=None):
+		if k in self:
+			return self[k]
+		return default
+
+	# Reads (and discards) whatever is left, so the connection goes back to the pool
+	def close(self):
+		for item in self.items:
+			pass
+
+	def _fill(self):
+		if self.eof:
+			return False
+
+		chunk = self.body.read()
+		if not chunk:
+			self.eof = True
+			self.buf = self.buf[self.pos:] + self.text.decode(b'', True)
+			self.pos = 0
+
+			if self.record is not None:
+				self.record['bytes'] = self.body.size
+			return False
+
+		self.buf = self.buf[self.pos:] + self.text.decode(chunk)
+		self.pos = 0
+		return True
+
+	def _peek(self):
+		while True:
+			while self.pos < len(self.buf) and self.buf[self.pos] in self.whitespace:
+				self.pos += 1
+
+			if self.pos < len(self.buf):
+				return self.buf[self.pos]
+
+			if not self._fill():
+				return ''
+
+	def _expect(self, chars):
+		c = self._peek()
+		if not c or c not in chars:
+			raise ValueError("Expected one of %r at offset %s of the response, found %r" % (chars, self.pos, c))
+
+		self.pos += 1
+		return c
+
+	def _value(self):
+		self._peek()
+
+		while True:
+			start = time.perf_counter()
+			try:
+				(value, end) = self.decoder.raw_decode(self.buf, self.pos)
+				json_timer.add(time.perf_counter() - start)
+
+				# A number (or literal) that runs up to the end of the buffer may have been cut short
+				if self.eof or (end < len(self.buf) and self.buf[end] in self.delimiters):
+					self.pos = end
+					return value
+			except ValueError:
+				json_timer.add(time.perf_counter() - start)
+				if self.eof:
+					raise
+
+			self._fill()
+
+	def _parse(self):
+		self._expect('{')
+
+		if self._peek() == '}':
+			self.pos += 1
+		else:
+			while True:
+				k = self._value()
+				self._expect(':')
+
+				if k == self.key and self._peek() == '[':
+					self.pos += 1
+
+					if self._peek() == ']':
+						self.pos += 1
+					else:
+						while True:
+							item = self._value()
+							self.count += 1
+							yield item
+
+							if self._expect(',]') == ']':
+								break
+				else:
+					self.rest[k] = self._value()
+
+				if self._expect(',}') == '}':
+					break
+
+		while self._fill():
+			pass
+
+def graph_client( obj_config ):
+	graph = obj_config.graph
+
+	scheduler = Scheduler(
+		graph.get('rate', default_rate),
+		graph.get('burst', default_burst),
+		graph.get('retries', default_retries),
+		graph.get('backoff', default_backoff),
+		graph.get('backoff_max', default_backoff_max),
+		graph.get('usage_threshold', default_usage_threshold),
+	)
+
+	return GraphClient(
+		graph.get('base_url', default_base_url),
+		graph.get('timeout', default_timeout),
+		graph.get('pool_size', default_pool_size),
+		scheduler,
+	)
+
+# txn bookkeeping: each attempt at a request is a row (see fbk_schema for the columns past return_code)
+txn_columns = ['datetime_requested', 'return_code', 'attempt', 'latency', 'bytes', 'usage', 'error', 'throttled_until']
+
+def record_attempts( cxn, attempts ):
+	# SQL
+	sql_txn_insert = """INSERT INTO txn
+	(%s)
+	VALUES
+	(%s)
+	;""" % (",".join(txn_columns), ",".join([":" + c for c in txn_columns]))
+	# END SQL
+
+	cxn.executemany( sql_txn_insert, attempts )
+
+	# The id of the last attempt's row (the one that succeeded, if any did)
+	if attempts:
+		return cxn.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+	return None
+
+# Picks up a throttle recorded by an earlier run, so a restarted crawl doesn't walk straight back into the limit
+def resume_throttle( cxn, scheduler ):
+	row = cxn.execute("SELECT MAX(`throttled_until`) FROM txn").fetchone()
+	if row and row[0] and row[0] > time.time():
+		scheduler.pause(row[0])
+		return row[0]
+
+	return None
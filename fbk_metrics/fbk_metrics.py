@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+import json
+import os
+import resource
+import sqlite3
+import sys
+import threading
+import time
+
+# fbk_metrics -- Where a run's time went. The scripts time their stages and count what they did into this module's
+# timers and counters, which cost a couple of clock reads apiece, so they are always on. Run through fbk_3.py (or a
+# script's own main), --report writes them out as JSON once the command exits, --record-run keeps them in the runs
+# table of fbk_cache.db, and --profile runs the command under cProfile or tracemalloc.
+#
+#	The timers, in seconds, summed over every thread (so with -j workers they can add up to more than the run took):
+#		http_wait		waiting on Graph: sending a request until its headers arrive, and reading its body
+#		throttle_wait		held back by the rate limit, a throttle, or a retry's backoff
+#		json_decode		decoding responses (or archived pages)
+#		dedup			sorting fetched posts into new, edited and unchanged; finding the posts likes belong to
+#		sqlite_write		inserting and updating rows
+#		sqlite_commit		commits
+#		archive_write, archive_read	compressing pages into the archive, and reading them back
+#		transform		formatting posts for publishing
+#		render			writing the wall out (transform included); a sharded publish's worker processes
+#					aren't timed on their own, so this is how long the pool took
+#		search_index		publish -X's search index
+#
+#	Each timer's calls is how many times it was started (http_wait's is the number of requests sent).
+
+timers = {}
+counters = {}
+lock = threading.Lock()
+
+profiles = ('cpu', 'memory')
+profile_top = 25
+
+class Timer:
+	def __init__(self, name):
+		self.name = name
+		self.calls = 0
+		self.seconds = 0.0
+		self.lock = threading.Lock()
+
+	def add(self, seconds, calls=1):
+		with self.lock:
+			self.calls += calls
+			self.seconds += seconds
+
+# with fbk_metrics.timed('sqlite_write'): ...
+class Timing:
+	def __init__(self, timer):
+		self.timer = timer
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.timer.add(time.perf_counter() - self.start)
+
+# Hot paths keep hold of their Timer and call add() themselves
+def timer( name ):
+	if name not in timers:
+		with lock:
+			timers.setdefault(name, Timer(name))
+
+	return timers[name]
+
+def timed( name ):
+	return Timing(timer(name))
+
+def count( name, n=1 ):
+	with lock:
+		counters[name] = counters.get(name, 0) + n
+
+# The timers and counters as plain data, for a worker process to send back to its parent
+def snapshot( ):
+	return {
+		'timers' : { t.name : (t.calls, t.seconds) for t in list(timers.values()) },
+		'counters' : dict(counters),
+	}
+
+# Zeroes the timers in place, as the scripts keep hold of theirs, for a worker process starting on a new task
+def reset( ):
+	with lock:
+		for t in timers.values():
+			with t.lock:
+				t.calls = 0
+				t.seconds = 0.0
+
+		counters.clear()
+
+def merge( worker_snapshot ):
+	for (name, (calls, seconds)) in worker_snapshot['timers'].items():
+		timer(name).add(seconds, calls)
+
+	for (name, n) in worker_snapshot['counters'].items():
+		count(name, n)
+
+def report( command, started, elapsed, status ):
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+
+	return {
+		'command' : command,
+		'argv' : sys.argv[1:],
+		'pid' : os.getpid(),
+		'started' : int(started),
+		'elapsed' : round(elapsed, 6),
+		'status' : status,
+		'cpu_user' : round(usage.ru_utime, 6),
+		'cpu_system' : round(usage.ru_stime, 6),
+		'max_rss_kib' : usage.ru_maxrss,
+		'timers' : { t.name : { 'calls' : t.calls, 'seconds' : round(t.seconds, 6) } for t in sorted(timers.values(), key=lambda t: t.name) },
+		'counters' : dict(sorted(counters.items())),
+	}
+
+def write_report( run_report, path ):
+	contents = json.dumps(run_report, indent=1)
+
+	if path == '-':
+		print(contents)
+		return
+
+	outfile = open(path + '.tmp', 'w', encoding='utf-8')
+	outfile.write(contents + '\n')
+	outfile.close()
+	os.replace(path + '.tmp', path)
+
+# Kept in fbk_cache.db (see fbk_schema) next to the txn rows of the same run
+def record_run( run_report ):
+	from fbk_config import fbk_config
+	from fbk_db import fbk_db
+
+	# SQL
+	sql_run_insert = """INSERT INTO runs
+	(`command`, `datetime_started`, `elapsed`, `status`, `report`)
+	VALUES
+	(?, ?, ?, ?, ?)
+	;"""
+	# END SQL
+	try:
+		cxn = fbk_db.connect( fbk_config.find_config_dir() )
+		cxn.execute( sql_run_insert, (run_report['command'], run_report['started'], run_report['elapsed'], run_report['status'],
+			json.dumps(run_report, separators=(',', ':'))) )
+		cxn.commit()
+	except sqlite3.Error as e:
+		print("Could not record the run: %s" % e)
+
+	fbk_db.close()
+
+# cProfile and tracemalloc are only imported when asked for, as they slow a run down (or, for tracemalloc, a lot)
+class Profile:
+	def __init__(self, kind, outfile=None):
+		self.kind = kind
+		self.outfile = outfile
+
+		if kind == 'cpu':
+			import cProfile
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+		else:
+			import tracemalloc
+			self.tracemalloc = tracemalloc
+			tracemalloc.start(10)
+
+	# Prints the top of the profile to stderr, and saves all of it to outfile if there is one
+	def finish(self, run_report):
+		if self.kind == 'cpu':
+			import pstats
+			self.profiler.disable()
+
+			stats = pstats.Stats(self.profiler, stream=sys.stderr)
+			stats.sort_stats('cumulative').print_stats(profile_top)
+			if self.outfile:
+				stats.dump_stats(self.outfile)
+			return
+
+		snapshot = self.tracemalloc.take_snapshot()
+		(current, peak) = self.tracemalloc.get_traced_memory()
+		self.tracemalloc.stop()
+
+		run_report['tracemalloc_peak_kib'] = peak // 1024
+
+		sys.stderr.write("Peak traced memory: %s KiB; still allocated at exit:\n" % (peak // 1024))
+		for stat in snapshot.statistics('lineno')[:profile_top]:
+			sys.stderr.write("%s\n" % stat)
+
+		if self.outfile:
+			snapshot.dump(self.outfile)
+
+def add_arguments( parser ):
+	parser.add_argument('--report', metavar='FILE',
+			help='Write a JSON report of where the run\'s time went (see fbk_metrics) to FILE when it exits, or - for stdout')
+
+	parser.add_argument('--record-run', action="store_true",
+			help='Keep the run\'s report in the runs table of fbk_cache.db')
+
+	parser.add_argument('--profile', choices=profiles,
+			help="""Run under cProfile (cpu; the main thread only) or tracemalloc (memory), and print the top of the
+			profile to stderr""")
+
+	parser.add_argument('--profile-out', metavar='FILE',
+			help='Save the whole profile to FILE (pstats for cpu, a tracemalloc snapshot for memory)')
+
+# Runs a script's run(args) as command, and reports on it however it ends
+def run( command, script_run, run_args ):
+	profile = None
+	if run_args.profile:
+		profile = Profile(run_args.profile, run_args.profile_out)
+
+	started = time.time()
+	start = time.perf_counter()
+
+	status = 1
+	try:
+		status = script_run(run_args)
+	except SystemExit as e:
+		status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+		raise
+	except KeyboardInterrupt:
+		status = 130
+		raise
+	finally:
+		run_report = report( command, started, time.perf_counter() - start, status )
+
+		if profile is not None:
+			profile.finish(run_report)
+
+		if run_args.report:
+			write_report( run_report, run_args.report )
+
+		if run_args.record_run:
+			record_run( run_report )
+
+	return status
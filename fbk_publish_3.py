@@ -34,39 +34,118 @@
 
 import argparse
 import os
-from bs4 import BeautifulSoup, Tag, Comment
-import sqlite3
 import sys
 import re
 import json
+import html
+import hashlib
+import time
+import calendar
+import shutil
+import unicodedata
 from fbk_config import fbk_config
-from datetime import datetime
-from tzlocal import get_localzone
+from fbk_db import fbk_db
+from fbk_metrics import fbk_metrics
+from datetime import datetime, timezone
+
+# BeautifulSoup (bs4) and tzlocal are imported where they are used, so that a run that doesn't need them doesn't
+# pay for loading them. bs4 is optional: only sanitize_publish and the "soup" renderer need it.
+def import_soup( feature ):
+	try:
+		import bs4
+	except ImportError:
+		print("%s requires BeautifulSoup (bs4) to be installed. Exiting." % feature)
+		sys.exit(1)
+
+	return bs4
 
 def write_outfile( contents, outfilepath, filename ):
 	outfile = open(os.path.join(outfilepath, filename), 'w')
 	outfile.write( contents )
 	outfile.close()
 
-def transform(o_post):
-	ts = datetime.strptime(o_post[2], "%Y-%m-%dT%H:%M:%S%z")
+# transform() used to run strptime, astimezone and five strftimes for every post. Posts now carry their epoch (or
+# it is sliced out of created_timestamp), and the rest is cached: the zone's offset and name per UTC day, and the
+# strings for each local day and hour of the day.
+tz_offset_cache = {}
+local_day_cache = {}
+local_hour_cache = {}
+
+transform_timer = fbk_metrics.timer('transform')
+
+# (epoch, isoformat()) for a Graph timestamp such as 2014-03-04T18:20:00+0000. The epoch is only worked out if it
+# isn't already known.
+def parse_timestamp( str_ts, epoch=None ):
+	if len(str_ts) == 24 and str_ts[19] in '+-':
+		if epoch is None:
+			offset = int(str_ts[20:22]) * 3600 + int(str_ts[22:24]) * 60
+			if str_ts[19] == '-':
+				offset = -offset
+
+			epoch = calendar.timegm( (int(str_ts[0:4]), int(str_ts[5:7]), int(str_ts[8:10]),
+				int(str_ts[11:13]), int(str_ts[14:16]), int(str_ts[17:19])) ) - offset
+
+		return (epoch, "%s:%s" % (str_ts[:22], str_ts[22:24]))
+
+	ts = datetime.strptime(str_ts, "%Y-%m-%dT%H:%M:%S%z")
+	return (int(ts.timestamp()), ts.isoformat())
+
+# local_tz's (utcoffset in seconds, tzname) at epoch
+def tz_offset( epoch ):
+	day = epoch // 86400
+	key = (local_tz, day)
+
+	if key in tz_offset_cache:
+		return tz_offset_cache[key]
+
+	ts = datetime.fromtimestamp(epoch, local_tz)
+	offset = (int(ts.utcoffset().total_seconds()), ts.strftime("%Z"))
 
-	zts = ts.isoformat()		
+	# Only cached for days the offset doesn't change in
+	if offset[0] == datetime.fromtimestamp(day * 86400, local_tz).utcoffset().total_seconds() == \
+			datetime.fromtimestamp(day * 86400 + 86399, local_tz).utcoffset().total_seconds():
+		tz_offset_cache[key] = offset
 
-	ts = ts.astimezone( local_tz )
+	return offset
 
-	dy = ts.strftime("%e").strip()
-	hr = ts.strftime("%l").strip()
-	ap = ts.strftime("%p").lower()
+def local_day( day ):
+	if day not in local_day_cache:
+		ts = datetime.fromtimestamp(day * 86400, timezone.utc)
+		dy = ts.strftime("%e").strip()
 
-	nixts = ts.strftime("%s")
-	strts = ts.strftime("%A, %B " + dy + ", %Y at " + hr + ":%M" + ap + " %Z")
-	sants = ts.strftime("%B " + dy + ", %Y at " + hr + ":%M " + ap )
+		local_day_cache[day] = {
+			'long'	: ts.strftime("%A, %B " + dy + ", %Y"),
+			'short'	: ts.strftime("%B " + dy + ", %Y"),
+			'date'	: ts.strftime("%Y%m%d"),
+		}
 
-	dt = ts.strftime("%Y%m%d")
+	return local_day_cache[day]
 
-	msg = o_post[1].replace('\n', '<br />\n')
+def local_hour( hour ):
+	if hour not in local_hour_cache:
+		ts = datetime.fromtimestamp(hour * 3600, timezone.utc)
+		local_hour_cache[hour] = (ts.strftime("%l").strip(), ts.strftime("%p").lower())
 
+	return local_hour_cache[hour]
+
+# Posts are rows of fbk_id, message, created_timestamp, privacy_description and (optionally) created_epoch
+def transform(o_post):
+	start = time.perf_counter()
+	(epoch, zts) = parse_timestamp(o_post[2], o_post[4] if len(o_post) > 4 else None)
+
+	(offset, tzname) = tz_offset(epoch)
+	local = epoch + offset
+
+	day = local_day(local // 86400)
+	(hr, ap) = local_hour(local // 3600 % 24)
+	mn = local // 60 % 60
+
+	strts = "%s at %s:%02d%s %s" % (day['long'], hr, mn, ap, tzname)
+	sants = "%s at %s:%02d %s" % (day['short'], hr, mn, ap)
+
+	msg = html.escape(o_post[1], False).replace('\n', '<br />\n')
+
+	transform_timer.add(time.perf_counter() - start)
 
 	return {
 		'fbk_id' 		: o_post[0],
@@ -75,41 +154,84 @@ def transform(o_post):
 		'privacy_description'	: o_post[2],
 		'formatted_timestamp'	: strts,
 		'sanitized_timestamp'	: sants,
-		'unix_timestamp'	: int(nixts),
-		'date'			: dt,
+		'unix_timestamp'	: epoch,
+		'date'			: day['date'],
 	}
 
+# Where the children of a tag start in the document it was parsed from (just past its opening tag), using the
+# position html.parser records for each tag.
+def source_offset( source, tag ):
+	offset = 0
+	for line in range(tag.sourceline - 1):
+		offset = source.index('\n', offset) + 1
+	offset += tag.sourcepos
+
+	quote = None
+	while offset < len(source):
+		c = source[offset]
+		offset += 1
+
+		if quote:
+			if c == quote:
+				quote = None
+		elif c in '"\'':
+			quote = c
+		elif c == '>':
+			return offset
+
+	return offset
+
 # This is called sanitize_publish for a reason. It will _ONLY_ operate properly on old-style Facebook export data
 # formats, which were supported by fbk_sanitize. I hope that this method will go away completely in the future.
+#
+# The old wall.html is copied through as-is; BeautifulSoup is only used to find where #content starts, and the
+# posts are written out there one row at a time.
 def sanitize_publish(fname):
 
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
+	cxn = connect()
 	cur = cxn.cursor()
 
 	f = open(fname, 'r')
-	soup = BeautifulSoup( f.read(), "html.parser" )
+	source = f.read()
 	f.close()
 
-	if obj_config['graph']['merge_compat_id']:
-		cur.execute("SELECT `created_timestamp` FROM `posts` WHERE `id`=?", (obj_config['graph']['merge_compat_id'],))
-		source_merge_timestamp = int(datetime.strptime(cur.fetchone()[0], "%Y-%m-%dT%H:%M:%S%z").strftime('%s'))
+	bs4 = import_soup("sanitize_publish")
+
+	content_tag = bs4.BeautifulSoup( source, "html.parser" ).find(id='content')
+	if not content_tag:
+		print("No suitable content ID found in the source document. Exiting.")
+		sys.exit(7)
 
+	content_offset = source_offset(source, content_tag)
 
-	sql_fetch_query = """SELECT `fbk_id`,`message`,`created_timestamp`,`privacy_description` FROM `posts` WHERE `privacy_description`='Public' AND `type`='status' 
-	ORDER BY `created_timestamp` DESC"""
+	source_merge_timestamp = None
+	if obj_config.graph.merge_compat_id is not None:
+		cur.execute("SELECT `created_epoch` FROM `posts` WHERE `id`=?", (obj_config.graph.merge_compat_id,))
+		source_merge_timestamp = cur.fetchone()[0]
+
+	# Only posts newer than the merge point; the rest are already in the old wall.html
+	sql_merge_where = ''
+	sql_params = ()
+	if source_merge_timestamp:
+		sql_merge_where = "AND `created_epoch` > ?"
+		sql_params = (source_merge_timestamp,)
+
+	sql_fetch_query = """SELECT `fbk_id`,`message`,`created_timestamp`,`privacy_description`,`created_epoch` FROM `posts` WHERE %s
+	%s
+	ORDER BY `created_epoch` DESC""" % (published_where(), sql_merge_where)
 	
-	cur.execute(sql_fetch_query)
+	cur.execute(sql_fetch_query, sql_params)
 
-	posts = []
-	for post in cur.fetchall():
-		p = transform(post)
+	str_outfile_dt = datetime.now().strftime('%Y-%m-%d_%H_%M_%S')
+	dest_path = "wall-%s.html" % str_outfile_dt
 
-		if not source_merge_timestamp or p['unix_timestamp'] > source_merge_timestamp:
-			posts.append( transform(post) )
+	outfile = open(dest_path, 'w')
+	outfile.write( source[:content_offset] )
+
+	for post in cur:
+		p = transform(post)
 
-	str_posts = ''
-	for p in posts:
-		str_posts = str_posts +  """<div class="feedentry hentry" id="fb_%s">
+		outfile.write( """<div class="feedentry hentry" id="fb_%s">
 		         <span class="author vcard">
 		          <span class="profile fn">
 		           %s
@@ -123,56 +245,103 @@ def sanitize_publish(fname):
 		           %s
 		          </time>
 		         </div>
-		        </div>""" % (p['fbk_id'], obj_config['name'], p['message'], p['date'], p['created_timestamp'], p['sanitized_timestamp'])
+		        </div>""" % (p['fbk_id'], obj_config.name, p['message'], p['date'], p['created_timestamp'], p['sanitized_timestamp']) )
 
-
-	cxn.close()
+	outfile.write( source[content_offset:] )
+	outfile.close()
 
 
-	content_tag = soup.find(id='content') 
-	if not content_tag:
-		print("No suitable content ID found in the source document. Exiting.")
-		sys.exit(7)
+# The markup publish() writes, filled in with %-formatting. Posts are written out one at a time as they come off the
+# cursor, so the page is never held in memory.
+wall_head_template = """<html>
+ <head>
+  <title>%(name)s — Wall</title>
+  <meta charset="utf-8"/>
+  <link href="style.css" rel="stylesheet" type="text/css"/>
+ </head>
+ <body>
+  <table id="main"><thead></thead><tfoot></tfoot><tbody></tbody></table>
+  <h1>%(name)s%(tagline)s</h1>
+"""
+
+wall_tagline_template = """<span id="tagline">%s</span>"""
+
+wall_content_head = """<div id="content">
+"""
+
+wall_post_template = """<div class="feedentry hentry" id="fb_%(fbk_id)s">
+ <span class="author vcard"><span class="fn profile">%(name)s</span></span>
+ <span class="entry-title entry-content">%(message)s</span>
+ <div class="timerow">
+  <time class="time published" data-date="%(date)s" title="%(created_timestamp)s">%(sanitized_timestamp)s</time>
+ </div>
+</div>
+"""
+
+wall_content_tail = """<!--Generated by fbk_utils %s-->
+</div>
+"""
+
+wall_tail = """ </body>
+</html>
+"""
+
+def render_post( p, name ):
+	p['name'] = name
+	p['fbk_id'] = html.escape(p['fbk_id'])
+
+	return wall_post_template % p
+
+# A post's row in publish_fragment
+def render_fragment( post, h, name ):
+	return { 'fbk_id' : post[0], 'hash' : h, 'fragment' : render_post(transform(post), name) }
+
+# Writes the page around already-rendered posts
+def write_wall( fragments, outfile, full, now ):
+	if full:
+		tagline = ''
+		if obj_config.tagline:
+			tagline = wall_tagline_template % html.escape(obj_config.tagline)
 
-	posts = BeautifulSoup("<div>" + str_posts + "</div>", "html.parser").find('div').contents + content_tag.contents
-	#posts = content_tag.contents
-	#posts = BeautifulSoup("<div id='contents'>" + str_posts + "</div>").find('div').contents
+		outfile.write( wall_head_template % { 'name' : html.escape(obj_config.name), 'tagline' : tagline } )
 
-	content_tag.contents = posts
+	outfile.write( wall_content_head )
 
-	str_outfile_dt = datetime.now().strftime('%Y-%m-%d_%H_%M_%S')
-	dest_path = "wall-%s.html" % str_outfile_dt
-	write_outfile(soup.prettify(), '', dest_path)
+	for fragment in fragments:
+		outfile.write( fragment )
 
+	outfile.write( wall_content_tail % now.isoformat() )
 
-def publish(fname, full=True):
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
-	cur = cxn.cursor()
-	local_tz = get_localzone() 
+	if full:
+		outfile.write( wall_tail )
 
+def render_template( posts, outfile, full, now ):
+	name = html.escape(obj_config.name)
 
-	sql_fetch_query = """SELECT `fbk_id`,`message`,`created_timestamp`,`privacy_description` FROM `posts` WHERE `privacy_description`='Public' AND `type`='status' 
-	ORDER BY `created_timestamp` DESC"""
-	cur.execute(sql_fetch_query)
+	write_wall( (render_post(transform(post), name) for post in posts), outfile, full, now )
 
+# The original renderer: builds the whole page as a BeautifulSoup tree, one parsed fragment per post
+def render_soup( posts, outfile, full, now ):
+	bs4 = import_soup("The soup renderer")
+	BeautifulSoup = bs4.BeautifulSoup
 
 	soup = BeautifulSoup( """<html><head><title>%s — Wall</title>
 			<meta charset="utf-8">
 			<link rel="stylesheet" href="style.css" type="text/css">
 			</head>
-			<body><table id="main"><thead /><tfoot /><tbody /></table></body></html>""" % obj_config['name'], "html.parser")
+			<body><table id="main"><thead /><tfoot /><tbody /></table></body></html>""" % html.escape(obj_config.name), "html.parser")
 
 	body = soup.find('body')
 
 	h1 = soup.new_tag('h1')
-	h1.string = obj_config['name']
+	h1.string = obj_config.name
 
-	if obj_config['tagline']:
+	if obj_config.tagline:
 		
 
 		span = soup.new_tag('span')
 		span['id'] = "tagline"
-		span.string = obj_config['tagline']
+		span.string = obj_config.tagline
 
 		h1.append(span)
 
@@ -183,7 +352,7 @@ def publish(fname, full=True):
 	main = main_body.find(id='content')
 
 
-	for post in cur.fetchall():
+	for post in posts:
 
 		p = transform(post)
 
@@ -195,32 +364,682 @@ def publish(fname, full=True):
 	        %s
 	        </time>
 	        </div>
-			</div>""" % (p['fbk_id'], obj_config['name'], p['message'], p['created_timestamp'], p['date'], p['sanitized_timestamp']), "html.parser" )
+			</div>""" % (html.escape(p['fbk_id']), html.escape(obj_config.name), p['message'], p['created_timestamp'], p['date'], p['sanitized_timestamp']), "html.parser" )
 
 
 		main.append(soup_post)
 
-	now = datetime.now(local_tz)
-	fbk_util_comment = soup.new_string("Generated by fbk_utils %s" % now.isoformat(), Comment)
+	fbk_util_comment = soup.new_string("Generated by fbk_utils %s" % now.isoformat(), bs4.Comment)
 	main.append(fbk_util_comment)
 
 	if full:
 		body.append(main_body)
-		write_outfile( soup.prettify(), '.', 'wall-full.html' )
+		outfile.write( soup.prettify() )
 	else:
-		write_outfile( main_body.prettify(), '.', 'wall-posts.html' )
+		outfile.write( main_body.prettify() )
 
-	cxn.close()
+renderers = {
+	'template'	: render_template,
+	'soup'		: render_soup,
+}
 
-	return
+# The posts that get published: public statuses, less any that fall in the config's timefilter. Queries using it
+# need the fbk_timefiltered() function, which connect() registers.
+def published_where( alias='' ):
+	where = "%s`privacy_description`='Public' AND %s`type`='status'" % (alias, alias)
+	if obj_config.timefilter:
+		where += " AND NOT fbk_timefiltered(%s`created_epoch`)" % alias
 
-# Main()
-if __name__ == "__main__":
-	global local_tz
+	return where
 
-	# Process arguments
-	parser = argparse.ArgumentParser(description='Publish content from _fetch to html pages')
+def connect( ):
+	cxn = fbk_db.connect(config_dir)
+	cxn.create_function('fbk_timefiltered', 1, lambda epoch: epoch in obj_config.timefilter, deterministic=True)
+
+	return cxn
+
+# Everything besides the post itself that ends up in its markup. A change to any of it re-renders every post.
+def fragment_salt( ):
+	return hashlib.sha1( ("%s\0%s\0%s" % (obj_config.name, local_tz, wall_post_template)).encode('utf-8') ).hexdigest()
+
+# Everything on a page besides its posts: a change to any of it rewrites the page, though no post is rendered again
+def page_salt( ):
+	return "\0".join( (obj_config.name, obj_config.tagline, wall_head_template, wall_tagline_template, wall_content_head,
+		wall_content_tail, wall_tail, wall_index_head, wall_index_item_template, wall_index_tail) )
+
+def fragment_hash( post, salt ):
+	return hashlib.sha1( ("%s\0%s\0%s\0%s" % (post[0], post[1], post[2], salt)).encode('utf-8') ).hexdigest()
+
+# Stores newly rendered posts, and forgets those that are no longer public
+def save_fragments( cxn, fragments ):
+	cur = cxn.cursor()
+
+	# SQL
+	sql_fragment_upsert = """INSERT INTO publish_fragment
+	(`fbk_id`, `hash`, `fragment`)
+	VALUES
+	(:fbk_id, :hash, :fragment)
+	ON CONFLICT(`fbk_id`) DO UPDATE SET `hash`=excluded.`hash`, `fragment`=excluded.`fragment`
+	;"""
+	# END SQL
+	cur.executemany( sql_fragment_upsert, fragments )
+
+	# SQL
+	sql_fragment_prune = """DELETE FROM publish_fragment WHERE `fbk_id` NOT IN
+	(SELECT `fbk_id` FROM `posts` WHERE %s)""" % published_where()
+	# END SQL
+	cur.execute( sql_fragment_prune )
+
+# Incremental publish: posts are only rendered when they are new or have changed since they were last rendered
+# (publish_fragment), and the output is only rewritten when the list of posts differs from its last build
+# (publish_build). Returns the number of posts rendered, or None if the output was already up to date.
+def publish_incremental( cxn, filename, full, now ):
+	cur = cxn.cursor()
+	output = os.path.abspath(filename)
+	salt = fragment_salt()
+	name = html.escape(obj_config.name)
+
+	# SQL
+	sql_fetch_query = """SELECT p.`fbk_id`, p.`message`, p.`created_timestamp`, p.`privacy_description`, p.`created_epoch`, f.`hash`
+	FROM `posts` p LEFT JOIN `publish_fragment` f ON f.`fbk_id`=p.`fbk_id`
+	WHERE %s
+	ORDER BY p.`created_epoch` DESC""" % published_where('p.')
+	# END SQL
+	cur.execute(sql_fetch_query)
+
+	digest = hashlib.sha1( page_salt().encode('utf-8') )
+	posts = 0
+	stale = []
+	for post in cur:
+		h = fragment_hash(post, salt)
+		digest.update(h.encode('ascii'))
+		posts += 1
+
+		if h != post[5]:
+			stale.append( (post[:5], h) )
+
+	digest = digest.hexdigest()
+
+	cur.execute("SELECT `digest` FROM `publish_build` WHERE `output`=?", (output,))
+	last_build = cur.fetchone()
+
+	if not stale and last_build and last_build[0] == digest and os.path.exists(output):
+		return None
+
+	with fbk_metrics.timed('render'):
+		fragments = [ render_fragment(post, h, name) for (post, h) in stale ]
+	fbk_metrics.count('posts_rendered', len(fragments))
+
+	with fbk_metrics.timed('sqlite_write'):
+		save_fragments( cxn, fragments )
+
+	# SQL
+	sql_fragment_query = """SELECT f.`fragment` FROM `posts` p JOIN `publish_fragment` f ON f.`fbk_id`=p.`fbk_id`
+	WHERE %s
+	ORDER BY p.`created_epoch` DESC""" % published_where('p.')
+	# END SQL
+	cur.execute( sql_fragment_query )
+
+	# Written alongside and renamed over the old output, so a reader never sees half a page
+	with fbk_metrics.timed('render'):
+		outfile = open(output + '.tmp', 'w', encoding='utf-8')
+		write_wall( (row[0] for row in cur), outfile, full, now )
+		outfile.close()
+		os.replace(output + '.tmp', output)
+
+	cur.execute("INSERT OR REPLACE INTO publish_build (`output`, `digest`, `posts`, `rendered`, `datetime_built`) VALUES (?, ?, ?, ?, ?)",
+		(output, digest, posts, len(fragments), int(time.time())))
+	cxn.commit()
+
+	return len(fragments)
+
+def mktreeoutput( basedirname ):
+	file_path = '.'
+	# Create the base filename (if it doesn't exist)
+	if( not os.path.exists(os.path.join(os.path.dirname(file_path), basedirname)) ):
+		os.mkdir( os.path.join(os.path.dirname(file_path), basedirname) )
+
+	# Set up the date-stampped html directory
+	str_outfile_dt = datetime.now().strftime('%Y-%m-%d_%H_%M_%S')
+	outfile_path = os.path.join(os.path.dirname(file_path), basedirname, "html-" + str_outfile_dt)
+
+	# Two publishes in the same second
+	n = 1
+	while os.path.exists(outfile_path):
+		n += 1
+		outfile_path = os.path.join(os.path.dirname(file_path), basedirname, "html-%s-%s" % (str_outfile_dt, n))
+
+	os.mkdir( outfile_path )
+
+	return outfile_path
+
+# --shards is either "month" or a number of posts per page
+def shard_scheme( str_scheme ):
+	if str_scheme == 'month':
+		return str_scheme
+
+	if str_scheme.isdigit() and int(str_scheme) > 0:
+		return int(str_scheme)
+
+	raise argparse.ArgumentTypeError("expected \"month\" or a number of posts, not %r" % str_scheme)
+
+# The local date of a post, as transform() puts it in 'date'
+def local_date( epoch ):
+	return local_day( (epoch + tz_offset(epoch)[0]) // 86400 )['date']
+
+wall_index_head = """<ul id="index">
+"""
+
+wall_index_item_template = """<li><a href="%(filename)s">%(label)s</a> (%(posts)s posts)</li>
+"""
+
+wall_index_tail = """</ul>
+<!--Generated by fbk_utils %s-->
+"""
+
+def shard_filename( shard ):
+	return "wall-%s.html" % shard
+
+def shard_label( scheme, shard, posts ):
+	if scheme == 'month':
+		return datetime.strptime(shard, "%Y%m").strftime("%B %Y")
+
+	first = int(shard) * scheme + 1
+	return "Posts %s to %s" % (first, first + posts - 1)
 
+def init_shard_worker( worker_config, worker_tz ):
+	global obj_config, local_tz
+
+	obj_config = worker_config
+	local_tz = worker_tz
+
+# Runs in a worker process: writes one shard, rendering the posts that don't have a cached fragment. Returns the
+# newly rendered fragments, for the parent to store.
+def render_shard( path, entries, now ):
+	name = html.escape(obj_config.name)
+	fragments = []
+	markup = []
+
+	for (post, h, fragment) in entries:
+		if fragment is None:
+			rendered = render_fragment(post, h, name)
+			fragments.append(rendered)
+			fragment = rendered['fragment']
+
+		markup.append(fragment)
+
+	outfile = open(path, 'w', encoding='utf-8')
+	write_wall( markup, outfile, True, now )
+	outfile.close()
+
+	return fragments
+
+# Sharded publish: one page per month (or per fixed number of posts, counted from the oldest so that new posts only
+# ever touch the last page) and an index, in a new datestamped tree under basedirname. Only shards whose posts have
+# changed since they were last built are rendered, in a process pool; the rest are linked from the tree they were
+# last written to. Returns the tree, or None if nothing had changed.
+def publish_sharded( cxn, scheme, workers, now ):
+	cur = cxn.cursor()
+	str_scheme = scheme if scheme == 'month' else "posts-%s" % scheme
+	salt = fragment_salt()
+
+	# SQL
+	sql_fetch_query = """SELECT p.`fbk_id`, p.`message`, p.`created_timestamp`, p.`privacy_description`, p.`created_epoch`, f.`hash`
+	FROM `posts` p LEFT JOIN `publish_fragment` f ON f.`fbk_id`=p.`fbk_id`
+	WHERE %s
+	ORDER BY p.`created_epoch` ASC""" % published_where('p.')
+	# END SQL
+	cur.execute(sql_fetch_query)
+
+	# shard -> [(fbk_id, post if it needs rendering else None, hash), ...]
+	shards = {}
+	for (rank, post) in enumerate(cur):
+		if scheme == 'month':
+			shard = local_date(post[4])[:6]
+		else:
+			shard = "%05d" % (rank // scheme)
+
+		h = fragment_hash(post, salt)
+		shards.setdefault(shard, []).append( (post[0], post[:5] if h != post[5] else None, h) )
+
+	# Newest first, as on the wall
+	for entries in shards.values():
+		entries.reverse()
+
+	cur.execute("SELECT `shard`, `digest`, `path` FROM `publish_shard` WHERE `scheme`=?", (str_scheme,))
+	built = { row[0] : row[1:] for row in cur.fetchall() }
+
+	digests = {}
+	touched = []
+	shard_salt = page_salt().encode('utf-8')
+	for (shard, entries) in shards.items():
+		digest = hashlib.sha1( shard_salt )
+		for (fbk_id, post, h) in entries:
+			digest.update(h.encode('ascii'))
+		digests[shard] = digest.hexdigest()
+
+		if shard not in built or built[shard][0] != digests[shard] or not os.path.exists(built[shard][1]):
+			touched.append(shard)
+
+	if not touched and set(built) == set(shards):
+		return None
+
+	basedirname = obj_config.graph.basedirname
+
+	outfile_path = mktreeoutput(basedirname)
+
+	for shard in set(shards) - set(touched):
+		path = os.path.join(outfile_path, shard_filename(shard))
+		try:
+			os.link(built[shard][1], path)
+		except OSError:
+			shutil.copy2(built[shard][1], path)
+
+	# The touched shards' cached fragments, for the posts that haven't changed
+	jobs = []
+	for shard in touched:
+		fbk_ids = [ fbk_id for (fbk_id, post, h) in shards[shard] if post is None ]
+		cur.execute("SELECT `fbk_id`, `fragment` FROM `publish_fragment` WHERE `fbk_id` IN (SELECT `value` FROM json_each(?))",
+			(json.dumps(fbk_ids),))
+		cached = dict(cur.fetchall())
+
+		entries = [ (post, h, cached.get(fbk_id)) for (fbk_id, post, h) in shards[shard] ]
+		jobs.append( (shard, os.path.join(outfile_path, shard_filename(shard)), entries) )
+
+	fragments = []
+	with fbk_metrics.timed('render'):
+		if workers > 1 and len(jobs) > 1:
+			from concurrent.futures import ProcessPoolExecutor
+
+			with ProcessPoolExecutor(max_workers=workers, initializer=init_shard_worker, initargs=(obj_config, local_tz)) as executor:
+				for rendered in executor.map(render_shard, [job[1] for job in jobs], [job[2] for job in jobs], [now] * len(jobs)):
+					fragments.extend(rendered)
+		else:
+			for (shard, path, entries) in jobs:
+				fragments.extend( render_shard(path, entries, now) )
+	fbk_metrics.count('posts_rendered', len(fragments))
+
+	with fbk_metrics.timed('sqlite_write'):
+		save_fragments( cxn, fragments )
+
+	outfile = open(os.path.join(outfile_path, 'index.html'), 'w', encoding='utf-8')
+	tagline = ''
+	if obj_config.tagline:
+		tagline = wall_tagline_template % html.escape(obj_config.tagline)
+	outfile.write( wall_head_template % { 'name' : html.escape(obj_config.name), 'tagline' : tagline } )
+	outfile.write( wall_index_head )
+	for shard in sorted(shards, reverse=True):
+		outfile.write( wall_index_item_template % { 'filename' : shard_filename(shard),
+			'label' : shard_label(scheme, shard, len(shards[shard])), 'posts' : len(shards[shard]) } )
+	outfile.write( wall_index_tail % now.isoformat() )
+	outfile.write( wall_tail )
+	outfile.close()
+
+	cur.execute("DELETE FROM `publish_shard` WHERE `scheme`=?", (str_scheme,))
+	cur.executemany("INSERT INTO publish_shard (`scheme`, `shard`, `digest`, `posts`, `path`, `datetime_built`) VALUES (?, ?, ?, ?, ?, ?)",
+		[ (str_scheme, shard, digests[shard], len(shards[shard]), os.path.abspath(os.path.join(outfile_path, shard_filename(shard))), int(time.time()))
+			for shard in shards ])
+	cxn.commit()
+
+	print("Rebuilt %s of %s shards (%s posts rendered)" % (len(touched), len(shards), len(fragments)))
+
+	return outfile_path
+
+# The client-side search index (-X): an inverted index of the wall's posts under search/, next to the wall, with a
+# static page that searches it in the browser. Terms are sharded by their first two characters (t/<shard>.json,
+# each term's posts newest first) and the posts' entries by id (d/<id / search_docs_per_shard>.json), so a search
+# only downloads the few files its words need. Only the files that a changed post touches are written again.
+search_docs_per_shard = 1000
+search_excerpt_length = 160
+search_index_version = 2
+search_term_length = 32
+
+search_term_re = re.compile(r'\w+')
+search_shard_re = re.compile(r'[a-z0-9]+')
+
+# Lower case, without accents, at least 2 characters, and cut to the first search_term_length; the search page
+# splits queries the same way, so that a longer word is still found by its first characters
+def search_terms( message ):
+	text = (message or '').lower()
+	if not text.isascii():
+		text = "".join( c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c) )
+
+	return set( term[:search_term_length] for term in search_term_re.findall(text) if len(term) >= 2 )
+
+def search_shard( term ):
+	return term[:2]
+
+# Shards that aren't plain ASCII are named by their code points, to keep the file names portable
+def search_shard_name( shard ):
+	if search_shard_re.fullmatch(shard):
+		return shard
+
+	return 'u' + '-'.join( '%x' % ord(c) for c in shard )
+
+def search_excerpt( message ):
+	excerpt = " ".join((message or '').split())
+	if len(excerpt) > search_excerpt_length:
+		excerpt = excerpt[:search_excerpt_length].rstrip() + "…"
+
+	return excerpt
+
+def write_json_file( path, contents ):
+	outfile = open(path + '.tmp', 'w', encoding='utf-8')
+	outfile.write( contents )
+	outfile.close()
+	os.replace(path + '.tmp', path)
+
+def remove_file( path ):
+	if os.path.exists(path):
+		os.remove(path)
+
+wall_search_template = """<html>
+ <head>
+  <title>%(name)s — Search</title>
+  <meta charset="utf-8"/>
+  <link href="../style.css" rel="stylesheet" type="text/css"/>
+ </head>
+ <body>
+  <h1>%(name)s</h1>
+  <form id="search"><input id="q" type="search" autofocus="autofocus"/></form>
+  <p id="status"></p>
+  <div id="content"></div>
+  <p><a id="more" href="#" hidden="hidden">More</a></p>
+  <script>
+(function() {
+	var meta = null, shards = {}, docs = {}, hits = [], shown = 0, pageSize = 50;
+	var q = document.getElementById('q'), status = document.getElementById('status');
+	var content = document.getElementById('content'), more = document.getElementById('more');
+
+	function get(url) {
+		return fetch(url).then(function(r) {
+			if (!r.ok) throw new Error(url + ': ' + r.status);
+			return r.json();
+		});
+	}
+
+	// As search_terms() in fbk_publish_3.py
+	function terms(query) {
+		var found = query.toLowerCase().normalize('NFKD').replace(/\\p{M}/gu, '').match(/[\\p{L}\\p{N}_]+/gu) || [];
+		found = found.map(function(t) { return Array.from(t); }).filter(function(t) { return t.length >= 2; })
+			.map(function(t) { return t.slice(0, %(term_length)s).join(''); });
+		return found.filter(function(t, i) { return found.indexOf(t) == i; });
+	}
+
+	function shardName(shard) {
+		if (/^[a-z0-9]+$/.test(shard)) return shard;
+		return 'u' + Array.from(shard).map(function(c) { return c.codePointAt(0).toString(16); }).join('-');
+	}
+
+	function postings(term) {
+		var name = shardName(Array.from(term).slice(0, 2).join(''));
+		if (meta.shards.indexOf(name) < 0) return Promise.resolve([]);
+		if (!shards[name]) shards[name] = get('t/' + name + '.json');
+		return shards[name].then(function(shard) { return shard[term] || []; });
+	}
+
+	function entries(ids) {
+		var names = [];
+		ids.forEach(function(id) {
+			var name = Math.floor(id / meta.docs_per_shard);
+			if (!docs[name]) docs[name] = get('d/' + name + '.json');
+			if (names.indexOf(name) < 0) names.push(name);
+		});
+		return Promise.all(names.map(function(name) { return docs[name]; })).then(function(loaded) {
+			var all = Object.assign.apply(null, [{}].concat(loaded));
+			return ids.map(function(id) { return all[id]; });
+		});
+	}
+
+	function showMore() {
+		var ids = hits.slice(shown, shown + pageSize);
+		shown += ids.length;
+		more.hidden = shown >= hits.length;
+
+		return entries(ids).then(function(found) {
+			found.forEach(function(entry) {
+				var post = document.createElement('div'), link = document.createElement('a'), text = document.createElement('span');
+				post.className = 'feedentry hentry';
+				link.href = meta.page + '#fb_' + entry[0];
+				link.textContent = entry[1];
+				text.className = 'entry-title entry-content';
+				text.textContent = ' ' + entry[2];
+				post.appendChild(link);
+				post.appendChild(text);
+				content.appendChild(post);
+			});
+		});
+	}
+
+	// Every word must appear. Posts come newest first, in the order of the rarest word's list.
+	function search() {
+		var words = terms(q.value);
+		content.textContent = '';
+		hits = [];
+		shown = 0;
+		more.hidden = true;
+
+		if (!words.length) {
+			status.textContent = '';
+			return;
+		}
+
+		var query = q.value;
+		Promise.all(words.map(postings)).then(function(lists) {
+			if (query != q.value) return;
+
+			lists.sort(function(a, b) { return a.length - b.length; });
+			var others = lists.slice(1).map(function(list) { return new Set(list); });
+			hits = lists[0].filter(function(id) { return others.every(function(s) { return s.has(id); }); });
+
+			status.textContent = hits.length + (hits.length == 1 ? ' post' : ' posts');
+			return showMore();
+		}).catch(function(e) { status.textContent = e.message; });
+	}
+
+	var timer = null;
+	q.addEventListener('input', function() {
+		clearTimeout(timer);
+		timer = setTimeout(search, 150);
+	});
+	document.getElementById('search').addEventListener('submit', function(e) { e.preventDefault(); search(); });
+	more.addEventListener('click', function(e) { e.preventDefault(); showMore(); });
+
+	get('meta.json').then(function(m) {
+		meta = m;
+		if (q.value) search();
+	}).catch(function(e) { status.textContent = e.message; });
+})();
+  </script>
+ </body>
+</html>
+"""
+
+# Brings the search index under outdir up to date with the wall's posts, for a wall written to page. Returns the
+# number of posts (re)indexed and the number of files written, or None if the index was already up to date.
+def publish_search_index( cxn, outdir, page ):
+	cur = cxn.cursor()
+	salt = "%s\0%s" % (search_index_version, local_tz)
+
+	# The search page only needs writing again when what goes into it changes; the build's digest carries both
+	search_page = wall_search_template % { 'name' : html.escape(obj_config.name), 'term_length' : search_term_length }
+	build_digest = "%s\0%s" % (salt, hashlib.sha1(search_page.encode('utf-8')).hexdigest())
+	build = "search:%s" % os.path.abspath(outdir)
+
+	# SQL
+	sql_fetch_query = """SELECT p.`id`, p.`fbk_id`, p.`message`, p.`created_timestamp`, p.`privacy_description`, p.`created_epoch`, d.`hash`
+	FROM `posts` p LEFT JOIN `search_doc` d ON d.`posts_id`=p.`id`
+	WHERE %s""" % published_where('p.')
+	# END SQL
+	cur.execute(sql_fetch_query)
+
+	indexed = set()
+	changed = []
+	for row in cur:
+		indexed.add(row[0])
+
+		h = hashlib.sha1( ("%s\0%s\0%s" % (row[2], row[3], salt)).encode('utf-8') ).hexdigest()
+		if h != row[6]:
+			changed.append( (row[:6], h) )
+
+	cur.execute("SELECT `posts_id` FROM `search_doc`")
+	removed = [ row[0] for row in cur.fetchall() if row[0] not in indexed ]
+
+	dirty_shards = set()
+	dirty_docs = set()
+
+	# SQL
+	sql_posting_insert = "INSERT INTO search_posting (`term`, `posts_id`, `created_epoch`) VALUES (?, ?, ?)"
+	sql_posting_delete = "DELETE FROM search_posting WHERE `term`=? AND `posts_id`=?"
+	sql_doc_upsert = """INSERT INTO search_doc (`posts_id`, `hash`, `entry`) VALUES (?, ?, ?)
+	ON CONFLICT(`posts_id`) DO UPDATE SET `hash`=excluded.`hash`, `entry`=excluded.`entry`"""
+	# END SQL
+
+	for posts_id in removed:
+		cur.execute("SELECT `term` FROM search_posting WHERE `posts_id`=?", (posts_id,))
+		dirty_shards.update( search_shard(row[0]) for row in cur.fetchall() )
+
+		cur.execute("DELETE FROM search_posting WHERE `posts_id`=?", (posts_id,))
+		cur.execute("DELETE FROM search_doc WHERE `posts_id`=?", (posts_id,))
+		dirty_docs.add(posts_id // search_docs_per_shard)
+
+	for (row, h) in changed:
+		(posts_id, fbk_id, message, created_epoch) = (row[0], row[1], row[2], row[5])
+
+		cur.execute("SELECT `term` FROM search_posting WHERE `posts_id`=?", (posts_id,))
+		old_terms = set( r[0] for r in cur.fetchall() )
+		new_terms = search_terms(message)
+
+		cur.executemany( sql_posting_delete, [ (term, posts_id) for term in old_terms - new_terms ] )
+		cur.executemany( sql_posting_insert, [ (term, posts_id, created_epoch) for term in new_terms - old_terms ] )
+		dirty_shards.update( search_shard(term) for term in old_terms ^ new_terms )
+
+		p = transform(row[1:])
+		entry = json.dumps( [fbk_id, p['sanitized_timestamp'], search_excerpt(message)], ensure_ascii=False, separators=(',', ':') )
+		cur.execute( sql_doc_upsert, (posts_id, h, entry) )
+		dirty_docs.add(posts_id // search_docs_per_shard)
+
+	# Written somewhere new (or last built into another directory): every file has to be written
+	cur.execute("SELECT `digest` FROM `publish_build` WHERE `output`=?", (build,))
+	last_build = cur.fetchone()
+	everything = not last_build or last_build[0].rpartition('\0')[0] != salt or not os.path.exists(os.path.join(outdir, 'meta.json'))
+	page_changed = not last_build or last_build[0] != build_digest
+
+	if everything:
+		cur.execute("SELECT `shard` FROM search_shard")
+		dirty_shards.update( row[0] for row in cur.fetchall() )
+
+		cur.execute("SELECT DISTINCT `posts_id` / ? FROM search_doc", (search_docs_per_shard,))
+		dirty_docs.update( row[0] for row in cur.fetchall() )
+
+		for subdir in ('t', 'd'):
+			os.makedirs(os.path.join(outdir, subdir), exist_ok=True)
+
+	if everything or page_changed:
+		write_json_file( os.path.join(outdir, 'index.html'), search_page )
+
+	if not everything and not dirty_shards and not dirty_docs and not page_changed:
+		return None
+
+	# SQL
+	sql_shard_query = """SELECT `term`, `posts_id` FROM search_posting WHERE `term` >= ? AND `term` < ?
+	ORDER BY `term`, `created_epoch` DESC"""
+	# END SQL
+
+	for shard in dirty_shards:
+		path = os.path.join(outdir, 't', search_shard_name(shard) + '.json')
+
+		cur.execute( sql_shard_query, (shard, shard + '\U0010ffff') )
+		terms = {}
+		postings = 0
+		for (term, posts_id) in cur:
+			terms.setdefault(term, []).append(posts_id)
+			postings += 1
+
+		if terms:
+			write_json_file( path, json.dumps(terms, ensure_ascii=False, separators=(',', ':')) )
+			cur.execute("INSERT OR REPLACE INTO search_shard (`shard`, `terms`, `postings`) VALUES (?, ?, ?)", (shard, len(terms), postings))
+		else:
+			remove_file(path)
+			cur.execute("DELETE FROM search_shard WHERE `shard`=?", (shard,))
+
+	for n in dirty_docs:
+		path = os.path.join(outdir, 'd', '%s.json' % n)
+
+		cur.execute("SELECT `posts_id`, `entry` FROM search_doc WHERE `posts_id` >= ? AND `posts_id` < ?",
+			(n * search_docs_per_shard, (n + 1) * search_docs_per_shard))
+		entries = [ '"%s":%s' % row for row in cur.fetchall() ]
+
+		if entries:
+			write_json_file( path, '{' + ','.join(entries) + '}' )
+		else:
+			remove_file(path)
+
+	cur.execute("SELECT `shard` FROM search_shard ORDER BY `shard`")
+	meta = {
+		'version' : search_index_version,
+		'page' : '../' + page,
+		'docs_per_shard' : search_docs_per_shard,
+		'shards' : [ search_shard_name(row[0]) for row in cur.fetchall() ],
+	}
+	write_json_file( os.path.join(outdir, 'meta.json'), json.dumps(meta, separators=(',', ':')) )
+
+	# Only one directory is kept up to date at a time
+	cur.execute("DELETE FROM `publish_build` WHERE `output` LIKE 'search:%'")
+	cur.execute("INSERT INTO publish_build (`output`, `digest`, `posts`, `rendered`, `datetime_built`) VALUES (?, ?, ?, ?, ?)",
+		(build, build_digest, len(indexed), len(changed) + len(removed), int(time.time())))
+	cxn.commit()
+
+	return (len(changed) + len(removed), len(dirty_shards) + len(dirty_docs))
+
+def publish(fname, full=True, renderer='template', incremental=False, shards=None, workers=1, search_index=False):
+	cxn = connect()
+	cur = cxn.cursor()
+
+	if full:
+		filename = 'wall-full.html'
+	else:
+		filename = 'wall-posts.html'
+
+	if shards:
+		outfile_path = publish_sharded( cxn, shards, workers, datetime.now(local_tz) )
+
+		if outfile_path is None:
+			print("No shards have changed since the last publish.")
+		else:
+			print("Published to %s" % outfile_path)
+
+		return
+
+	if incremental:
+		rendered = publish_incremental( cxn, os.path.join('.', filename), full, datetime.now(local_tz) )
+
+		if rendered is None:
+			print("%s is up to date." % filename)
+		else:
+			print("Rendered %s new or changed posts into %s" % (rendered, filename))
+	else:
+		sql_fetch_query = """SELECT `fbk_id`,`message`,`created_timestamp`,`privacy_description`,`created_epoch` FROM `posts` WHERE %s
+		ORDER BY `created_epoch` DESC""" % published_where()
+		cur.execute(sql_fetch_query)
+
+		with fbk_metrics.timed('render'):
+			outfile = open(os.path.join('.', filename), 'w', encoding='utf-8')
+			renderers[renderer]( cur, outfile, full, datetime.now(local_tz) )
+			outfile.close()
+
+	if search_index:
+		with fbk_metrics.timed('search_index'):
+			indexed = publish_search_index( cxn, os.path.join('.', 'search'), filename )
+
+		if indexed is None:
+			print("The search index is up to date.")
+		else:
+			print("Indexed %s new or changed posts; wrote %s search index files" % indexed)
+
+	return
+
+def add_arguments( parser ):
 	parser.add_argument('-f', '--config-file', metavar='CONFIG_FILE', 
 			help='A JSON-structured file containing configuration directives to use for the script')
 
@@ -231,39 +1050,74 @@ if __name__ == "__main__":
 	parser.add_argument('-P', '--posts-only', action="store_true",
 			help="""Output only the structured content of posts, in a minimal HTML document.""")
 
-	parser.add_argument('--version', action='version', version='%(prog)s 1.2')
+	parser.add_argument('-R', '--renderer', choices=sorted(renderers.keys()), default='template',
+			help="""How to render the posts: "template" (the default) streams them out through string templates,
+			"soup" builds the page with BeautifulSoup, as older versions did.""")
+
+	parser.add_argument('-i', '--incremental', action="store_true",
+			help="""Only render posts that are new or changed since the last publish, and leave the output alone
+			if nothing changed. Uses the template renderer.""")
+
+	parser.add_argument('-S', '--shards', metavar='SHARDS', type=shard_scheme,
+			help="""Write one page per month ("month") or per SHARDS posts, plus an index, into a new datestamped
+			directory under basedirname. Only pages with new or changed posts are rebuilt. Uses the template renderer.""")
+
+	parser.add_argument('-X', '--search-index', action="store_true",
+			help="""Also write a search index for the wall, and a page that searches it in the browser, into
+			search/. Only posts that are new or changed since the last publish are indexed again.""")
 
-	args = parser.parse_args()
+	parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+			help="""With --shards, the number of processes rendering pages (default: the number of CPUs)""")
 
+	parser.add_argument('--version', action='version', version='%(prog)s 1.2')
+
+# Sets the module's globals, as run() would; fbk_daemon_3 shares its config this way
+def configure( run_args, run_config_dir, run_obj_config ):
+	global args, config_dir, use_configdir, obj_config, local_tz
 
-	config_dir = ".fbk"
+	args = run_args
+	config_dir = run_config_dir
 	use_configdir = os.path.exists( config_dir )
+	obj_config = run_obj_config
 
-	if use_configdir == False:
-		config_dir = os.path.join( os.path.expanduser('~'), '.fbk' )
-		use_configdir = os.path.exists( config_dir )
+	from tzlocal import get_localzone
+	local_tz = get_localzone()
 
-	# Default obj_config
-	
-	file_configfile = None
-	if(args.config_file):
-		file_configfile = os.path.abspath(args.config_file)
-	elif( use_configdir and os.path.exists(os.path.join(config_dir, 'config.json'))):
-		file_configfile = os.path.join(config_dir, 'config.json')
+def run( run_args ):
+	config_dir = fbk_config.find_config_dir()
+
+	configure( run_args, config_dir, fbk_config.load_config(config_dir, run_args.config_file) )
+	fbk_config.require_account( obj_config, 'publish' )
 
-	if(file_configfile):
-		obj_config = fbk_config.parse_config( file_configfile )
+	if( (args.incremental or args.shards) and args.renderer != 'template' ):
+		print("--incremental and --shards only work with the template renderer")
+		sys.exit(1)
+
+	if( args.search_index and args.shards ):
+		print("--search-index only works with a single page wall, not --shards")
+		sys.exit(1)
 
 	if( args.sanitize_publish and not(os.path.exists(args.sanitize_publish)) ):
 		print("File (%s) does not exist" % args.sanitize_publish)
 		sys.exit(3)
 
-	local_tz = get_localzone()
-
+	# Opens (and migrates) the cache once for the whole run
+	fbk_db.connect(config_dir)
 
 	if(args.sanitize_publish):
 		sanitize_publish(args.sanitize_publish)
 	else:
-		publish(args.sanitize_publish, not args.posts_only)
+		publish(args.sanitize_publish, not args.posts_only, args.renderer, args.incremental, args.shards, args.workers, args.search_index)
+
+	fbk_db.close()
+	return 0
+
+# Main()
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='Publish content from _fetch to html pages')
+	add_arguments(parser)
+	fbk_metrics.add_arguments(parser)
 
-	sys.exit(0)
+	sys.exit( fbk_metrics.run('publish', run, parser.parse_args()) )
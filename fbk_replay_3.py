@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# fbk_replay_3.py -- Runs the pages of posts kept in the archive (see fbk_archive) back through fbk_fetch_3's
+# ingestion, oldest first, without touching the network. Handy after fbk_insert_response has been taught a new
+# field, or to rebuild a cache from its archive, e.g.
+#
+#		$ ./fbk_replay_3.py
+#		$ ./fbk_replay_3.py --verify
+
+import argparse
+import json
+import sys
+import time
+from fbk_config import fbk_config
+from fbk_db import fbk_db
+from fbk_archive import fbk_archive
+from fbk_metrics import fbk_metrics
+import fbk_fetch_3
+
+def debug_print(msg, verbose_threshold):
+	if args.verbosity:
+		if args.verbosity >= verbose_threshold:
+			print(msg)
+
+def replay( cxn, archive, since_txn=None, commit_every=100, verify=False ):
+	pages = 0
+	raw_bytes = 0
+	totals = [0, 0, 0, 0]
+
+	start = time.perf_counter()
+	for (txn_id, url, page) in archive.pages(cxn, since_txn):
+		with fbk_metrics.timed('json_decode'):
+			response = json.loads(page.decode('utf-8'))
+
+		pages += 1
+		raw_bytes += len(page)
+
+		if verify:
+			continue
+
+		counts = fbk_fetch_3.fbk_insert_response( cxn, response )
+		totals = [ t + c for (t, c) in zip(totals, counts) ]
+
+		debug_print("txn %s (%s): inserted %s, updated %s, skipped %s, invalid %s" %
+			(txn_id, url, counts[2], counts[3], counts[1], counts[0]), 2)
+
+		if pages % commit_every == 0:
+			cxn.commit()
+
+	cxn.commit()
+	elapsed = time.perf_counter() - start
+
+	print("Read %s archived pages (%.1f MB) in %.1fs" % (pages, raw_bytes / 1048576.0, elapsed))
+	if not verify:
+		print("Inserted %s posts, updated %s, skipped %s unchanged and %s invalid" % (totals[2], totals[3], totals[1], totals[0]))
+
+	return pages
+
+def add_arguments( parser ):
+	parser.add_argument('--since-txn', type=int, metavar='TXN_ID',
+			help='Only replay pages fetched after the request with this txn id')
+
+	parser.add_argument('--verify', action="store_true",
+			help='Only read and decode every archived page, to check that the archive is whole')
+
+	parser.add_argument('-c', '--commit-every', type=int, default=100, metavar='PAGES',
+			help='Commit after this many pages (default: 100)')
+
+	parser.add_argument('-f', '--config-file', metavar='CONFIG_FILE',
+			help='A JSON-structured file containing configuration directives to use for the script')
+
+	parser.add_argument('-v', '--verbosity', action="count",
+			help="Increase output verbosity")
+
+	parser.add_argument('--version', action='version', version='%(prog)s 1.0')
+
+def run( run_args ):
+	global args, config_dir, obj_config
+
+	args = run_args
+
+	config_dir = fbk_config.find_config_dir()
+
+	obj_config = fbk_config.load_config( config_dir, args.config_file )
+	fbk_config.require_account( obj_config, 'replay' )
+
+	# fbk_insert_response reads its settings from fbk_fetch_3's globals; there is no Graph client to give it
+	fetch_parser = argparse.ArgumentParser()
+	fbk_fetch_3.add_arguments(fetch_parser)
+	fbk_fetch_3.configure( fetch_parser.parse_args(['-v'] * (args.verbosity or 0)), config_dir, obj_config, None )
+
+	cxn = fbk_db.connect(config_dir)
+	archive = fbk_archive.Archive(config_dir)
+
+	try:
+		replay( cxn, archive, args.since_txn, args.commit_every, args.verify )
+	except (OSError, ValueError) as e:
+		cxn.commit()
+		print("Replay failed: %s" % e)
+		sys.exit(1)
+
+	archive.close()
+	fbk_db.close()
+	return 0
+
+# Main()
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='Replay archived pages of posts into the cache')
+	add_arguments(parser)
+	fbk_metrics.add_arguments(parser)
+
+	sys.exit( fbk_metrics.run('replay', run, parser.parse_args()) )
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+import sqlite3
+from datetime import datetime
+
+# fbk_schema -- The layout of fbk_cache.db, as a numbered list of migrations. The database's PRAGMA user_version is
+# the number of the last migration applied to it, so every script can call migrate() at startup and only the
+# missing steps run. Migrations are never edited once released; changes go in a new one at the end.
+
+def parse_epoch( str_ts ):
+	if not str_ts:
+		return None
+
+	return int(datetime.strptime(str_ts, "%Y-%m-%dT%H:%M:%S%z").timestamp())
+
+def table_exists( cxn, table ):
+	return cxn.execute("SELECT 1 FROM sqlite_master WHERE `type`='table' AND `name`=?", (table,)).fetchone() is not None
+
+def add_column( cxn, table, column, column_type ):
+	existing = [row[1] for row in cxn.execute("PRAGMA table_info(%s)" % table)]
+	if column not in existing:
+		cxn.execute("ALTER TABLE %s ADD COLUMN `%s` %s" % (table, column, column_type))
+
+# 1. The tables as fbk_fetch_3 and fbk_scrape_likes_3 used to create them
+def migrate_tables( cxn ):
+	sql_txn_create = """CREATE TABLE IF NOT EXISTS txn
+	(
+		`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+		`datetime_requested` INTEGER,
+		`return_code` INTEGER
+	)
+	"""
+	cxn.execute( sql_txn_create )
+
+	sql_posts_create = """CREATE TABLE IF NOT EXISTS posts
+	(
+		`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+		`fbk_id` TEXT,
+		`message` TEXT,
+		`privacy_description` TEXT,
+		`created_timestamp` TEXT,
+		`type` TEXT
+	)
+	"""
+	cxn.execute( sql_posts_create )
+
+	sql_postslikes_create = """CREATE TABLE IF NOT EXISTS posts_likes
+	(
+		`person_id` INTEGER,
+		`posts_id` INTEGER,
+		PRIMARY KEY (`person_id`,`posts_id`)
+	)
+	"""
+	cxn.execute( sql_postslikes_create )
+
+	sql_person_create = """CREATE TABLE IF NOT EXISTS person
+	(
+		`id` INTEGER PRIMARY KEY,
+		`name` TEXT
+	)
+	"""
+	cxn.execute( sql_person_create )
+
+	sql_checkpoint_create = """CREATE TABLE IF NOT EXISTS checkpoint
+	(
+		`name` TEXT PRIMARY KEY,
+		`cursor` TEXT,
+		`until` INTEGER,
+		`pages` INTEGER,
+		`datetime_updated` INTEGER,
+		`complete` INTEGER
+	)
+	"""
+	cxn.execute( sql_checkpoint_create )
+
+# 2. One txn row per request attempt, with what the scheduler saw
+def migrate_txn_attempts( cxn ):
+	add_column(cxn, 'txn', 'attempt', 'INTEGER')
+	add_column(cxn, 'txn', 'latency', 'REAL')
+	add_column(cxn, 'txn', 'bytes', 'INTEGER')
+	add_column(cxn, 'txn', 'usage', 'REAL')
+	add_column(cxn, 'txn', 'error', 'TEXT')
+	add_column(cxn, 'txn', 'throttled_until', 'REAL')
+
+# 3. Older caches may hold the same post more than once. Keep the first copy of each, point any likes at it, and
+# let a UNIQUE index stop it from happening again.
+def migrate_unique_posts( cxn ):
+	cur = cxn.cursor()
+
+	cur.execute("SELECT COUNT(*) - COUNT(DISTINCT `fbk_id`) FROM posts")
+	duplicates = cur.fetchone()[0]
+
+	if duplicates:
+		print("Removing %s duplicate posts from the cache" % duplicates)
+
+		# SQL
+		sql_likes_remap = """UPDATE OR IGNORE posts_likes SET `posts_id`=(
+			SELECT MIN(p2.`id`) FROM posts p1 JOIN posts p2 ON p2.`fbk_id`=p1.`fbk_id`
+			WHERE p1.`id`=posts_likes.`posts_id`
+		)"""
+		# END SQL
+		cur.execute( sql_likes_remap )
+		cur.execute("DELETE FROM posts_likes WHERE `posts_id` NOT IN (SELECT MIN(`id`) FROM posts GROUP BY `fbk_id`)")
+
+		cur.execute("DELETE FROM posts WHERE `id` NOT IN (SELECT MIN(`id`) FROM posts GROUP BY `fbk_id`)")
+
+	cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS posts_fbk_id ON posts (`fbk_id`)")
+
+# 4. An integer copy of created_timestamp, and indexes for the queries that used to scan posts: publish's public
+# statuses newest first, and the oldest post for fbk_fetch_prior. (Lookups by fbk_id already use posts_fbk_id.)
+def migrate_epoch_indexes( cxn ):
+	add_column(cxn, 'posts', 'created_epoch', 'INTEGER')
+
+	cxn.create_function('fbk_epoch', 1, parse_epoch)
+	cxn.execute("UPDATE posts SET `created_epoch`=fbk_epoch(`created_timestamp`) WHERE `created_epoch` IS NULL")
+
+	cxn.execute("CREATE INDEX IF NOT EXISTS posts_publish ON posts (`privacy_description`, `type`, `created_epoch`)")
+	cxn.execute("CREATE INDEX IF NOT EXISTS posts_created_epoch ON posts (`created_epoch`)")
+
+# 5. fbk_publish_3's incremental build: each public post's rendered markup, keyed by a hash of what it was rendered
+# from, and what each output file was last built from.
+def migrate_publish_manifest( cxn ):
+	sql_fragment_create = """CREATE TABLE IF NOT EXISTS publish_fragment
+	(
+		`fbk_id` TEXT PRIMARY KEY,
+		`hash` TEXT,
+		`fragment` TEXT
+	)
+	"""
+	cxn.execute( sql_fragment_create )
+
+	sql_build_create = """CREATE TABLE IF NOT EXISTS publish_build
+	(
+		`output` TEXT PRIMARY KEY,
+		`digest` TEXT,
+		`posts` INTEGER,
+		`rendered` INTEGER,
+		`datetime_built` INTEGER
+	)
+	"""
+	cxn.execute( sql_build_create )
+
+# 6. fbk_publish_3's sharded output: what each shard was last built from, and where it was written
+def migrate_publish_shards( cxn ):
+	sql_shard_create = """CREATE TABLE IF NOT EXISTS publish_shard
+	(
+		`scheme` TEXT,
+		`shard` TEXT,
+		`digest` TEXT,
+		`posts` INTEGER,
+		`path` TEXT,
+		`datetime_built` INTEGER,
+		PRIMARY KEY (`scheme`, `shard`)
+	)
+	"""
+	cxn.execute( sql_shard_create )
+
+# 7. posts_likes is keyed person first; fbk_scrape_likes_3 looks a post's likes up by post
+def migrate_likes_index( cxn ):
+	cxn.execute("CREATE INDEX IF NOT EXISTS posts_likes_posts_id ON posts_likes (`posts_id`)")
+
+# 8. Where fbk_scrape_likes_3 is with each post's likes: when they were last read in full and last checked for a
+# change in count, the count, and the next page of a scrape that didn't finish
+def migrate_likes_sync( cxn ):
+	sql_likes_sync_create = """CREATE TABLE IF NOT EXISTS likes_sync
+	(
+		`posts_id` INTEGER PRIMARY KEY,
+		`datetime_scraped` INTEGER,
+		`datetime_checked` INTEGER,
+		`like_count` INTEGER,
+		`cursor` TEXT
+	)
+	"""
+	cxn.execute( sql_likes_sync_create )
+
+# The full-text index on posts.message, an FTS5 table over posts (content='posts') that holds only the index. The
+# triggers keep it in step with every insert, edit and delete of a post, whichever script makes it.
+def create_posts_fts( cxn ):
+	sql_fts_create = """CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5
+	(
+		`message`,
+		content='posts',
+		content_rowid='id',
+		tokenize='unicode61 remove_diacritics 2'
+	)
+	"""
+	cxn.execute( sql_fts_create )
+
+	# SQL
+	sql_fts_triggers = [
+		"""CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+			INSERT INTO posts_fts (`rowid`, `message`) VALUES (new.`id`, new.`message`);
+		END""",
+		"""CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+			INSERT INTO posts_fts (posts_fts, `rowid`, `message`) VALUES ('delete', old.`id`, old.`message`);
+		END""",
+		"""CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF `message` ON posts BEGIN
+			INSERT INTO posts_fts (posts_fts, `rowid`, `message`) VALUES ('delete', old.`id`, old.`message`);
+			INSERT INTO posts_fts (`rowid`, `message`) VALUES (new.`id`, new.`message`);
+		END""",
+	]
+	# END SQL
+	for sql_trigger in sql_fts_triggers:
+		cxn.execute( sql_trigger )
+
+	# Index what is already cached
+	cxn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+
+# 9. Full-text search for fbk_search_3. An sqlite built without FTS5 goes without; fbk_search_3 --rebuild creates
+# the index once it is available.
+def migrate_posts_fts( cxn ):
+	try:
+		create_posts_fts(cxn)
+	except sqlite3.OperationalError as e:
+		print("Not creating the full-text search index: %s" % e)
+
+# 10. fbk_publish_3's client-side search index: the terms of each public post (newest first within a term, hence the
+# epoch), what each post was last indexed from along with its entry in the index, and the index's files
+def migrate_search_postings( cxn ):
+	sql_search_doc_create = """CREATE TABLE IF NOT EXISTS search_doc
+	(
+		`posts_id` INTEGER PRIMARY KEY,
+		`hash` TEXT,
+		`entry` TEXT
+	)
+	"""
+	cxn.execute( sql_search_doc_create )
+
+	sql_search_posting_create = """CREATE TABLE IF NOT EXISTS search_posting
+	(
+		`term` TEXT,
+		`posts_id` INTEGER,
+		`created_epoch` INTEGER,
+		PRIMARY KEY (`term`, `posts_id`)
+	) WITHOUT ROWID
+	"""
+	cxn.execute( sql_search_posting_create )
+	cxn.execute("CREATE INDEX IF NOT EXISTS search_posting_posts_id ON search_posting (`posts_id`)")
+
+	sql_search_shard_create = """CREATE TABLE IF NOT EXISTS search_shard
+	(
+		`shard` TEXT PRIMARY KEY,
+		`terms` INTEGER,
+		`postings` INTEGER
+	)
+	"""
+	cxn.execute( sql_search_shard_create )
+
+# 11. fbk_archive's index: where each archived page of posts is, keyed by the txn row of the request that fetched it
+def migrate_archive( cxn ):
+	sql_archive_create = """CREATE TABLE IF NOT EXISTS archive
+	(
+		`txn_id` INTEGER PRIMARY KEY,
+		`segment` INTEGER,
+		`offset` INTEGER,
+		`length` INTEGER,
+		`raw_length` INTEGER,
+		`codec` TEXT,
+		`url` TEXT,
+		`datetime_archived` INTEGER
+	)
+	"""
+	cxn.execute( sql_archive_create )
+
+# 12. fbk_metrics' run reports (--record-run): one row per run, with its report as JSON
+def migrate_runs( cxn ):
+	sql_runs_create = """CREATE TABLE IF NOT EXISTS runs
+	(
+		`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+		`command` TEXT,
+		`datetime_started` INTEGER,
+		`elapsed` REAL,
+		`status` INTEGER,
+		`report` TEXT
+	)
+	"""
+	cxn.execute( sql_runs_create )
+
+migrations = [
+	(1, migrate_tables),
+	(2, migrate_txn_attempts),
+	(3, migrate_unique_posts),
+	(4, migrate_epoch_indexes),
+	(5, migrate_publish_manifest),
+	(6, migrate_publish_shards),
+	(7, migrate_likes_index),
+	(8, migrate_likes_sync),
+	(9, migrate_posts_fts),
+	(10, migrate_search_postings),
+	(11, migrate_archive),
+	(12, migrate_runs),
+]
+
+def schema_version( cxn ):
+	return cxn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate( cxn ):
+	version = schema_version(cxn)
+
+	for (number, migration) in migrations:
+		if number <= version:
+			continue
+
+		# Each step and its version bump are one transaction
+		cxn.execute("BEGIN")
+		try:
+			migration(cxn)
+			cxn.execute("PRAGMA user_version = %d" % number)
+		except:
+			cxn.rollback()
+			raise
+		cxn.commit()
+
+	return schema_version(cxn)
@@ -14,69 +14,69 @@ import os
 import json
 import shutil
 import urllib
-import urllib.request
+import urllib.parse
 import time
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from fbk_config import fbk_config
-import sqlite3
+from fbk_graph import fbk_graph
+from fbk_db import fbk_db
+from fbk_metrics import fbk_metrics
+
+# Set (by fbk_daemon_3, on SIGTERM) to stop once the responses in flight have been written
+stopping = False
 
 def debug_print(msg, verbose_threshold):
 	if args.verbosity:
 		if args.verbosity >= verbose_threshold:
 			print(msg)
 
-def fbk_fetch_prior( ):
+def fbk_fetch_prior( cxn ):
 
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
 	cur = cxn.cursor()
 
-	sql_fetch_query = """SELECT `created_timestamp` FROM `posts`
-	ORDER BY `created_timestamp` ASC LIMIT 1"""
+	sql_fetch_query = """SELECT `created_timestamp`, `created_epoch` FROM `posts`
+	ORDER BY `created_epoch` ASC LIMIT 1"""
 	cur.execute(sql_fetch_query)
 
-	str_earliest_ts = cur.fetchone()[0]
-	earliest_ts = int(datetime.strptime(str_earliest_ts, "%Y-%m-%dT%H:%M:%S%z").strftime('%s'))
+	(str_earliest_ts, earliest_ts) = cur.fetchone()
 	print(str_earliest_ts)
-	fbk_fetch_insert(until=earliest_ts, limit=200)
-	cxn.close()
+	fbk_fetch_insert(cxn, until=earliest_ts, limit=200)
 
 	sys.exit(32)
 
 	return
 
-def fbk_insert_response( res, fbk_cache_id=[] ):
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
-	cur = cxn.cursor()
-
-	status_kv_schema = { 'fbk_id' : 'id', 'created_timestamp' : 'created_time' }
-	status_kv_dict = { k : k for k in ('type', 'message') }
+# Most variables in one statement, for sqlite builds older than 3.32
+sql_max_variables = 999
 
-	status_kv_dict = (OrderedDict((list(status_kv_dict.items()) + list(status_kv_schema.items()))))
+# Maps a page's worth of fbk_ids to posts.id, a few lookups at most
+def fbk_post_ids( cxn, fbk_ids ):
+	post_ids = {}
 
-	likes = []
-	person = []
-	uniq_person_id = []
-	skipped = 0
-	invalid = 0
-	for status in res['data']:
+	for i in range(0, len(fbk_ids), sql_max_variables):
+		chunk = fbk_ids[i:i + sql_max_variables]
 
-		like = {}
+		sql_fbk_id = "SELECT `fbk_id`, `id` FROM `posts` WHERE `fbk_id` IN (%s)" % ",".join("?" * len(chunk))
+		post_ids.update( cxn.execute(sql_fbk_id, chunk).fetchall() )
 
-		post_fbk_id = status['id']
+	return post_ids
 
-		sql_fbk_id = "SELECT `id` FROM `posts` WHERE `fbk_id`='" + post_fbk_id + "'"
-		cur.execute(sql_fbk_id)
-		post_id = cur.fetchone()
+# Neither fbk_insert_response nor fbk_fetch_url commit; a page's txn row, likes and people are one transaction.
+def fbk_insert_response( cxn, res ):
+	cur = cxn.cursor()
 
-		if post_id == None:
-			continue
+	statuses = [ status for status in res['data'] if 'likes' in status ]
+	with fbk_metrics.timed('dedup'):
+		post_ids = fbk_post_ids( cxn, list({ status['id'] for status in statuses }) )
 
-		post_id = int(post_id[0])
+	likes = []
+	person = {}
+	for status in statuses:
 
-		if not 'likes' in status:
+		post_id = post_ids.get(status['id'])
+		if post_id == None:
 			continue
 
-		#fbk_cache_id = [x for l in cur.fetchall() for x in l]
 		for status_liker in status['likes']['data']:
 			person_id = int(status_liker['id'])
 			like = {
@@ -85,14 +85,10 @@ def fbk_insert_response( res, fbk_cache_id=[] ):
 			}
 			likes.append(like)
 
-			if person_id not in uniq_person_id:
-				liker = {
-					'person_id'	: person_id,
-					'name'		: status_liker['name']
-				}
-
-				person.append(liker)
-				uniq_person_id.append(person_id)
+			person[person_id] = {
+				'person_id'	: person_id,
+				'name'		: status_liker['name']
+			}
 
 	# SQL
 	sql_like_insert = """INSERT OR IGNORE INTO posts_likes
@@ -102,53 +98,45 @@ def fbk_insert_response( res, fbk_cache_id=[] ):
 	;""" % (",".join( ('person_id', 'posts_id') ))
 	# END SQL
 
-	cur.executemany( sql_like_insert, likes )
-	cxn.commit()
+	with fbk_metrics.timed('sqlite_write'):
+		cur.executemany( sql_like_insert, likes )
 
+	# People's names change; keep the latest
 	# SQL
-	sql_person_insert = """INSERT OR IGNORE INTO person
+	sql_person_upsert = """INSERT INTO person
 	(%s)
 	VALUES
 	(:person_id, :name)
+	ON CONFLICT(`id`) DO UPDATE SET `name`=excluded.`name` WHERE `name` IS NOT excluded.`name`
 	;""" % (",".join( ('id', 'name') ))
 	# END SQL
 
-	cur.executemany( sql_person_insert, person )
-	cxn.commit()
-
-	cxn.close()
+	with fbk_metrics.timed('sqlite_write'):
+		cur.executemany( sql_person_upsert, person.values() )
 
+	fbk_metrics.count('likes', len(likes))
 	return
 
-def fbk_fetch_url(url):
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
-	cur = cxn.cursor()
-
+def fbk_fetch_url( cxn, url ):
 	debug_print("Fetch URL: %s" % (url), 4)
 
-	with urllib.request.urlopen(url) as r:
-
-		cur.execute( "INSERT INTO txn (`datetime_requested`, `return_code`) VALUES (?, ?)", (time.time(), r.status) )
+	try:
+		(attempts, response) = graph.get_json(url)
+	except Exception as e:
+		fbk_graph.record_attempts(cxn, getattr(e, 'attempts', []))
 		cxn.commit()
+		raise
 
-		response = json.loads(r.read().decode('utf-8'))
+	fbk_graph.record_attempts(cxn, attempts)
 
 	debug_print("Loaded %s responses" % (len(response['data'])), 3)
-	cxn.close()
 
 	return response
 
-def fbk_fetch_insert( endpoint="posts", type_="status", fields=['id','likes'], since=None, until=None, limit=None, **kwargs):
+def fbk_fetch_insert( cxn, endpoint="posts", type_="status", fields=['id','likes'], since=None, until=None, limit=None, **kwargs):
 
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
-	cur = cxn.cursor()
-
-	# Set up fbk_cache_id
-	#cur.execute("SELECT id, fbk_id FROM posts")
-	#fbk_cache_id = [x for l in cur.fetchall() for x in l]
-
-	url_params = (endpoint, obj_config['graph']['access_token'], type_, ",".join(fields))
-	url = "https://graph.facebook.com/me/%s?access_token=%s&type=%s&fields=%s" % url_params
+	url_params = (endpoint, obj_config.graph.access_token, type_, ",".join(fields))
+	url = graph.url("/%s/%s?access_token=%s&type=%s&fields=%s" % ((obj_config.graph.node,) + url_params))
 
 	if(since):
 		url += "&since=%s" % (since)
@@ -157,83 +145,285 @@ def fbk_fetch_insert( endpoint="posts", type_="status", fields=['id','likes'], s
 	if(until):
 		url += "&until=%s" % (until)
 
-	fbk_insert_response( fbk_fetch_url(url))
-
-	cxn.close()
+	fbk_insert_response( cxn, fbk_fetch_url(cxn, url) )
+	cxn.commit()
 
 	return
 
-def fbk_cache( ):
-	#if ( use_configdir and os.path.exists(os.path.join(config_dir,'fbk_cache.db')) ):
-	cxn = sqlite3.connect( os.path.join(config_dir, 'fbk_cache.db') )
+# Likes per page when following a post's likes
+likes_page_limit = 500
+
+# Refresh policy defaults: posts younger than likes_hot_days are checked on every run, older ones every
+# likes_cold_interval days
+default_likes_hot_days = 30
+default_likes_cold_interval = 7
+
+def fbk_likes_url( fbk_id ):
+	return "/%s/likes?limit=%s&summary=true" % (fbk_id, likes_page_limit)
+
+# Paging URLs carry the access token; it isn't kept in the database
+def fbk_strip_token( url ):
+	parts = urllib.parse.urlsplit(url)
+	query = [ (k, v) for (k, v) in urllib.parse.parse_qsl(parts.query) if k != 'access_token' ]
+
+	return urllib.parse.urlunsplit( parts._replace(query=urllib.parse.urlencode(query)) )
+
+def fbk_add_token( url ):
+	return url + ("&" if "?" in url else "?") + "access_token=%s" % obj_config.graph.access_token
+
+# Workers: each returns (attempts, [(fbk_id, likes page), ...], [fbk_id of each request to try again on its own])
+def fbk_likes_batch( fbk_ids ):
+	debug_print("Batch of %s posts: %s .. %s" % (len(fbk_ids), fbk_ids[0], fbk_ids[-1]), 3)
+
+	(attempts, results) = graph.batch( obj_config.graph.access_token, [fbk_likes_url(fbk_id) for fbk_id in fbk_ids] )
+
+	pages = []
+	retry = []
+	for (fbk_id, (code, body)) in zip(fbk_ids, results):
+		if code == 200 and isinstance(body, dict) and 'data' in body:
+			pages.append( (fbk_id, body) )
+		else:
+			debug_print("Batched request for %s came back with %s; retrying on its own" % (fbk_id, code), 2)
+			retry.append(fbk_id)
+
+	return (attempts, pages, retry)
+
+# Returns (attempts, { fbk_id : like count }) for up to batch_max posts, in one request
+def fbk_likes_counts( fbk_ids ):
+	url = graph.url("/?ids=%s&fields=likes.limit(0).summary(true)&access_token=%s" %
+		(",".join(fbk_ids), obj_config.graph.access_token))
+
+	(attempts, response) = graph.get_json(url)
+
+	counts = {}
+	for (fbk_id, post) in response.items():
+		if isinstance(post, dict) and 'likes' in post:
+			counts[fbk_id] = post['likes'].get('summary', {}).get('total_count')
+
+	return (attempts, counts)
+
+def fbk_likes_page( fbk_id, url ):
+	debug_print("Fetch URL: %s" % (url), 4)
+
+	(attempts, page) = graph.get_json(url)
+
+	return (attempts, [ (fbk_id, page) ], [])
+
+# Reads every like of every post in fbk_ids: the first page of each, 50 posts to a request through the batch
+# endpoint, then any further pages (likes.paging.next) one request each. Posts in resume pick up from the page a
+# previous run stopped at. Requests run on a pool of workers; this thread does all the writing, one transaction per
+# response. Each post's progress is kept in likes_sync, and once all of a post's likes have been read (from the
+# start), likes that are no longer there are removed. Returns (posts completed, likes read, failed requests).
+def fbk_scrape_likes( cxn, fbk_ids, workers, resume={} ):
+	cur = cxn.cursor()
+
+	graph.pool_size = max(graph.pool_size, workers)
+
+	# SQL
+	sql_likes_prune = """DELETE FROM posts_likes
+	WHERE `posts_id`=(SELECT `id` FROM `posts` WHERE `fbk_id`=?)
+	AND `person_id` NOT IN (SELECT `value` FROM json_each(?))"""
+	# END SQL
+
+	# SQL
+	sql_sync_page = """INSERT INTO likes_sync (`posts_id`, `cursor`)
+	SELECT `id`, :cursor FROM `posts` WHERE `fbk_id`=:fbk_id
+	ON CONFLICT(`posts_id`) DO UPDATE SET `cursor`=excluded.`cursor`"""
+	# END SQL
+
+	# SQL
+	sql_sync_done = """INSERT INTO likes_sync (`posts_id`, `datetime_scraped`, `datetime_checked`, `like_count`, `cursor`)
+	SELECT `id`, :now, :now, :like_count, NULL FROM `posts` WHERE `fbk_id`=:fbk_id
+	ON CONFLICT(`posts_id`) DO UPDATE SET `datetime_scraped`=excluded.`datetime_scraped`,
+		`datetime_checked`=excluded.`datetime_checked`, `like_count`=excluded.`like_count`, `cursor`=NULL"""
+	# END SQL
+
+	seen = {}
+	totals = {}
+	completed = 0
+	likes = 0
+	failed = 0
+
+	# Batches are handed out a few at a time rather than all at once, so that responses can't pile up in memory
+	# faster than they are written
+	batches = ( fbk_ids[i:i + fbk_graph.batch_max] for i in range(0, len(fbk_ids), fbk_graph.batch_max) )
+	in_flight = workers * 2
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		jobs = {}
+
+		for (fbk_id, cursor) in resume.items():
+			seen[fbk_id] = None
+			jobs[executor.submit(fbk_likes_page, fbk_id, fbk_add_token(cursor))] = [fbk_id]
+
+		while True:
+			while len(jobs) < in_flight and not stopping:
+				batch = next(batches, None)
+				if batch is None:
+					break
+				jobs[executor.submit(fbk_likes_batch, batch)] = batch
+
+			if not jobs:
+				break
+
+			(done, pending) = wait(jobs, return_when=FIRST_COMPLETED)
+
+			for future in done:
+				job_fbk_ids = jobs.pop(future)
+
+				try:
+					(attempts, pages, retry) = future.result()
+				except fbk_graph.fetch_errors as e:
+					fbk_graph.record_attempts(cxn, getattr(e, 'attempts', []))
+					cxn.commit()
+
+					print("Fetching likes for %s posts failed: %s" % (len(job_fbk_ids), e))
+					failed += 1
+					continue
+
+				fbk_graph.record_attempts(cxn, attempts)
+
+				fbk_insert_response( cxn, { 'data' : [ { 'id' : fbk_id, 'likes' : page } for (fbk_id, page) in pages ] } )
+
+				for (fbk_id, page) in pages:
+					if 'summary' in page:
+						totals[fbk_id] = page['summary'].get('total_count')
+
+					# None: resumed part way through, so not every like will have been seen
+					if seen.setdefault(fbk_id, set()) is not None:
+						seen[fbk_id].update( int(liker['id']) for liker in page['data'] )
+					likes += len(page['data'])
+
+					next_url = page.get('paging', {}).get('next')
+					if next_url:
+						# Saved first, so that a stop (or a failure) picks up from here next time
+						cur.execute( sql_sync_page, { 'fbk_id' : fbk_id, 'cursor' : fbk_strip_token(next_url) } )
+						if not stopping:
+							jobs[executor.submit(fbk_likes_page, fbk_id, next_url)] = [fbk_id]
+						continue
+
+					post_seen = seen.pop(fbk_id)
+					if post_seen is not None:
+						cur.execute( sql_likes_prune, (fbk_id, json.dumps(list(post_seen))) )
+
+					like_count = totals.pop(fbk_id, None)
+					if like_count is None:
+						like_count = cur.execute("SELECT COUNT(*) FROM posts_likes WHERE `posts_id`=(SELECT `id` FROM `posts` WHERE `fbk_id`=?)",
+							(fbk_id,)).fetchone()[0]
+
+					cur.execute( sql_sync_done, { 'fbk_id' : fbk_id, 'now' : int(time.time()), 'like_count' : like_count } )
+					completed += 1
+
+				if not stopping:
+					for fbk_id in retry:
+						jobs[executor.submit(fbk_likes_page, fbk_id, fbk_add_token(graph.url(fbk_likes_url(fbk_id))))] = [fbk_id]
+
+				cxn.commit()
+
+			# Requests already sent are let finish (and written); the rest are dropped
+			if stopping:
+				for future in list(jobs):
+					if future.cancel():
+						jobs.pop(future)
+
+	return (completed, likes, failed)
+
+# Asks Graph for the like counts of the posts in counts ({ fbk_id : count when last read }), batch_max posts to a
+# request. Posts whose count hasn't changed are marked as checked. Returns (the fbk_ids whose count changed, failed
+# requests).
+def fbk_check_likes( cxn, counts, workers ):
 	cur = cxn.cursor()
+	fbk_ids = list(counts)
 
-	sql_txn_create = """CREATE TABLE IF NOT EXISTS txn
-	(
-		`id` INTEGER PRIMARY KEY AUTOINCREMENT,
-		`datetime_requested` INTEGER,
-		`return_code` INTEGER
-	)
-	"""
-	cur.execute( sql_txn_create )
+	changed = []
+	failed = 0
 
-	sql_posts_create = """CREATE TABLE IF NOT EXISTS posts
-	(
-		`id` INTEGER PRIMARY KEY AUTOINCREMENT,
-		`fbk_id` TEXT,
-		`message` TEXT,
-		`privacy_description` TEXT,
-		`created_timestamp` TEXT,
-		`type` TEXT
-	)
-	"""
-	cur.execute( sql_posts_create )
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		jobs = {}
+		for i in range(0, len(fbk_ids), fbk_graph.batch_max):
+			batch = fbk_ids[i:i + fbk_graph.batch_max]
+			jobs[executor.submit(fbk_likes_counts, batch)] = batch
 
-	sql_postslikes_create = """CREATE TABLE IF NOT EXISTS posts_likes
-	(
-		`person_id` INTEGER,
-		`posts_id` INTEGER,
-		PRIMARY KEY (`person_id`,`posts_id`)
-	)
-	"""
-	cur.execute( sql_postslikes_create )
+		for future in list(jobs):
+			if stopping:
+				future.cancel()
+				continue
 
-	sql_person_create = """CREATE TABLE IF NOT EXISTS person
-	(
-		`id` INTEGER PRIMARY KEY,
-		`name` TEXT
-	)
-	"""
-	cur.execute( sql_person_create )
+			try:
+				(attempts, current) = future.result()
+			except fbk_graph.fetch_errors as e:
+				fbk_graph.record_attempts(cxn, getattr(e, 'attempts', []))
+				cxn.commit()
 
-	# Set up fbk_cache_id
-	cur.execute("SELECT fbk_id FROM posts")
-	fbk_cache_id = [x for l in cur.fetchall() for x in l]
+				print("Checking the like counts of %s posts failed: %s" % (len(jobs[future]), e))
+				failed += 1
+				continue
 
+			fbk_graph.record_attempts(cxn, attempts)
 
-	graph_status_url = "https://graph.facebook.com/me/posts?access_token=%s&type=status&fields=id,likes" % (obj_config['graph']['access_token'])
-	#graph_status_url += "&__paging_token=enc_AdBNF7zntHiM7nLEpUOkHOfPlydiAVYn5A5JHN6RhH6N10kubwEr5RxgbV2NnyttA8i4dYey1b2GX9joP9xzPlbq&access_token=CAAAAAIz3DV0BAEdDmcawhSClCnDKeIo4SdXwU92xbgPNcZCOeOZBVBiYpPa440Crekk5ZCDJ90wZBdT1ZAY0HvMoGLuNBuhwPViZAHr8NVkg34qAGkPhkIfpVgdR8IOJmCdPxdLZAbdVZBIhqV4AZClR01VeoZCkv4of35KqQGaQXCWVUdJiVblSvzSMyAdhQRpHb78YT7kzZC22QZDZD&until=1226285728"
-	#graph_status_url += "&limit=200"
+			unchanged = []
+			for fbk_id in jobs[future]:
+				if fbk_id in current and current[fbk_id] != counts[fbk_id]:
+					changed.append(fbk_id)
+				else:
+					unchanged.append( (int(time.time()), fbk_id) )
 
-	debug_print("Fetch URL: %s" % (graph_status_url), 4)
+			cur.executemany("UPDATE likes_sync SET `datetime_checked`=? WHERE `posts_id`=(SELECT `id` FROM `posts` WHERE `fbk_id`=?)", unchanged)
+			cxn.commit()
 
+	return (changed, failed)
 
-	#
-	iteration = 0
-	fetch_loop_max = 1 # At some point in the future, this will represent a complete fetch loop
-	while iteration < fetch_loop_max and graph_status_url:
+def fbk_cache( ):
+	#if ( use_configdir and os.path.exists(os.path.join(config_dir,'fbk_cache.db')) ):
+	cxn = fbk_db.connect(config_dir)
+	cur = cxn.cursor()
 
-		response = fbk_fetch_url(graph_status_url)
+	fbk_graph.resume_throttle(cxn, graph.scheduler)
 
-		debug_print(response['paging']['next'], 2)
+	now = int(time.time())
+	hot_since = now - obj_config.graph.get('likes_hot_days', default_likes_hot_days) * 86400
+	cold_before = now - obj_config.graph.get('likes_cold_interval', default_likes_cold_interval) * 86400
 
-		fbk_insert_response( response, fbk_cache_id)
+	if args.all:
+		(hot_since, cold_before) = (0, now + 1)
 
-		graph_status_url = response['paging']['next']
+	# Posts that have never been read, were left part way through, are recent, or haven't been checked in a while;
+	# newest first. Everything else is cold, and skipped.
+	# SQL
+	sql_sync_query = """SELECT p.`fbk_id`, s.`posts_id` IS NULL, s.`like_count`, s.`cursor`
+	FROM `posts` p LEFT JOIN `likes_sync` s ON s.`posts_id`=p.`id`
+	WHERE s.`posts_id` IS NULL OR s.`cursor` IS NOT NULL OR p.`created_epoch` >= ? OR s.`datetime_checked` < ?
+	ORDER BY p.`created_epoch` DESC"""
+	# END SQL
+	cur.execute(sql_sync_query, (hot_since, cold_before))
+	due = cur.fetchall()
+
+	resume = { fbk_id : cursor for (fbk_id, new, like_count, cursor) in due if not new and cursor }
+	counts = { fbk_id : like_count for (fbk_id, new, like_count, cursor) in due if not new and not cursor }
+
+	# With --all, every post is read again regardless of its count
+	if args.all:
+		changed = set(counts)
+		check_failed = 0
+	else:
+		(changed, check_failed) = fbk_check_likes( cxn, counts, args.workers )
+		changed = set(changed)
+
+	fbk_ids = [ fbk_id for (fbk_id, new, like_count, cursor) in due if new or fbk_id in changed ]
+
+	debug_print("%s posts due: %s never read, %s to resume, %s checked of which %s changed" %
+		(len(due), len(fbk_ids) - len(changed), len(resume), len(counts), len(changed)), 1)
+
+	(completed, likes, failed) = fbk_scrape_likes( cxn, fbk_ids, args.workers, resume )
 
-		iteration = iteration + 1
+	print("Read %s likes on %s posts" % (likes, completed))
 
-	cxn.close()
+	failed += check_failed
+	if failed:
+		print("%s requests failed; the likes of those posts are incomplete. Run again to retry them." % failed)
+		sys.exit(14)
+
+	return (completed, likes)
 
 def mktreeoutput( basedirname ):
 	file_path = '.'
@@ -251,19 +441,11 @@ def mktreeoutput( basedirname ):
 
 def process_graph_likes():
 
-	if( 'basedirname' in obj_config['graph'] ):
-		basedirname = obj_config['graph']['basedirname']
-	else:
-		basedirname = "_fbk"
+	basedirname = obj_config.graph.basedirname
 
 	fbk_cache()
 
-# Main()
-if __name__ == "__main__":
-
-	# Process arguments
-	parser = argparse.ArgumentParser(description='Scrape likes for content from Facebook\'s Graph API')
-
+def add_arguments( parser ):
 	parser.add_argument('-A', '--access-token',
 			help='The access token to use for making Facebook Graph API requests.')
 
@@ -276,35 +458,56 @@ if __name__ == "__main__":
 	parser.add_argument('-v', '--verbosity', action="count",
 			help="Increase output verbosity")
 
-	parser.add_argument('--version', action='version', version='%(prog)s 1.0')
+	parser.add_argument('-a', '--all', action="store_true",
+			help='Read the likes of every post again, rather than only those that are due')
 
-	args = parser.parse_args()
+	parser.add_argument('-j', '--workers', type=int, default=4,
+			help='The number of requests to have in flight at once (default: 4)')
 
+	parser.add_argument('--version', action='version', version='%(prog)s 1.0')
 
-	config_dir = ".fbk"
+# Sets the module's globals, as run() would; fbk_daemon_3 shares its config and Graph client this way
+def configure( run_args, run_config_dir, run_obj_config, run_graph ):
+	global args, config_dir, use_configdir, obj_config, graph
+
+	args = run_args
+	config_dir = run_config_dir
 	use_configdir = os.path.exists( config_dir )
+	obj_config = run_obj_config
+	graph = run_graph
+
+def run( run_args ):
+	config_dir = fbk_config.find_config_dir()
 
-	if use_configdir == False:
-		config_dir = os.path.join( os.path.expanduser('~'), '.fbk' )
-		use_configdir = os.path.exists( config_dir )
+	obj_config = fbk_config.load_config( config_dir, run_args.config_file, False,
+		{ 'graph' : { 'access_token' : run_args.access_token, 'client_id' : run_args.client_id } } )
 
-	# Default obj_config
+	# With several accounts configured and none chosen, each is scraped at once, by a process of its own
+	if( fbk_config.account is None and obj_config.accounts ):
+		if( run_args.access_token or run_args.client_id ):
+			print("-A and -C only apply to one account; choose it with fbk --account NAME")
+			sys.exit(1)
 
-	file_configfile = None
-	if(args.config_file):
-		file_configfile = os.path.abspath(args.config_file)
-	elif( use_configdir and os.path.exists(os.path.join(config_dir, 'config.json'))):
-		file_configfile = os.path.join(config_dir, 'config.json')
+		return fbk_config.run_accounts( fbk_config.account_names(obj_config), run, run_args )
 
-	if(file_configfile):
-		obj_config = fbk_config.parse_config( file_configfile, True )
+	fbk_config.validate_access_token( obj_config )
 
-	if(args.access_token):
-		obj_config['graph']['access_token'] = args.access_token
+	configure( run_args, config_dir, obj_config, fbk_graph.graph_client(obj_config) )
 
-	if(args.client_id):
-		obj_config['graph']['client_id'] = args.client_id
+	# Opens (and migrates) the cache once for the whole run
+	fbk_db.connect(config_dir)
 
 	process_graph_likes()
 
-	sys.exit(0)
+	fbk_db.close()
+	return 0
+
+# Main()
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='Scrape likes for content from Facebook\'s Graph API')
+	add_arguments(parser)
+	fbk_metrics.add_arguments(parser)
+
+	sys.exit( fbk_metrics.run('scrape-likes', run, parser.parse_args()) )
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+#
+# fbk_search_3.py -- Searches the messages of cached posts through the full-text index (posts_fts) that fbk_cache.db
+# keeps alongside posts, best matches first, e.g.
+#
+#		$ ./fbk_search_3.py road trip
+#		$ ./fbk_search_3.py -e "road trip" --since 2012-01-01 --until 2013-01-01 -p Public
+#
+#	The query is an FTS5 query: words must all appear, "quoted words" must appear as a phrase, and OR, NOT, NEAR()
+#	and prefix* work as sqlite documents them. -e searches for the whole query as one phrase.
+
+import argparse
+import calendar
+import sqlite3
+import sys
+from datetime import datetime
+from fbk_config import fbk_config
+from fbk_db import fbk_db
+from fbk_metrics import fbk_metrics
+from fbk_schema import fbk_schema
+
+snippet_tokens = 16
+
+orders = {
+	'rank'		: 'posts_fts.`rank`',
+	'newest'	: 'p.`created_epoch` DESC',
+	'oldest'	: 'p.`created_epoch` ASC',
+}
+
+def debug_print(msg, verbose_threshold):
+	if args.verbosity:
+		if args.verbosity >= verbose_threshold:
+			print(msg)
+
+def parse_when( str_when ):
+	if str_when.isdigit():
+		return int(str_when)
+
+	return calendar.timegm(datetime.strptime(str_when, "%Y-%m-%d").timetuple())
+
+# A query that matches its words as one phrase, whatever they contain
+def fts_phrase( query ):
+	return '"%s"' % query.replace('"', '""')
+
+# The WHERE clause and its parameters for a query and the filters given with it
+def search_filter( query, since=None, until=None, privacy=None ):
+	where = ["posts_fts MATCH ?"]
+	params = [query]
+
+	if since is not None:
+		where.append("p.`created_epoch` >= ?")
+		params.append(since)
+
+	if until is not None:
+		where.append("p.`created_epoch` < ?")
+		params.append(until)
+
+	if privacy:
+		where.append("p.`privacy_description` COLLATE NOCASE IN (%s)" % ",".join("?" * len(privacy)))
+		params.extend(privacy)
+
+	return (" AND ".join(where), params)
+
+def search( cxn, query, since=None, until=None, privacy=None, order='rank', limit=20, marks=('[', ']') ):
+	(where, params) = search_filter(query, since, until, privacy)
+
+	# SQL
+	sql_search = """SELECT p.`fbk_id`, p.`created_epoch`, p.`privacy_description`,
+		snippet(posts_fts, 0, ?, ?, '...', %s), bm25(posts_fts)
+	FROM posts_fts
+	JOIN posts p ON p.`id`=posts_fts.`rowid`
+	WHERE %s
+	ORDER BY %s
+	LIMIT ?""" % (snippet_tokens, where, orders[order])
+	# END SQL
+
+	return cxn.execute( sql_search, list(marks) + params + [limit] ).fetchall()
+
+def search_count( cxn, query, since=None, until=None, privacy=None ):
+	(where, params) = search_filter(query, since, until, privacy)
+
+	sql_count = "SELECT COUNT(*) FROM posts_fts JOIN posts p ON p.`id`=posts_fts.`rowid` WHERE %s" % where
+
+	return cxn.execute( sql_count, params ).fetchone()[0]
+
+# Creates the index (if an older sqlite couldn't) and re-reads every post into it
+def rebuild_index( cxn ):
+	cxn.execute("BEGIN")
+	fbk_schema.create_posts_fts(cxn)
+	cxn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('optimize')")
+	cxn.commit()
+
+def print_results( results ):
+	for (fbk_id, epoch, privacy, snippet, score) in results:
+		when = datetime.fromtimestamp(epoch).strftime('%Y-%m-%d %H:%M') if epoch is not None else '?'
+
+		print("%s  %-12s %s" % (when, privacy, fbk_id))
+		print("    %s" % " ".join(snippet.split()))
+		debug_print("    (bm25 %.3f)" % score, 1)
+
+def add_arguments( parser ):
+	parser.add_argument('query', nargs='*', metavar='QUERY',
+			help='The words (or FTS5 query) to search for')
+
+	parser.add_argument('-e', '--exact', action="store_true",
+			help='Search for the whole query as one phrase')
+
+	parser.add_argument('--since', metavar='DATE',
+			help='Only posts from DATE (YYYY-MM-DD or a UNIX timestamp) onwards')
+
+	parser.add_argument('--until', metavar='DATE',
+			help='Only posts from before DATE (YYYY-MM-DD or a UNIX timestamp)')
+
+	parser.add_argument('-p', '--privacy', metavar='DESCRIPTION', action='append',
+			help='Only posts with this privacy description (e.g. Public); may be given more than once')
+
+	parser.add_argument('-o', '--order', choices=sorted(orders.keys()), default='rank',
+			help='Best matches first (rank), or by date (default: rank)')
+
+	parser.add_argument('-n', '--limit', type=int, default=20,
+			help='The most results to show (default: 20)')
+
+	parser.add_argument('--rebuild', action="store_true",
+			help='Rebuild the full-text index from the cached posts')
+
+	parser.add_argument('-f', '--config-file', metavar='CONFIG_FILE',
+			help='A JSON-structured file containing configuration directives to use for the script')
+
+	parser.add_argument('-v', '--verbosity', action="count",
+			help="Increase output verbosity")
+
+	parser.add_argument('--version', action='version', version='%(prog)s 1.0')
+
+def run( run_args ):
+	global args, config_dir
+
+	args = run_args
+
+	config_dir = fbk_config.find_config_dir()
+
+	# Only the location of the cache is needed, but a missing config is reported the same way as the other scripts
+	fbk_config.require_account( fbk_config.load_config(config_dir, args.config_file), 'search' )
+
+	if( not args.query and not args.rebuild ):
+		print("Nothing to search for")
+		sys.exit(1)
+
+	cxn = fbk_db.connect(config_dir)
+
+	if(args.rebuild):
+		try:
+			rebuild_index(cxn)
+		except sqlite3.OperationalError as e:
+			print("Could not build the full-text search index: %s" % e)
+			sys.exit(1)
+		print("Rebuilt the full-text search index")
+
+	if not fbk_schema.table_exists(cxn, 'posts_fts'):
+		print("There is no full-text search index (sqlite may lack FTS5); see --rebuild")
+		sys.exit(1)
+
+	if(args.query):
+		query = " ".join(args.query)
+		if(args.exact):
+			query = fts_phrase(query)
+
+		since = parse_when(args.since) if args.since else None
+		until = parse_when(args.until) if args.until else None
+
+		# Bold on a terminal, brackets otherwise
+		marks = ('\033[1m', '\033[0m') if sys.stdout.isatty() else ('[', ']')
+
+		try:
+			results = search(cxn, query, since, until, args.privacy, args.order, args.limit, marks)
+			if(args.verbosity):
+				print("%s matching posts" % search_count(cxn, query, since, until, args.privacy))
+		except sqlite3.OperationalError as e:
+			print("Bad query (%s): %s" % (query, e))
+			sys.exit(1)
+
+		print_results(results)
+
+	fbk_db.close()
+	return 0
+
+# Main()
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='Search the messages of cached posts')
+	add_arguments(parser)
+	fbk_metrics.add_arguments(parser)
+
+	sys.exit( fbk_metrics.run('search', run, parser.parse_args()) )
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+#
+# fbk_standin_3.py -- A stand-in for the parts of the Graph API that the fbk_*_3 scripts use, serving synthetic
+# posts and likes. It is there for benchmarks (see fbk_bench_3.py), and for trying changes out without a token or a
+# rate limit. Point "base_url" in the graph section of config.json at it, e.g.
+#
+#		$ ./fbk_standin_3.py --posts 100000 &
+#		"graph" : { "base_url" : "http://127.0.0.1:8765", "access_token" : "standin", ... }
+#
+#	It serves:
+#		GET /{node}/posts		newest first, with limit, since and until, paging.next and inline likes
+#		GET /{post id}/likes		with limit, after (a cursor) and summary=true
+#		GET /?ids=...			each post's like count (fields=likes.limit(0).summary(true))
+#		POST /				the batch endpoint, for GETs of the above
+#
+#	Post n (0 is the oldest) is the same every time for the same --posts, --likes and --seed. Every 50th post has
+#	no message, as a photo without a caption would, so the scripts' handling of invalid posts gets exercised too.
+#	--latency delays every response; --error-rate answers that share of requests with a 503, and --throttle-rate
+#	with Graph's rate limit error (code 4, with Retry-After).
+
+import argparse
+import base64
+import gzip
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+user_id = '100000000000001'
+post_id_base = 10000000
+person_id_base = 200000000
+people = 5000
+
+# Posts are step seconds apart, the oldest at epoch_start
+epoch_start = 1230768000
+default_step = 21600
+
+default_port = 8765
+default_page_size = 25
+max_page_size = 100
+inline_likes = 25
+
+words = ('the', 'a', 'and', 'to', 'of', 'in', 'it', 'is', 'for', 'on', 'with', 'we', 'at', 'this', 'that', 'just',
+	'day', 'today', 'night', 'week', 'home', 'work', 'coffee', 'dinner', 'friends', 'family', 'road', 'trip', 'rain',
+	'sun', 'snow', 'beach', 'city', 'music', 'show', 'game', 'movie', 'book', 'dog', 'cat', 'garden', 'kitchen', 'new',
+	'old', 'great', 'long', 'finally', 'again', 'happy', 'birthday', 'weekend', 'morning', 'café', 'naïve', 'über')
+
+privacies = (('Public', 0.8), ('Your friends', 0.15), ('Only Me', 0.05))
+
+def post_id( n ):
+	return "%s_%s" % (user_id, post_id_base + n)
+
+# The post number of a post id, or None if there is no such post
+def post_number( fbk_id ):
+	(owner, sep, number) = fbk_id.partition('_')
+	if owner != user_id or not number.isdigit():
+		return None
+
+	n = int(number) - post_id_base
+	if n < 0 or n >= options.posts:
+		return None
+
+	return n
+
+def post_epoch( n ):
+	return epoch_start + n * options.step
+
+def like_count( n ):
+	return (n * 7919 + options.seed) % (options.likes + 1)
+
+def person( n, j ):
+	i = (n * 13 + j) % people
+	return { 'id' : str(person_id_base + i), 'name' : "Person %s" % i }
+
+def encode_cursor( offset ):
+	return base64.b64encode(str(offset).encode('ascii')).decode('ascii')
+
+def decode_cursor( cursor ):
+	try:
+		return int(base64.b64decode(cursor).decode('ascii'))
+	except ValueError:
+		return 0
+
+def graph_url( path, query ):
+	return "%s%s?%s" % (options.base_url, path, urllib.parse.urlencode(query))
+
+# A page of a post's likes, from offset
+def likes_page( n, offset, limit, query, path, summary ):
+	count = like_count(n)
+	end = min(count, offset + limit)
+
+	page = { 'data' : [ person(n, j) for j in range(offset, end) ], 'paging' : {} }
+	if end > offset:
+		page['paging']['cursors'] = { 'before' : encode_cursor(offset), 'after' : encode_cursor(end) }
+
+	if end < count:
+		next_query = dict(query)
+		next_query['after'] = encode_cursor(end)
+		page['paging']['next'] = graph_url(path, next_query)
+
+	if summary:
+		page['summary'] = { 'total_count' : count }
+
+	return page
+
+def post( n, fields ):
+	rng = random.Random(options.seed * 1000003 + n)
+
+	p = { 'id' : post_id(n) }
+
+	if 'message' in fields and n % 50 != 49:
+		p['message'] = " ".join( rng.choice(words) for i in range(rng.randint(3, 30)) ).capitalize() + "."
+
+	if 'privacy' in fields:
+		r = rng.random()
+		for (description, share) in privacies:
+			if r < share:
+				break
+			r -= share
+		p['privacy'] = { 'description' : description, 'value' : 'EVERYONE' if description == 'Public' else 'CUSTOM' }
+
+	if 'type' in fields:
+		p['type'] = 'status'
+
+	p['created_time'] = datetime.fromtimestamp(post_epoch(n), timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+0000")
+
+	if 'likes' in fields and like_count(n):
+		p['likes'] = likes_page(n, 0, inline_likes, { 'limit' : inline_likes }, '/%s/likes' % post_id(n), False)
+
+	return p
+
+# /me/posts: newest first, since <= created < until
+def posts_page( query, path ):
+	limit = min(int(query.get('limit', options.page_size)), max_page_size)
+	fields = query.get('fields', 'id,message,privacy,type').split(',')
+
+	newest = options.posts - 1
+	if 'until' in query:
+		newest = min(newest, (int(query['until']) - 1 - epoch_start) // options.step)
+
+	oldest = 0
+	if 'since' in query:
+		oldest = max(oldest, -((epoch_start - int(query['since'])) // options.step))
+
+	numbers = range(newest, max(oldest, newest - limit + 1) - 1, -1)
+
+	page = { 'data' : [ post(n, fields) for n in numbers ] }
+	if numbers:
+		next_query = dict(query)
+		next_query['until'] = str(post_epoch(numbers[-1]))
+		page['paging'] = { 'previous' : graph_url(path, dict(query, since=str(post_epoch(numbers[0])))),
+			'next' : graph_url(path, next_query) }
+
+	return page
+
+def graph_error( message, code, status ):
+	return (status, { 'error' : { 'message' : message, 'type' : 'OAuthException', 'code' : code } })
+
+# Answers one GET; returns (status, response)
+def get( path, query ):
+	if 'access_token' not in query:
+		return graph_error("An active access token must be used to query information about the current user.", 2500, 400)
+
+	parts = [ part for part in path.split('/') if part ]
+
+	# A version prefix (/v2.5/...) is accepted and ignored
+	if parts and parts[0].startswith('v') and parts[0][1:].replace('.', '').isdigit():
+		parts = parts[1:]
+
+	# Any node's posts are the same posts: "me", or a page
+	if len(parts) == 2 and parts[1] in ('posts', 'feed'):
+		return (200, posts_page(query, path))
+
+	if len(parts) == 2 and parts[1] == 'likes':
+		n = post_number(parts[0])
+		if n is None:
+			return graph_error("Unsupported get request.", 100, 400)
+
+		limit = min(int(query.get('limit', options.page_size)), 1000)
+		return (200, likes_page(n, decode_cursor(query.get('after', '')), limit, query, path, query.get('summary') == 'true'))
+
+	if not parts and 'ids' in query:
+		found = {}
+		for fbk_id in query['ids'].split(','):
+			n = post_number(fbk_id)
+			if n is None:
+				return graph_error("Some of the aliases you requested do not exist: %s" % fbk_id, 803, 404)
+
+			found[fbk_id] = { 'id' : fbk_id, 'likes' : { 'data' : [], 'summary' : { 'total_count' : like_count(n) } } }
+		return (200, found)
+
+	return graph_error("Unknown path components: %s" % path, 2500, 400)
+
+# Shared by the server's threads
+lock = threading.Lock()
+failure_rng = random.Random()
+stats = { 'requests' : 0, 'errors' : 0, 'throttled' : 0 }
+
+# None, 'error' or 'throttle', at the configured rates
+def injected_failure( ):
+	with lock:
+		r = failure_rng.random()
+
+	if r < options.throttle_rate:
+		return 'throttle'
+	if r < options.throttle_rate + options.error_rate:
+		return 'error'
+	return None
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *log_args):
+		if options.verbose:
+			http.server.BaseHTTPRequestHandler.log_message(self, format, *log_args)
+
+	def send_body(self, status, body, headers={}):
+		if options.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+			body = gzip.compress(body, 6)
+			headers = dict(headers, **{ 'Content-Encoding' : 'gzip' })
+
+		self.send_response(status)
+		for (k, v) in headers.items():
+			self.send_header(k, v)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def send_json(self, status, response):
+		usage = json.dumps({ 'call_count' : options.usage, 'total_cputime' : options.usage, 'total_time' : options.usage })
+
+		self.send_body(status, json.dumps(response).encode('utf-8'),
+			{ 'Content-Type' : 'application/json; charset=UTF-8', 'X-App-Usage' : usage })
+
+	# The latency and failures every request is subject to. Returns True if the request has been answered.
+	def fail(self):
+		with lock:
+			stats['requests'] += 1
+
+		if options.latency:
+			time.sleep(options.latency / 1000.0)
+
+		failure = injected_failure()
+		if failure == 'throttle':
+			with lock:
+				stats['throttled'] += 1
+
+			(status, response) = graph_error("(#4) Application request limit reached", 4, 400)
+			usage = json.dumps({ 'call_count' : 100, 'total_cputime' : 100, 'total_time' : 100 })
+			self.send_body(status, json.dumps(response).encode('utf-8'),
+				{ 'Content-Type' : 'application/json; charset=UTF-8', 'X-App-Usage' : usage, 'Retry-After' : str(options.retry_after) })
+			return True
+
+		if failure == 'error':
+			with lock:
+				stats['errors'] += 1
+
+			self.send_body(503, b'Service Unavailable', { 'Content-Type' : 'text/plain' })
+			return True
+
+		return False
+
+	def do_GET(self):
+		if self.fail():
+			return
+
+		parts = urllib.parse.urlsplit(self.path)
+		self.send_json( *get(parts.path, dict(urllib.parse.parse_qsl(parts.query))) )
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+
+		if self.fail():
+			return
+
+		fields = dict(urllib.parse.parse_qsl(body))
+		if 'batch' not in fields:
+			return self.send_json( *graph_error("Unsupported post request.", 100, 400) )
+
+		requests = json.loads(fields['batch'])
+		if len(requests) > 50:
+			return self.send_json( *graph_error("Too many requests in batch message. Maximum batch size is 50", 1, 400) )
+
+		results = []
+		for request in requests:
+			# Graph can leave part of a batch undone (null), or fail some of it
+			failure = injected_failure()
+			if failure == 'error':
+				results.append(None)
+				continue
+
+			if failure == 'throttle':
+				(status, response) = graph_error("(#4) Application request limit reached", 4, 400)
+			else:
+				relative = urllib.parse.urlsplit('/' + request['relative_url'].lstrip('/'))
+				query = dict(urllib.parse.parse_qsl(relative.query))
+				query.setdefault('access_token', fields.get('access_token', ''))
+				(status, response) = get(relative.path, query)
+
+			results.append({ 'code' : status, 'headers' : [], 'body' : json.dumps(response) })
+
+		self.send_json(200, results)
+
+class StandinServer(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+def add_arguments( parser ):
+	parser.add_argument('-p', '--port', type=int, default=default_port,
+			help='The port to listen on, on 127.0.0.1 (default: %s; 0 picks a free one)' % default_port)
+
+	parser.add_argument('-n', '--posts', type=int, default=1000,
+			help='The number of posts on the timeline (default: 1000)')
+
+	parser.add_argument('--likes', type=int, default=40,
+			help='The most likes a post has; counts run from 0 to this (default: 40)')
+
+	parser.add_argument('--step', type=int, default=default_step,
+			help='Seconds between posts (default: %s)' % default_step)
+
+	parser.add_argument('--page-size', type=int, default=default_page_size,
+			help='Posts (or likes) to a page when a request gives no limit (default: %s)' % default_page_size)
+
+	parser.add_argument('--seed', type=int, default=1,
+			help='Varies the posts\' messages and like counts (default: 1)')
+
+	parser.add_argument('--latency', type=float, default=0,
+			help='Milliseconds to wait before answering each request (default: 0)')
+
+	parser.add_argument('--error-rate', type=float, default=0,
+			help='The share of requests (and of the requests in a batch) that fail, with a 503 (default: 0)')
+
+	parser.add_argument('--throttle-rate', type=float, default=0,
+			help='The share of requests that get Graph\'s rate limit error (default: 0)')
+
+	parser.add_argument('--retry-after', type=int, default=1,
+			help='The Retry-After, in seconds, sent with a rate limit error (default: 1)')
+
+	parser.add_argument('--usage', type=int, default=0,
+			help='The usage percentage reported in X-App-Usage (default: 0)')
+
+	parser.add_argument('--gzip', action="store_true",
+			help='Gzip responses to clients that accept it')
+
+	parser.add_argument('-v', '--verbose', action="store_true",
+			help='Log every request')
+
+	parser.add_argument('--version', action='version', version='%(prog)s 1.0')
+
+def run( run_args ):
+	global options
+
+	options = run_args
+
+	server = StandinServer(('127.0.0.1', options.port), StandinHandler)
+	options.base_url = "http://127.0.0.1:%s" % server.server_address[1]
+
+	# The first line is the address, for whoever started us (fbk_bench_3 reads it)
+	print(options.base_url)
+	sys.stdout.flush()
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+	server.server_close()
+	print("Served %(requests)s requests (%(errors)s errors, %(throttled)s throttled)" % stats)
+	return 0
+
+# Main()
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='Serve synthetic posts and likes in place of the Graph API')
+	add_arguments(parser)
+
+	sys.exit( run(parser.parse_args()) )
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts and packages live at the top of the repository, which isn't installed as a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,84 @@
+import io
+import re
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+bs4 = pytest.importorskip('bs4')
+
+import fbk_publish_3
+from fbk_config import fbk_config
+
+# (fbk_id, message, created_timestamp, privacy_description, created_epoch), as publish() selects them
+posts = [
+	('100_1', 'Plain status', '2014-03-04T18:20:00+0000', 'Public', 1393957200),
+	('100_2', 'Markup <b>is</b> escaped & "quoted" \'too\'', '2014-03-09T06:59:59+0000', 'Public', 1394348399),
+	('100_3', 'Across the DST change\nwith a second line\n\nand a blank one', '2014-03-09T07:00:00+0000', 'Public', 1394348400),
+	('100_4', 'Unicode: café — 東京 🎉', '2013-12-31T23:59:59+0000', 'Public', 1388534399),
+	('100_5', 'Midnight and noon', '2014-01-01T05:00:00+0000', 'Public', 1388552400),
+	('100_6', 'Noon', '2014-01-01T17:00:00+0000', 'Public', 1388595600),
+	('100_7', 'An offset timestamp', '2014-07-04T12:30:00-0400', 'Public', None),
+	('100_8', '  leading and trailing whitespace  ', '2012-02-29T12:00:00+0000', 'Public', 1330516800),
+	('100_9<x>', 'An id needing escaping', '2011-11-06T06:30:00+0000', 'Public', 1320561000),
+]
+
+now = datetime(2014, 3, 10, 12, 0, 0, tzinfo=ZoneInfo('America/New_York'))
+
+@pytest.fixture(autouse=True)
+def publish_config( monkeypatch ):
+	monkeypatch.setattr(fbk_publish_3, 'obj_config', fbk_config.Config({ 'name' : 'Test & <Person>', 'tagline' : 'A "tagline" & more' }), raising=False)
+	monkeypatch.setattr(fbk_publish_3, 'local_tz', ZoneInfo('America/New_York'), raising=False)
+
+def render( renderer, full ):
+	outfile = io.StringIO()
+	fbk_publish_3.renderers[renderer]( iter(posts), outfile, full, now )
+
+	return outfile.getvalue()
+
+# The DOM as (tag, attributes, children), with runs of whitespace collapsed and whitespace-only text dropped, as
+# prettify() reflows text and indents
+def normalise( node ):
+	if isinstance(node, bs4.Comment):
+		return ('#comment', ' '.join(node.split()))
+
+	if isinstance(node, bs4.NavigableString):
+		return ' '.join(node.split())
+
+	attrs = sorted( (k, ' '.join(v) if isinstance(v, list) else v) for (k, v) in node.attrs.items() )
+
+	children = []
+	for child in node.children:
+		child = normalise(child)
+		if child == '':
+			continue
+		if isinstance(child, str) and children and isinstance(children[-1], str):
+			children[-1] += ' ' + child
+		else:
+			children.append(child)
+
+	return (node.name, attrs, children)
+
+def dom( contents ):
+	return normalise( bs4.BeautifulSoup(contents, 'html.parser') )
+
+def count_nodes( tree ):
+	if isinstance(tree, tuple) and len(tree) == 3:
+		return 1 + sum( count_nodes(child) for child in tree[2] )
+
+	return 1
+
+@pytest.mark.parametrize('full', [True, False])
+def test_template_matches_soup( full ):
+	template = dom(render('template', full))
+	soup = dom(render('soup', full))
+
+	assert template == soup
+	assert count_nodes(template) > len(posts) * 8
+
+def test_template_escapes():
+	contents = render('template', True)
+
+	assert 'Test &amp; &lt;Person&gt;' in contents
+	assert '<b>' not in contents
+	assert len(re.findall(r'class="feedentry hentry"', contents)) == len(posts)